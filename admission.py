@@ -0,0 +1,155 @@
+import asyncio
+import math
+import time
+
+import metrics
+import utils
+from config import *
+
+# Admission control for the messaging port.
+# Connections are limited globally and per IP address, and every address gets token buckets for new connections and received bytes.
+# Addresses that break the protocol (malformed frames or JSON, framing.ProtocolError, too many connections) collect penalty points,
+# which decay over time. Addresses with too many points are blocked for a while, longer each time they are blocked again.
+
+class TokenBucket():
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_update = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_update) * self.rate)
+        self._last_update = now
+
+    def consume(self, amount: float = 1) -> bool:
+        self._refill()
+        if self._tokens < amount:
+            return False
+        self._tokens -= amount
+        return True
+
+    def take(self, amount: float) -> float:
+        """Takes the tokens even if there aren't enough, and returns how long to wait until the debt is paid off."""
+        self._refill()
+        self._tokens -= amount
+        return max(0.0, -self._tokens / self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+class _AddressState():
+    def __init__(self):
+        self.connections = TokenBucket(CONNECTIONS_PER_SECOND_PER_IP, CONNECTION_BURST_PER_IP)
+        self.bytes = TokenBucket(BYTES_PER_SECOND_PER_IP, BYTE_BURST_PER_IP)
+        self.active_handlers = 0
+        self.penalty = 0.0
+        self.penalty_time = time.monotonic()
+        self.blocked_until = 0.0
+        self.block_count = 0
+
+    def get_penalty(self) -> float:
+        now = time.monotonic()
+        self.penalty *= math.pow(0.5, (now - self.penalty_time) / PENALTY_HALF_LIFE)
+        self.penalty_time = now
+        return self.penalty
+
+    def is_idle(self) -> bool:
+        return self.active_handlers == 0 and self.blocked_until <= time.monotonic() and self.get_penalty() < 0.01 and self.connections.is_full() and self.bytes.is_full()
+
+class AdmissionController():
+    def __init__(self):
+        self._addresses: dict[str, _AddressState] = {}
+        self._banned: set[str] = set() # banned by the user, until they are unbanned
+        self._active_handlers = 0
+
+    def _get_state(self, ip: str) -> _AddressState:
+        state = self._addresses.get(ip)
+        if state is None:
+            if len(self._addresses) >= MAX_TRACKED_ADDRESSES:
+                self._prune()
+            state = _AddressState()
+            self._addresses[ip] = state
+        return state
+
+    def _prune(self):
+        for ip in [ip for ip, state in self._addresses.items() if state.is_idle()]:
+            del self._addresses[ip]
+
+    def _reject(self, reason: str) -> bool:
+        metrics.increment(f'admission.rejected.{reason}')
+        return False
+
+    def ban(self, ip: str):
+        self._banned.add(ip)
+
+    def unban(self, ip: str):
+        self._banned.discard(ip)
+        state = self._addresses.get(ip)
+        if state:
+            state.blocked_until = 0.0
+            state.penalty = 0.0
+
+    def is_blocked(self, ip: str) -> bool:
+        if ip in self._banned:
+            return True
+        state = self._addresses.get(ip)
+        return state is not None and state.blocked_until > time.monotonic()
+
+    def get_blocked_addresses(self) -> dict[str, float]:
+        """Returns the blocked addresses with the seconds left until they are unblocked (infinite if they were banned)."""
+        now = time.monotonic()
+        result = {ip: state.blocked_until - now for ip, state in self._addresses.items() if state.blocked_until > now}
+        result.update({ip: math.inf for ip in self._banned})
+        return result
+
+    def admit(self, ip: str) -> bool:
+        """Called for each new connection. If it returns True, `release` must be called when the connection is closed."""
+        if self.is_blocked(ip):
+            return self._reject('blocked')
+        if self._active_handlers >= MAX_CONCURRENT_HANDLERS:
+            return self._reject('capacity')
+        state = self._get_state(ip)
+        if state.active_handlers >= MAX_CONNECTIONS_PER_IP:
+            self.report_violation(ip, 'connections')
+            return self._reject('connections')
+        if not state.connections.consume():
+            self.report_violation(ip, 'connection_rate')
+            return self._reject('connection_rate')
+        state.active_handlers += 1
+        self._active_handlers += 1
+        metrics.set_gauge('admission.handlers.active', self._active_handlers)
+        return True
+
+    def release(self, ip: str):
+        state = self._addresses.get(ip)
+        if state and state.active_handlers > 0:
+            state.active_handlers -= 1
+        self._active_handlers = max(0, self._active_handlers - 1)
+        metrics.set_gauge('admission.handlers.active', self._active_handlers)
+
+    async def throttle(self, ip: str, byte_count: int):
+        """Waits until the address may send `byte_count` more bytes. The connection isn't read in the meantime, which slows the sender down."""
+        delay = self._get_state(ip).bytes.take(byte_count)
+        if delay > 0:
+            metrics.increment('admission.throttled')
+            metrics.increment('admission.throttled_seconds', delay)
+            await asyncio.sleep(delay)
+
+    def report_violation(self, ip: str, reason: str, penalty: float = 1.0):
+        """Adds penalty points to the address and blocks it if it has too many."""
+        metrics.increment(f'admission.violations.{reason}')
+        state = self._get_state(ip)
+        state.penalty = state.get_penalty() + penalty
+        if state.penalty < BLOCK_PENALTY_THRESHOLD or state.blocked_until > time.monotonic():
+            return
+        duration = min(BLOCK_DURATION * 2 ** state.block_count, MAX_BLOCK_DURATION)
+        state.block_count += 1
+        state.blocked_until = time.monotonic() + duration
+        state.penalty = 0.0
+        metrics.increment('admission.blocked')
+        utils.print_warning(f"Blocked {ip} for {duration:.0f} seconds ({reason}).")
+
+controller = AdmissionController()
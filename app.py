@@ -13,6 +13,7 @@ import PIL.Image
 import utils
 import message_server
 import commands
+import presence
 import markdown
 from attachment import Attachment
 from message import Message
@@ -223,9 +224,8 @@ class App(tk.Frame):
         self.attachment_bar_up_to_date = False
         for filename in filenames:
             try:
-                with open(filename, mode='rb') as file:
-                    attachment = Attachment(filename, file.read())
-                    self.upload_attachment(attachment)
+                attachment = Attachment.from_file(filename)
+                self.upload_attachment(attachment)
             except:
                 message_server.inbound_message_queue.put(MessagePacket(Message('<system>', f'Failed to access `{filename}`'), ['<localhost>']))
 
@@ -256,6 +256,9 @@ class App(tk.Frame):
                 elif local:
                     self.chatlog.insert(tk.END, username + user_suffix, 'localuser')
                 else:
+                    channel = message.get_metadata().get('channel')
+                    if isinstance(channel, str):
+                        username += f' #{channel}'
                     self.chatlog.insert(tk.END, username + user_suffix, 'user')
                 parsed_text = markdown.parse_markdown(sanitized_text)
                 for wordblock, tag in parsed_text:
@@ -308,6 +311,7 @@ class UserList(tk.Frame):
         self.user_list.grid(row=1, column=0, sticky='news')
 
         self._user_buttons: dict[User, UserListButton] = {}
+        self._presence_version = -1 # the buttons are compared with `Users` when the presence tracker's version changes
         self.update()
     def update(self):
         self.after(MSPT, self.update)
@@ -315,10 +319,22 @@ class UserList(tk.Frame):
         self.label.configure(bg = self.var_bg0.get(), fg = self.var_fg.get(), text = self.var_title.get())
         self.user_list.configure(bg = self.var_bg1.get())
 
+        presence_version = presence.tracker.get_version()
+        if presence_version != self._presence_version:
+            self._presence_version = presence_version # read first, changes made while reconciling are picked up next tick
+            self.reconcile()
+    def reconcile(self):
         users = Users.get_all_users()
         for user in users:
-            if user not in self._user_buttons and user.is_active():
+            button = self._user_buttons.get(user)
+            if button:
+                if button.is_active() != user.is_active():
+                    button.set_active(user.is_active())
+            elif user.is_active():
                 self.add_user(user)
+        removed = set(self._user_buttons).difference(users) # offline for long
+        for user in removed:
+            self._user_buttons.pop(user).destroy()
     def add_user(self, user: User):
         username = user.get_username()
         button = UserListButton(self.user_list, user=user, text=username)
@@ -346,35 +362,48 @@ class UserListButton(tk.Button):
         self.var_bg_selected = utils.bind_variable_to_setting(tk.StringVar(), 'theme.button.selected', '#11e')
         self.var_fg = utils.bind_variable_to_setting(tk.StringVar(), 'theme.font.color', '#fff')
 
+        self.var_bg_idle.trace_add('write', self.update)
+        self.var_bg_hover.trace_add('write', self.update)
+        self.var_bg_selected.trace_add('write', self.update)
+        self.var_fg.trace_add('write', self.update)
+
         self.configure(border=0, anchor='w', command=self._on_command, text=user.get_username())
         self.bind('<Enter>', self._on_enter)
         self.bind('<Leave>', self._on_leave)
         self._hover = False
         self._selected = False
+        self._active = user.is_active()
         self.user = user
         self.update()
     def is_selected(self):
         return self._selected
     def _get_username(self):
         return self.user.get_username()
+    def is_active(self) -> bool:
+        return self._active
+    def set_active(self, active: bool):
+        self._active = active
+        self.update()
     def _on_enter(self, e: object):
         self._hover = True
+        self.update()
     def _on_leave(self, e: object):
         self._hover = False
+        self.update()
     def _on_command(self):
         self._selected = not self._selected
+        self.update()
     def __lt__(self, other: object):
         if not isinstance(other, UserListButton):
             raise NotImplemented
         return self._get_username() < other._get_username()
-    def update(self):
-        self.after(MSPT, self.update)
+    def update(self, *args):
         fg, bg, text = self.var_fg.get(), self.var_bg_idle.get(), ''
         if self._selected:
             bg = self.var_bg_selected.get()
         elif self._hover:
             bg = self.var_bg_hover.get()
-        if self.user.is_active():
+        if self._active:
             text = self._get_username()
         else:
             fg, text ='#aaa', self._get_username() + " (Inactive)"
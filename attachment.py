@@ -1,5 +1,8 @@
 import base64
+import io
 import json
+import mmap
+import os
 from typing import assert_type
 
 def sanitize_filename(filename: str):
@@ -17,14 +20,60 @@ def sanitize_filename(filename: str):
     result = result.translate(dict.fromkeys(range(32)))
     return result
 
+class _FileRegion(io.RawIOBase):
+    """Reads `size` bytes of a file starting at `offset`, as if they were the whole file."""
+    def __init__(self, path: str, offset: int, size: int):
+        self._file = open(path, mode='rb')
+        self._offset = offset
+        self._size = size
+        self._position = 0
+        self._file.seek(offset)
+
+    def readable(self) -> bool:
+        return True
+    def seekable(self) -> bool:
+        return True
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast('B')[:max(0, self._size - self._position)]
+        count = self._file.readinto(view) or 0
+        self._position += count
+        return count
+    def seek(self, position: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self._size
+        self._position = min(max(0, position), self._size)
+        self._file.seek(self._offset + self._position)
+        return self._position
+    def tell(self) -> int:
+        return self._position
+    def close(self):
+        self._file.close()
+        super().close()
+
 class Attachment():
-    def __init__(self, filename: str, content: bytes):
+    """The content is either a buffer (`bytes`, or a view into a larger buffer) or a region of a file, which is only read when it's needed."""
+    def __init__(self, filename: str, content: bytes|bytearray|memoryview):
         assert isinstance(filename, str), 'filename must be a str object'
-        assert isinstance(content, bytes), 'filename must be a bytes object'
-        self._content = content
+        assert isinstance(content, (bytes, bytearray, memoryview)), 'content must be a bytes-like object'
+        self._content = content if isinstance(content, bytes) else memoryview(content).cast('B')
         self._filename = sanitize_filename(filename)
+        self._path: str|None = None
+        self._offset = 0
+        self._size = len(self._content)
+        self._saved = False
     
     @staticmethod
+    def from_file(path: str, filename: str|None = None, saved: bool = False, offset: int = 0, size: int|None = None):
+        # the content is read from the file only when it's needed
+        attachment = Attachment(filename or path, b'')
+        attachment._path = path
+        attachment._offset = offset
+        attachment._size = os.path.getsize(path) - offset if size is None else size
+        attachment._saved = saved and offset == 0 and size is None
+        return attachment
+    @staticmethod
     def from_str(string: str):
         decoded_oject = json.loads(string)
         return Attachment.from_dict(decoded_oject)
@@ -37,16 +86,42 @@ class Attachment():
     
     def get_sanitized_filename(self) -> str:
         return sanitize_filename(self._filename)
+    def get_path(self) -> str|None:
+        return self._path
+    def get_offset(self) -> int:
+        return self._offset
+    def is_saved(self) -> bool:
+        return self._saved
+    def open(self) -> io.BufferedIOBase:
+        if self._path is not None:
+            if self._offset == 0 and self._size == os.path.getsize(self._path):
+                return open(self._path, mode='rb')
+            return io.BufferedReader(_FileRegion(self._path, self._offset, self._size))
+        return io.BytesIO(self._content)
     def get_content(self) -> bytes:
-        return self._content
+        if self._path is not None:
+            with self.open() as file:
+                return file.read()
+        return bytes(self._content)
+    def get_view(self) -> memoryview:
+        """Returns the content without copying it. Files are memory mapped."""
+        if self._path is None:
+            return memoryview(self._content)
+        if self._size == 0:
+            return memoryview(b'')
+        # mappings must start at a multiple of the allocation granularity
+        start = self._offset - self._offset % mmap.ALLOCATIONGRANULARITY
+        with open(self._path, mode='rb') as file:
+            mapping = mmap.mmap(file.fileno(), self._offset - start + self._size, offset=start, access=mmap.ACCESS_READ)
+        return memoryview(mapping)[self._offset - start:]
     def get_base64encoded_content(self) -> bytes:
-        return base64.b64encode(self._content)
+        return base64.b64encode(self.get_view())
     def get_content_size(self):
-        return len(self._content)
+        return self._size
     def to_dict(self):
         return {
             "filename": self.get_sanitized_filename(),
             "base64_content": self.get_base64encoded_content().decode(encoding='ascii')
         }
     def __str__(self):
-        return json.dumps(self.to_dict())
\ No newline at end of file
+        return json.dumps(self.to_dict())
@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# Load benchmark: starts several headless instances on 127.0.0.x loopback addresses and sends messages between them
+# through their control interface (see headless.py), which queues them like the chat input does.
+# Reports delivered messages per second, end-to-end latency, connection and key exchange times and memory use.
+# Run from anywhere with `python3 benchmarks/load.py --nodes 4 --messages 500`, add `--json` for machine readable output.
+#
+# Instances find each other with presence announcements sent directly to the other addresses (--peers), and use
+# their own ports (16000 and 16001 by default), so a running app isn't disturbed.
+# Every address in 127.0.0.0/8 works out of the box on Linux, other systems may need loopback aliases.
+# Latency is measured with time.monotonic_ns, which is the same clock in every process on Linux, Windows and macOS.
+
+HEADLESS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'headless.py')
+BENCHMARK_PREFIX = 'bench'
+
+def get_percentile(values: list[float], percentile: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(percentile / 100 * (len(ordered) - 1)))]
+
+def get_rss(pid: int) -> int|None:
+    """Returns the resident set size of the process in bytes, or None if it can't be read on this system."""
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+class Node():
+    def __init__(self, index: int, address: str, directory: str):
+        self.index = index
+        self.address = address
+        self.username = f'node{index}'
+        self.directory = directory
+        self.process: asyncio.subprocess.Process|None = None
+        self.online: set[str] = set()
+        self.latencies: list[float] = [] # in seconds
+        self.received: set[tuple[str, int]] = set() # (author, sequence number)
+        self.duplicates = 0
+        self.errors: list[str] = []
+        self.stats: dict[str, float] = {}
+        self.stats_received = asyncio.Event()
+        self.max_rss = 0
+        self.first_receive_time = 0.0
+        self.last_receive_time = 0.0
+        self._reader_task: asyncio.Task|None = None
+
+    async def start(self, options: argparse.Namespace, peers: list[str]):
+        os.makedirs(self.directory, exist_ok=True)
+        self.process = await asyncio.create_subprocess_exec(
+            options.python, HEADLESS_PATH, '-d', '0', '--json',
+            '--address', self.address, '--peers', ','.join(peers),
+            '--discovery-port', str(options.discovery_port), '--messaging-port', str(options.messaging_port),
+            cwd=self.directory, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        self._reader_task = asyncio.create_task(self._read_output())
+        await self.send_line(f'/username {self.username}')
+
+    async def send_line(self, line: str):
+        assert self.process is not None and self.process.stdin is not None
+        self.process.stdin.write(line.encode('utf-8') + b'\n')
+        await self.process.stdin.drain()
+
+    async def request_stats(self) -> dict[str, float]:
+        self.stats_received.clear()
+        await self.send_line('/stats')
+        await self.stats_received.wait()
+        return self.stats
+
+    def sample_rss(self):
+        if self.process is not None:
+            self.max_rss = max(self.max_rss, get_rss(self.process.pid) or 0)
+
+    async def stop(self, timeout: float):
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            await self.send_line('/exit')
+            await asyncio.wait_for(self.process.wait(), timeout=timeout)
+        except (TimeoutError, ConnectionError):
+            # a node that doesn't exit after /exit is a bug, it's reported instead of hidden
+            print(f'The node on {self.address} did not exit after /exit, killed it', file=sys.stderr)
+            self.process.kill()
+            await self.process.wait()
+        if self._reader_task:
+            self._reader_task.cancel()
+
+    async def _read_output(self):
+        assert self.process is not None and self.process.stdout is not None
+        while line := await self.process.stdout.readline():
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            self._handle_message(str(message.get('author')), str(message.get('text')))
+
+    def _handle_message(self, author: str, text: str):
+        now = time.monotonic_ns()
+        if author == '<system>':
+            if text.startswith('Network statistics:'):
+                for stat in text.splitlines()[1:]:
+                    name, _, value = stat.strip().partition(': ')
+                    self.stats[name] = float(value)
+                self.stats_received.set()
+            elif text.startswith('User ') and text.endswith(' is now online!'):
+                self.online.add(text[len('User '):-len(' is now online!')])
+            elif text.startswith('Failed'):
+                self.errors.append(text)
+            return
+        parts = text.split(' ', 3)
+        if author == self.username or len(parts) < 3 or parts[0] != BENCHMARK_PREFIX:
+            return
+        key = (author, int(parts[1]))
+        if key in self.received:
+            self.duplicates += 1
+            return
+        self.received.add(key)
+        self.latencies.append((now - int(parts[2])) / 1e9)
+        self.first_receive_time = self.first_receive_time or time.monotonic()
+        self.last_receive_time = time.monotonic()
+
+def create_message_line(sender: Node, receivers: list[Node], sequence: int, options: argparse.Namespace, attachment_path: str) -> str:
+    text = f'{BENCHMARK_PREFIX} {sequence} {time.monotonic_ns()} '
+    text += 'x' * max(0, options.size - len(text))
+    attachments = [attachment_path] if random.random() < options.attachment_ratio else []
+    return json.dumps({'to': [receiver.username for receiver in receivers], 'text': text, 'attachments': attachments})
+
+async def wait_until(condition, timeout: float, nodes: list[Node]) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        for node in nodes:
+            node.sample_rss()
+        await asyncio.sleep(0.05)
+    return True
+
+async def send_messages(sender: Node, nodes: list[Node], options: argparse.Namespace, attachment_path: str, first_sequence: int, count: int) -> int:
+    """Sends `count` messages to random receivers and returns how many deliveries are expected."""
+    others = [node for node in nodes if node is not sender]
+    expected = 0
+    start = time.monotonic()
+    for i in range(count):
+        if options.rate > 0: # an open loop, messages are sent on schedule even if the previous ones are late
+            await asyncio.sleep(max(0.0, start + i / options.rate - time.monotonic()))
+        receivers = random.sample(others, min(options.receivers, len(others)))
+        await sender.send_line(create_message_line(sender, receivers, first_sequence + i, options, attachment_path))
+        expected += len(receivers)
+    return expected
+
+def get_delivered(nodes: list[Node]) -> int:
+    return sum(len(node.received) for node in nodes)
+
+def get_average(nodes: list[Node], total_name: str, count_name: str) -> float:
+    count = sum(node.stats.get(count_name, 0) for node in nodes)
+    return sum(node.stats.get(total_name, 0) for node in nodes) / count if count else 0.0
+
+async def run(options: argparse.Namespace) -> dict:
+    directory = tempfile.mkdtemp(prefix='mores-chat-benchmark-')
+    addresses = [f'{options.base_address}.{options.first_host + i}' for i in range(options.nodes)]
+    nodes = [Node(i, address, os.path.join(directory, f'node{i}')) for i, address in enumerate(addresses)]
+    attachment_path = os.path.join(directory, 'attachment.bin')
+    with open(attachment_path, 'wb') as file:
+        file.write(os.urandom(options.attachment_size))
+    try:
+        start = time.monotonic()
+        for node in nodes:
+            await node.start(options, [address for address in addresses if address != node.address])
+        usernames = {node.username for node in nodes}
+        if not await wait_until(lambda: all(node.online >= usernames - {node.username} for node in nodes), options.timeout, nodes):
+            raise RuntimeError('The nodes did not discover each other, see the --timeout option')
+        discovery_time = time.monotonic() - start
+
+        # the first message to each peer opens the connection and exchanges keys, they aren't part of the measurement
+        for node in nodes:
+            others = [other for other in nodes if other is not node]
+            await node.send_line(create_message_line(node, others, 0, options, attachment_path))
+        if not await wait_until(lambda: get_delivered(nodes) >= options.nodes * (options.nodes - 1), options.timeout, nodes):
+            raise RuntimeError('Warm up messages were not delivered, see the --timeout option')
+        for node in nodes:
+            node.latencies.clear()
+            node.first_receive_time = 0.0
+
+        delivered_before = get_delivered(nodes)
+        start = time.monotonic()
+        expected = sum(await asyncio.gather(*(send_messages(node, nodes, options, attachment_path, 1, options.messages) for node in nodes)))
+        send_time = time.monotonic() - start
+        await wait_until(lambda: get_delivered(nodes) - delivered_before >= expected, options.timeout, nodes)
+        delivered = get_delivered(nodes) - delivered_before
+        duration = max(node.last_receive_time for node in nodes) - start
+
+        for node in nodes:
+            await asyncio.wait_for(node.request_stats(), timeout=options.timeout)
+        latencies = [latency for node in nodes for latency in node.latencies]
+        rss = [node.max_rss for node in nodes if node.max_rss]
+        return {
+            'nodes': options.nodes,
+            'messages_sent': options.nodes * options.messages,
+            'deliveries_expected': expected,
+            'deliveries': delivered,
+            'lost': expected - delivered,
+            'duplicates': sum(node.duplicates for node in nodes),
+            'errors': sum(len(node.errors) for node in nodes),
+            'discovery_seconds': discovery_time,
+            'send_seconds': send_time,
+            'duration_seconds': duration,
+            'deliveries_per_second': delivered / duration if duration > 0 else 0.0,
+            'latency_p50_ms': get_percentile(latencies, 50) * 1000,
+            'latency_p99_ms': get_percentile(latencies, 99) * 1000,
+            'latency_max_ms': max(latencies, default=0.0) * 1000,
+            'connect_ms': get_average(nodes, 'pool.connect_seconds', 'pool.connections.opened') * 1000,
+            'key_exchange_ms': get_average(nodes, 'pool.key_exchange_seconds', 'pool.key_exchanges') * 1000,
+            'max_rss_mb': max(rss, default=0) / 1e6,
+            'average_rss_mb': sum(rss) / len(rss) / 1e6 if rss else 0.0,
+        }
+    finally:
+        await asyncio.gather(*(node.stop(options.timeout) for node in nodes))
+        if options.keep:
+            print(f'Kept the node directories in {directory}', file=sys.stderr)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+def print_report(result: dict):
+    print(f"{result['nodes']} nodes, {result['messages_sent']} messages, {result['deliveries']}/{result['deliveries_expected']} delivered"
+          f" ({result['lost']} lost, {result['duplicates']} duplicates, {result['errors']} errors)")
+    print(f"  throughput:   {result['deliveries_per_second']:.1f} deliveries/s over {result['duration_seconds']:.2f} s (queued in {result['send_seconds']:.2f} s)")
+    print(f"  latency:      p50 {result['latency_p50_ms']:.1f} ms, p99 {result['latency_p99_ms']:.1f} ms, max {result['latency_max_ms']:.1f} ms")
+    print(f"  handshakes:   connect and hello {result['connect_ms']:.1f} ms, key exchange {result['key_exchange_ms']:.1f} ms, discovery {result['discovery_seconds']:.2f} s")
+    if result['max_rss_mb']:
+        print(f"  memory:       {result['average_rss_mb']:.1f} MB average, {result['max_rss_mb']:.1f} MB max resident per node")
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures MoRes-Chat throughput and latency with several instances on loopback addresses.')
+    parser.add_argument('--nodes', help='number of instances (default 4)', default=4, type=int)
+    parser.add_argument('--messages', help='messages sent by each instance (default 200)', default=200, type=int)
+    parser.add_argument('--rate', help='messages per second sent by each instance, 0 for as fast as possible (default 0)', default=0.0, type=float)
+    parser.add_argument('--receivers', help='receivers of each message (default 1)', default=1, type=int)
+    parser.add_argument('--size', help='text size of each message in bytes (default 64)', default=64, type=int)
+    parser.add_argument('--attachment-ratio', help='fraction of messages with an attachment (default 0)', default=0.0, type=float)
+    parser.add_argument('--attachment-size', help='attachment size in bytes (default 65536)', default=65536, type=int)
+    parser.add_argument('--base-address', help='first three parts of the loopback addresses (default 127.0.0)', default='127.0.0')
+    parser.add_argument('--first-host', help='last part of the first address (default 2)', default=2, type=int)
+    parser.add_argument('--discovery-port', help='discovery port of the instances (default 16000)', default=16000, type=int)
+    parser.add_argument('--messaging-port', help='messaging port of the instances (default 16001)', default=16001, type=int)
+    parser.add_argument('--python', help='interpreter for the instances (default the current one)', default=sys.executable)
+    parser.add_argument('--timeout', help='seconds to wait for discovery and deliveries (default 60)', default=60.0, type=float)
+    parser.add_argument('--max-p99-ms', help='exit with an error if the p99 latency is higher', type=float)
+    parser.add_argument('--min-throughput', help='exit with an error if fewer deliveries per second are made', type=float)
+    parser.add_argument('--keep', help="don't delete the directories of the instances", action='store_true')
+    parser.add_argument('--json', help='print the results as JSON', action='store_true')
+    options = parser.parse_args()
+    if options.nodes < 2:
+        parser.error('at least 2 nodes are needed')
+    if options.first_host + options.nodes > 255:
+        parser.error('too many nodes for the address range')
+
+    result = asyncio.run(run(options))
+    if options.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+    failed = result['lost'] > 0
+    if options.max_p99_ms is not None and result['latency_p99_ms'] > options.max_p99_ms:
+        print(f"p99 latency {result['latency_p99_ms']:.1f} ms is above {options.max_p99_ms} ms", file=sys.stderr)
+        failed = True
+    if options.min_throughput is not None and result['deliveries_per_second'] < options.min_throughput:
+        print(f"Throughput {result['deliveries_per_second']:.1f} deliveries/s is below {options.min_throughput}", file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import struct
+
+import compression
+from attachment import Attachment
+from ciphers import SessionCipher
+from framing import *
+
+# Message frames with FLAG_BINARY_SECTION carry inline attachments as raw encrypted bytes instead of base64 in the JSON:
+#   JSON length (4 bytes, big endian) | JSON object | encrypted attachment | encrypted attachment | ...
+# The JSON object lists the attachments in 'binary_attachments', with their filenames and encrypted sizes.
+# Attachments are encrypted straight from their buffers (or memory mapped files) and the parts are written to the
+# connection one after another, so the only copy of an attachment made on the way is its ciphertext.
+
+FLAG_BINARY_SECTION = 1
+
+JSON_LENGTH = struct.Struct('!I')
+
+def encrypt_attachments(attachments: list[Attachment], cipher: SessionCipher, algorithm: str|None = None) -> tuple[list[dict], list[bytes]]:
+    """Returns the entries for 'binary_attachments' and the encrypted attachments, compressed first if it's worth it."""
+    entries = []
+    parts = []
+    for attachment in attachments:
+        data: bytes|memoryview = attachment.get_view()
+        entry: dict = {'filename': attachment.get_sanitized_filename()}
+        if algorithm and compression.is_compressible(attachment):
+            compressed = compression.compress(data, algorithm)
+            if compressed is not None:
+                data = compressed
+                entry['compression'] = algorithm
+        encrypted = cipher.encrypt(data)
+        entry['size'] = len(encrypted)
+        entries.append(entry)
+        parts.append(encrypted)
+    return entries, parts
+
+def encode_payload(obj: dict, parts: list[bytes]) -> list[bytes]:
+    """Returns the parts of the frame payload, to be passed to `PeerConnection.send_raw`."""
+    encoded_object = encode_json_payload(obj)
+    return [JSON_LENGTH.pack(len(encoded_object)), encoded_object, *parts]
+
+def decode_payload(payload: memoryview) -> tuple[dict, memoryview]:
+    """Returns the JSON object and the binary section, which is a view into the payload."""
+    if len(payload) < JSON_LENGTH.size:
+        raise FrameError('Binary payload is too short')
+    (json_length,) = JSON_LENGTH.unpack_from(payload)
+    end = JSON_LENGTH.size + json_length
+    if end > len(payload):
+        raise FrameError('Binary payload is shorter than its JSON object')
+    return decode_json_payload(payload[JSON_LENGTH.size:end]), payload[end:]
+
+def decrypt_attachments(entries: object, binary_section: memoryview, cipher: SessionCipher) -> list[Attachment]:
+    if not isinstance(entries, list):
+        raise FrameError('Invalid binary attachments')
+    attachments = []
+    offset = 0
+    for entry in entries:
+        size = int(entry['size'])
+        if size < 0 or offset + size > len(binary_section):
+            raise FrameError('Binary attachment is outside of the binary section')
+        # decrypting makes the only copy, the binary section is reused for the next frame
+        data = cipher.decrypt(binary_section[offset:offset + size])
+        if 'compression' in entry:
+            data = compression.decompress(data, str(entry['compression']))
+        attachments.append(Attachment(str(entry['filename']), data))
+        offset += size
+    return attachments
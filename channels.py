@@ -0,0 +1,339 @@
+import asyncio
+import hashlib
+import json
+import re
+import socket
+import struct
+import time
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from typing import Callable
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import ciphers
+import connection_pool
+import delivery
+import metrics
+import unicode_utils
+import utils
+from attachment import Attachment
+from config import *
+from framing import *
+from message import Message
+from user import Users
+
+# Named channels backed by an IPv4 multicast group, so one datagram reaches every member.
+#
+# Datagram: magic (2 bytes) | kind (1 byte) | channel id (8 bytes) | sender instance (16 bytes) | repair port (2 bytes) | sequence number (8 bytes) | encrypted payload
+# The payload is encrypted with a key derived from the channel name and secret, and the header is authenticated along with it.
+# Heartbeats have an empty payload, but are authenticated the same way, so nobody without the key can move a sender's sequence number.
+# Every sender numbers its datagrams per channel and keeps the latest ones, so members can ask for the ones they missed
+# over the messaging port (FRAME_CHANNEL_REPAIR). The port is in the header, so several instances can share a host. Idle senders send heartbeats with their latest sequence number,
+# so the loss of their last message is noticed too.
+
+CHANNEL_MAGIC = b'\xffC'
+CHANNEL_HEADER = struct.Struct('!2sB8s16sHQ')
+
+CHANNEL_DATA = 1
+CHANNEL_HEARTBEAT = 2
+
+_channel_name_pattern = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+
+def validate_channel_name(name: str) -> bool:
+    return bool(_channel_name_pattern.match(name))
+
+def get_channel_id(name: str) -> bytes:
+    return hashlib.sha256(b'mores-chat channel ' + name.encode()).digest()[:8]
+
+def get_multicast_group(name: str) -> str:
+    digest = hashlib.sha256(name.encode()).digest()
+    return f'{MULTICAST_GROUP_PREFIX}.{digest[0]}.{digest[1]}'
+
+def _derive_channel_key(name: str, secret: str) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'mores-chat channel ' + name.encode()).derive(secret.encode('utf-8'))
+
+class MulticastChannel():
+    def __init__(self, name: str, secret: str = ''):
+        self.name = name
+        self.secret = secret
+        self.channel_id = get_channel_id(name)
+        self.group = get_multicast_group(name)
+        self.cipher = ciphers.AEADCipher(ciphers.CIPHER_AES_GCM, _derive_channel_key(name, secret))
+        self.sequence = 0
+        self.last_sent = 0.0
+        self._history: OrderedDict[int, bytes] = OrderedDict() # sequence number -> datagram, for repairs
+
+    def encode(self, kind: int, instance: bytes, repair_port: int, payload: bytes) -> bytes:
+        if kind == CHANNEL_DATA:
+            self.sequence += 1
+        header = CHANNEL_HEADER.pack(CHANNEL_MAGIC, kind, self.channel_id, instance, repair_port, self.sequence)
+        datagram = header + self.cipher.encrypt(payload, header)
+        if kind == CHANNEL_DATA:
+            self._history[self.sequence] = datagram
+            while len(self._history) > MULTICAST_HISTORY_SIZE:
+                self._history.popitem(last=False)
+        return datagram
+
+    def get_datagram(self, sequence: int) -> bytes|None:
+        return self._history.get(sequence)
+
+class _SenderState():
+    """What a member has received from one sender on one channel."""
+    def __init__(self, next_sequence: int):
+        self.next_sequence = next_sequence
+        self.missing: set[int] = set()
+        self.repairing = False
+        self.last_seen = time.monotonic()
+
+class ChannelManager():
+    def __init__(self):
+        self._channels: dict[bytes, MulticastChannel] = {} # keyed by channel id
+        self._senders: dict[tuple[bytes, bytes], _SenderState] = {} # keyed by (channel id, sender instance)
+        self._transport: asyncio.DatagramTransport|None = None
+        self._socket: socket.socket|None = None
+        self._instance = b''
+        self._repair_port = MESSAGING_PORT
+        self._on_message: Callable[[Message, str], None] = lambda message, channel_name: None
+
+    async def start(self, instance_id: str, on_message: Callable[[Message, str], None], repair_port: int = MESSAGING_PORT):
+        """Opens the multicast socket and joins the channels saved in the settings. Repair requests are served on `repair_port`."""
+        self._instance = bytes.fromhex(instance_id)
+        self._repair_port = repair_port
+        self._on_message = on_message
+        self._socket = _create_multicast_socket()
+        self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(lambda: _ChannelProtocol(self), sock=self._socket)
+        for name, secret in _get_saved_channels().items():
+            try:
+                self.join(name, secret, save=False)
+            except Exception as e:
+                utils.print_error(f"Failed to join channel #{name}:", e)
+
+    def close(self):
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    def join(self, name: str, secret: str = '', save: bool = True):
+        if not validate_channel_name(name):
+            raise RuntimeError(f'Invalid channel name: {name}')
+        channel = MulticastChannel(name, secret)
+        if self._socket and channel.channel_id not in self._channels:
+            self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, _get_membership(channel.group))
+        self._channels[channel.channel_id] = channel
+        if save:
+            _save_channel(name, secret)
+        utils.print_info(f"Joined channel #{name} on {channel.group}:{MULTICAST_PORT}")
+
+    def leave(self, name: str):
+        channel = self._channels.pop(get_channel_id(name), None)
+        _save_channel(name, None)
+        if channel is None:
+            return
+        for key in [key for key in self._senders if key[0] == channel.channel_id]:
+            self._senders.pop(key, None)
+        if self._socket:
+            self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, _get_membership(channel.group))
+
+    def get_channel(self, name: str) -> MulticastChannel|None:
+        return self._channels.get(get_channel_id(name))
+
+    def get_channel_names(self) -> list[str]:
+        return sorted(channel.name for channel in self._channels.values())
+
+    def send(self, name: str, message: Message):
+        channel = self.get_channel(name)
+        if channel is None:
+            raise RuntimeError(f'Not a member of #{name}')
+        if self._transport is None:
+            raise RuntimeError('Channels are not running')
+        author = message.get_author_username()
+        if author == '<localhost>':
+            author = utils.get_current_username()
+        content: dict = {'author': author, 'id': message.get_id(), 'time': message.get_timestamp(), 'message': unicode_utils.with_surrogates(message.get_text_content())}
+        if message.has_attachments():
+            content['attachments'] = [attachment.to_dict() for attachment in message.get_attachments()]
+        if message.has_metadata():
+            content['metadata'] = message.get_metadata()
+        payload = json.dumps(content).encode('utf-8')
+        if len(payload) > MAX_MULTICAST_PAYLOAD:
+            raise RuntimeError(f'The message is too large for a channel ({len(payload)} bytes, at most {MAX_MULTICAST_PAYLOAD})')
+        self._transport.sendto(channel.encode(CHANNEL_DATA, self._instance, self._repair_port, payload), (channel.group, MULTICAST_PORT))
+        channel.last_sent = time.monotonic()
+        metrics.increment('channels.datagrams.sent')
+
+    async def run(self):
+        """Sends heartbeats for channels with recent messages."""
+        while True:
+            await asyncio.sleep(MULTICAST_HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for channel in list(self._channels.values()):
+                if self._transport and channel.sequence and now - channel.last_sent < MULTICAST_HEARTBEAT_TIMEOUT:
+                    self._transport.sendto(channel.encode(CHANNEL_HEARTBEAT, self._instance, self._repair_port, b''), (channel.group, MULTICAST_PORT))
+
+    def handle_repair_request(self, decoded_object: dict) -> dict:
+        """Returns the requested datagrams that are still in the history."""
+        if decoded_object.get('sender') != self._instance.hex():
+            return {'datagrams': []}
+        channel = self._channels.get(bytes.fromhex(str(decoded_object['channel'])))
+        if channel is None:
+            return {'datagrams': []}
+        datagrams = []
+        for sequence in decoded_object.get('sequences', [])[:MULTICAST_MAX_REPAIR_BATCH]:
+            datagram = channel.get_datagram(int(sequence))
+            if datagram:
+                datagrams.append(b64encode(datagram).decode('ascii'))
+        return {'datagrams': datagrams}
+
+    def handle_datagram(self, data: bytes, ip: str, repaired: bool = False) -> bool:
+        if len(data) < CHANNEL_HEADER.size:
+            return False
+        magic, kind, channel_id, instance, repair_port, sequence = CHANNEL_HEADER.unpack_from(data)
+        if magic != CHANNEL_MAGIC or instance == self._instance: # our own datagrams are looped back
+            return False
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            return False
+        if kind not in (CHANNEL_DATA, CHANNEL_HEARTBEAT):
+            return False
+        header = bytes(data[:CHANNEL_HEADER.size])
+        try:
+            payload = channel.cipher.decrypt(data[CHANNEL_HEADER.size:], header)
+            content = json.loads(payload) if kind == CHANNEL_DATA else None
+        except Exception:
+            metrics.increment('channels.datagrams.dropped')
+            return False
+        if kind == CHANNEL_HEARTBEAT and payload:
+            metrics.increment('channels.datagrams.dropped')
+            return False
+        key = (channel_id, instance)
+        state = self._senders.get(key)
+        if state and time.monotonic() - state.last_seen > MULTICAST_HEARTBEAT_TIMEOUT:
+            state = None # nothing was heard from the sender for longer than it sends heartbeats, it may have sent a lot meanwhile
+        if state and sequence - state.next_sequence > MULTICAST_MAX_SEQUENCE_JUMP:
+            metrics.increment('channels.datagrams.rejected')
+            return False
+        if state:
+            state.last_seen = time.monotonic()
+        if kind == CHANNEL_HEARTBEAT:
+            if state is None:
+                self._senders[key] = _SenderState(sequence + 1)
+            elif sequence >= state.next_sequence:
+                self._mark_missing(state, sequence + 1)
+                self._schedule_repair(channel, instance, state, (ip, repair_port))
+            return True
+        if state is None:
+            state = _SenderState(sequence) # the history before we joined is not repaired
+            self._senders[key] = state
+        if sequence < state.next_sequence:
+            if sequence not in state.missing:
+                return True # a duplicate
+            state.missing.discard(sequence)
+        else:
+            self._mark_missing(state, sequence)
+            state.next_sequence = sequence + 1
+            self._schedule_repair(channel, instance, state, (ip, repair_port))
+        if repaired:
+            metrics.increment('channels.datagrams.repaired')
+        message = self._decode_message(content, ip)
+        if message:
+            self._on_message(message, channel.name)
+        return True
+
+    def _mark_missing(self, state: _SenderState, next_sequence: int):
+        start = max(state.next_sequence, next_sequence - MULTICAST_MAX_REPAIR_BATCH)
+        state.missing.update(range(start, next_sequence))
+        state.next_sequence = max(state.next_sequence, next_sequence)
+
+    def _schedule_repair(self, channel: MulticastChannel, instance: bytes, state: _SenderState, address: tuple[str, int]):
+        if state.missing and not state.repairing:
+            state.repairing = True
+            asyncio.create_task(self._repair(channel, instance, state, address))
+
+    async def _repair(self, channel: MulticastChannel, instance: bytes, state: _SenderState, address: tuple[str, int]):
+        try:
+            for _ in range(MULTICAST_REPAIR_ATTEMPTS):
+                await asyncio.sleep(MULTICAST_REPAIR_DELAY) # late datagrams may still arrive
+                if not state.missing:
+                    return
+                connection = await connection_pool.pool.get(*address)
+                if connection is None:
+                    return
+                metrics.increment('channels.nacks.sent')
+                reply = await connection.request(FRAME_CHANNEL_REPAIR, {
+                    'channel': channel.channel_id.hex(),
+                    'sender': instance.hex(),
+                    'sequences': sorted(state.missing)[:MULTICAST_MAX_REPAIR_BATCH]
+                })
+                for datagram in reply.get('datagrams', []):
+                    self.handle_datagram(b64decode(str(datagram).encode('ascii')), address[0], repaired=True)
+        except Exception as e:
+            utils.print_error(f"Failed to repair channel #{channel.name}:", e)
+        finally:
+            state.missing.clear() # whatever is still missing is gone from the sender's history
+            state.repairing = False
+
+    def _decode_message(self, content: object, ip: str) -> Message|None:
+        if not isinstance(content, dict) or not isinstance(content.get('author'), str) or not isinstance(content.get('message'), str):
+            return None
+        author = content['author']
+        if Users.check_username(author):
+            user = Users.get_user_by_username(author)
+            if user.has_ip() and user.get_ip() != ip:
+                utils.print_warning(f"Dropped a channel message from {ip} claiming to be {author}.")
+                return None
+        attachments = [Attachment.from_dict(attachment) for attachment in content.get('attachments', []) if isinstance(attachment, dict)]
+        metadata = content.get('metadata')
+        return Message(author, content['message'], attachments, metadata if isinstance(metadata, dict) else {}, delivery.get_message_id(content), delivery.get_message_timestamp(content))
+
+class _ChannelProtocol(asyncio.DatagramProtocol):
+    def __init__(self, manager: ChannelManager):
+        self._manager = manager
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        metrics.increment('channels.datagrams.received')
+        try:
+            self._manager.handle_datagram(data, addr[0])
+        except Exception as e:
+            utils.print_error("Exception while handling a channel datagram:", e)
+
+    def error_received(self, exc: Exception):
+        utils.print_warning("Channel socket error:", exc)
+
+def _get_interface() -> str:
+    return utils.get_setting('network.multicast.interface', '0.0.0.0')
+
+def _get_membership(group: str) -> bytes:
+    return socket.inet_aton(group) + socket.inet_aton(_get_interface())
+
+def _create_multicast_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    # several instances on one host can be members of the same channels
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', MULTICAST_PORT))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    if _get_interface() != '0.0.0.0':
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(_get_interface()))
+    sock.setblocking(False)
+    return sock
+
+def _get_saved_channels() -> dict[str, str]:
+    try:
+        saved = json.loads(utils.get_setting('channels.joined', '{}'))
+    except ValueError:
+        return {}
+    return {name: secret for name, secret in saved.items() if isinstance(secret, str)} if isinstance(saved, dict) else {}
+
+def _save_channel(name: str, secret: str|None):
+    saved = _get_saved_channels()
+    if secret is None:
+        saved.pop(name, None)
+    else:
+        saved[name] = secret
+    utils.set_setting('channels.joined', json.dumps(saved))
+
+manager = ChannelManager()
@@ -0,0 +1,128 @@
+import os
+import time
+from base64 import b64decode, b64encode
+from functools import lru_cache
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, modes as CipherModes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+
+import utils
+from config import *
+
+# Ciphers used to encrypt messages and attachments with a shared key.
+# Peers offer the ciphers they support during the key exchange and the receiver picks the first one it also supports.
+# Cipher contexts are created once per shared key and reused for every message of the session.
+# 3DES-ECB is only kept for older clients, which don't negotiate a cipher.
+
+CIPHER_AES_GCM = 'aes-256-gcm'
+CIPHER_CHACHA20_POLY1305 = 'chacha20-poly1305'
+CIPHER_3DES = '3des-ecb'
+
+SUPPORTED_CIPHERS = [CIPHER_AES_GCM, CIPHER_CHACHA20_POLY1305, CIPHER_3DES] # in order of preference
+
+NONCE_SIZE = 12
+AEAD_OVERHEAD = NONCE_SIZE + 16 # the nonce and the authentication tag
+
+class SessionCipher():
+    name = ''
+
+    def encrypt(self, data: bytes|memoryview, associated_data: bytes|None = None) -> bytes:
+        raise NotImplementedError()
+    def decrypt(self, data: bytes|memoryview, associated_data: bytes|None = None) -> bytes:
+        raise NotImplementedError()
+
+    def encrypt_text(self, text: str) -> str:
+        return b64encode(self.encrypt(text.encode('utf-8'))).decode(encoding='ascii')
+    def decrypt_text(self, encrypted_text: str) -> str:
+        return utils.decode_arbitrary_data(self.decrypt(b64decode(encrypted_text.encode(encoding='ascii'))))
+
+class LegacyCipher(SessionCipher):
+    name = CIPHER_3DES
+
+    def __init__(self, shared_key: int):
+        self._key = shared_key
+        self._cipher = Cipher(TripleDES(key=utils.derive_cipher_key(shared_key)), CipherModes.ECB())
+
+    def encrypt(self, data: bytes|memoryview, associated_data: bytes|None = None) -> bytes:
+        encryptor = self._cipher.encryptor()
+        return encryptor.update(utils.pad_PKCS7(bytes(data))) + encryptor.finalize() # the padder returns a memoryview for one
+    def decrypt(self, data: bytes|memoryview, associated_data: bytes|None = None) -> bytes:
+        decryptor = self._cipher.decryptor()
+        return utils.unpad_PKCS7(decryptor.update(data) + decryptor.finalize())
+
+    def decrypt_text(self, encrypted_text: str) -> str:
+        # older clients may send text that is not base64 encoded or padded
+        return utils.decrypt_text(encrypted_text, self._key)
+
+class AEADCipher(SessionCipher):
+    """Encrypts with AES-256-GCM or ChaCha20-Poly1305 and a 32 byte key. Each ciphertext is prefixed with its random nonce."""
+    def __init__(self, name: str, key: bytes):
+        self.name = name
+        self._aead = AESGCM(key) if name == CIPHER_AES_GCM else ChaCha20Poly1305(key)
+
+    def encrypt(self, data: bytes|memoryview, associated_data: bytes|None = None) -> bytes:
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, data, associated_data)
+    def decrypt(self, data: bytes|memoryview, associated_data: bytes|None = None) -> bytes:
+        data = memoryview(data)
+        return self._aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], associated_data)
+
+def _derive_key(cipher_name: str, shared_key: int) -> bytes:
+    key_material = shared_key.to_bytes(max(1, (shared_key.bit_length() + 7) // 8), 'big')
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'mores-chat ' + cipher_name.encode()).derive(key_material)
+
+@lru_cache(maxsize=256)
+def get_cipher(cipher_name: str, shared_key: int) -> SessionCipher:
+    if cipher_name == CIPHER_3DES:
+        return LegacyCipher(shared_key)
+    if cipher_name in (CIPHER_AES_GCM, CIPHER_CHACHA20_POLY1305):
+        return AEADCipher(cipher_name, _derive_key(cipher_name, shared_key))
+    raise RuntimeError(f'Unsupported cipher: {cipher_name}')
+
+def wrap_key(key: bytes, cipher: SessionCipher) -> str:
+    return b64encode(cipher.encrypt(key)).decode(encoding='ascii')
+
+def unwrap_cipher(wrapped_key: str, cipher: SessionCipher, cipher_name: str = CIPHER_AES_GCM) -> SessionCipher:
+    """Decrypts a content key that was encrypted with `wrap_key`, and returns a cipher using it."""
+    return AEADCipher(cipher_name, cipher.decrypt(b64decode(wrapped_key.encode(encoding='ascii'))))
+
+def get_offered_ciphers() -> list[str]:
+    offered = utils.get_setting('security.encryption.ciphers', SUPPORTED_CIPHERS)
+    return [cipher_name for cipher_name in offered if cipher_name in SUPPORTED_CIPHERS]
+
+def negotiate_cipher(offered: object) -> str:
+    """Picks the cipher for a key exchange request. Peers that don't offer any cipher only support 3DES."""
+    if isinstance(offered, list):
+        for cipher_name in get_offered_ciphers():
+            if cipher_name in offered:
+                return cipher_name
+    return CIPHER_3DES
+
+def get_negotiated_cipher(reply: dict) -> str:
+    cipher_name = reply.get('cipher', CIPHER_3DES)
+    if cipher_name not in SUPPORTED_CIPHERS:
+        raise RuntimeError(f'Peer picked an unsupported cipher: {cipher_name}')
+    return cipher_name
+
+def benchmark(size: int = 1024 * 1024 * 16, chunk_size: int = ATTACHMENT_CHUNK_SIZE) -> dict[str, float]:
+    """Returns the encryption and decryption throughput of each cipher in MB/s."""
+    data = os.urandom(chunk_size)
+    shared_key = int.from_bytes(os.urandom(32), 'big')
+    rounds = max(1, size // chunk_size)
+    result = {}
+    for cipher_name in SUPPORTED_CIPHERS:
+        cipher = get_cipher(cipher_name, shared_key)
+        start = time.perf_counter()
+        encrypted_chunks = [cipher.encrypt(data) for _ in range(rounds)]
+        encryption_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for encrypted_chunk in encrypted_chunks:
+            cipher.decrypt(encrypted_chunk)
+        decryption_time = time.perf_counter() - start
+        megabytes = rounds * chunk_size / 1000000
+        result[f'{cipher_name} encrypt'] = megabytes / encryption_time
+        result[f'{cipher_name} decrypt'] = megabytes / decryption_time
+    return result
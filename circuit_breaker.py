@@ -0,0 +1,76 @@
+import time
+
+import metrics
+import utils
+from config import *
+
+# Per-peer circuit breakers, so a peer that stopped answering (a laptop with its lid closed) doesn't stall every message to it.
+# After CIRCUIT_FAILURE_THRESHOLD failed sends in a row the circuit opens and sends fail immediately.
+# Once the open time is over, one send is let through as a probe (half-open): if it succeeds the circuit closes,
+# otherwise it opens again for twice as long.
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+class CircuitBreaker():
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.last_error = ''
+        self._opened_at = 0.0
+        self._open_time = CIRCUIT_OPEN_TIME
+
+    def get_retry_time(self) -> float:
+        """Returns the seconds left until the next probe is allowed."""
+        if self.state != STATE_OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self._open_time - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN and self.get_retry_time() == 0:
+            self.state = STATE_HALF_OPEN # this send is the probe
+            return True
+        metrics.increment('circuit.fast_failures')
+        return False
+
+    def record_success(self):
+        if self.state != STATE_CLOSED:
+            utils.print_info(f"Circuit to {self.ip} closed.")
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self._open_time = CIRCUIT_OPEN_TIME
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        self.last_error = error
+        if self.state == STATE_HALF_OPEN:
+            self._open_time = min(self._open_time * 2, MAX_CIRCUIT_OPEN_TIME)
+            self._open()
+        elif self.state == STATE_CLOSED and self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self._open()
+
+    def describe(self) -> str:
+        return f"{self.ip} is unreachable ({self.last_error}), next attempt in {self.get_retry_time():.0f} seconds"
+
+    def _open(self):
+        self.state = STATE_OPEN
+        self._opened_at = time.monotonic()
+        metrics.increment('circuit.opened')
+        utils.print_warning(f"Circuit to {self.ip} opened for {self._open_time:.0f} seconds: {self.last_error}")
+
+class CircuitBreakers():
+    def __init__(self):
+        self._breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, ip: str) -> CircuitBreaker:
+        breaker = self._breakers.get(ip)
+        if breaker is None:
+            breaker = CircuitBreaker(ip)
+            self._breakers[ip] = breaker
+        return breaker
+
+breakers = CircuitBreakers()
@@ -1,8 +1,18 @@
+import sys
+
+import admission
+import channels
+import ciphers
 import config
+import key_exchange
 import message_server
+import metrics
+import outbox
+import session_keys
 import utils
 import scripting
 import themes
+import user
 import config
 from command import Command
 from message import Message
@@ -34,11 +44,14 @@ def change_name(new_username: str) -> str:
     else:
         utils.set_setting('username', new_username)
     utils.change_username(new_username)
+    push_event('on_username_changed', new_username)
     return f'Your username has been successfully changed to {new_username}'
 
 def exit(*args: *tuple[str]):
-    import app
-    app.exit_app()
+    if 'app' in sys.modules: # the window closes itself, then stops the message server
+        sys.modules['app'].exit_app()
+    else:
+        message_server.exit()
     return "Goodbye!"
 
 def command_help(*args: *tuple[str]) -> str:
@@ -74,6 +87,7 @@ def encryption_command(*args: *tuple[str]) -> str:
             utils.set_setting('security.encryption.enabled', True)
             utils.set_setting('security.encryption.parameter.g', config.DEFAULT_DH_G)
             utils.set_setting('security.encryption.parameter.p', config.DEFAULT_DH_P)
+            utils.set_setting('security.encryption.group', '')
             result += "-1"
         if '-2' == argument:
             utils.set_setting('security.encryption.enabled', True)
@@ -88,9 +102,43 @@ def encryption_command(*args: *tuple[str]) -> str:
             value = int(args[i+1])
             if value < config.DH_G:
                 raise RuntimeError("Value of `g` must be greater than `g`, and must be a prime number.")
-            # TODO: Add prime check
+            if value.bit_length() > config.MAX_DH_P_BITS:
+                raise RuntimeError(f"Value of `p` must be at most {config.MAX_DH_P_BITS} bits long.")
+            if not key_exchange.is_probable_prime(value):
+                raise RuntimeError("Value of `p` must be a prime number.")
             utils.set_setting('security.encryption.parameter.p', value)
             result += "-p=" + str(value)
+        if '--group' == argument:
+            value = args[i+1]
+            if value == 'custom':
+                value = ''
+            elif value not in key_exchange.NAMED_GROUPS:
+                raise RuntimeError(f"Unknown group: {value}. Available groups: {', '.join(key_exchange.NAMED_GROUPS)}, custom")
+            utils.set_setting('security.encryption.enabled', True)
+            utils.set_setting('security.encryption.group', value)
+            result += "--group=" + (value or 'custom') + " "
+        if '--ciphers' == argument:
+            value = args[i+1].split(',')
+            for cipher_name in value:
+                if cipher_name not in ciphers.SUPPORTED_CIPHERS:
+                    raise RuntimeError(f"Unknown cipher: {cipher_name}. Available ciphers: {', '.join(ciphers.SUPPORTED_CIPHERS)}")
+            utils.set_setting('security.encryption.ciphers', value)
+            result += "--ciphers=" + ",".join(value) + " "
+        if '--rekey-interval' == argument:
+            value = int(args[i+1])
+            if value < 1:
+                raise RuntimeError("Rekey interval must be at least 1 second.")
+            utils.set_setting('security.encryption.rekey.interval', value)
+            result += "--rekey-interval=" + str(value) + " "
+        if '--rekey-messages' == argument:
+            value = int(args[i+1])
+            if value < 1:
+                raise RuntimeError("Rekey message count must be at least 1.")
+            utils.set_setting('security.encryption.rekey.messages', value)
+            result += "--rekey-messages=" + str(value) + " "
+        if '--rekey' == argument:
+            session_keys.store.forget()
+            result += "--rekey "
     return result
 
 # TODO: Add option to restore most recent n messages
@@ -125,6 +173,83 @@ def execute_script(*args: *tuple[str]) -> str:
     except Exception as e:
         return str(e)
 
+def _get_queue_depths() -> dict[str, dict[str, int]]:
+    queue_depths = message_server.peer_senders.get_queue_depths()
+    for username, depth in outbox.store.get_depths().items():
+        queue_depths.setdefault(username, {})['outbox'] = depth
+    return queue_depths
+
+def show_queues(*args: *tuple[str]) -> str:
+    queue_depths = message_server.call_in_loop(_get_queue_depths) # the queues belong to the asyncio loop
+    if len(queue_depths) == 0:
+        return "No messages are waiting to be sent."
+    result = "Messages waiting to be sent:"
+    for username, lanes in sorted(queue_depths.items()):
+        result += f"\n  {username}: " + ", ".join(f"{lane} {depth}" for lane, depth in lanes.items())
+    return result
+
+def show_stats(*args: *tuple[str]) -> str:
+    stats = metrics.get_all()
+    if len(stats) == 0:
+        return "No statistics have been collected yet."
+    result = "Network statistics:"
+    for name, value in sorted(stats.items()):
+        result += f"\n  {name}: {format(value, '.3f').rstrip('0').rstrip('.')}"
+    return result
+
+def show_blocklist(*args: *tuple[str]) -> str:
+    blocked = message_server.call_in_loop(admission.controller.get_blocked_addresses)
+    if len(blocked) == 0:
+        return "No addresses are blocked."
+    result = "Blocked addresses:"
+    for ip, seconds_left in sorted(blocked.items()):
+        result += f"\n  {ip}: " + ("banned" if seconds_left == float('inf') else f"{seconds_left:.0f} seconds left")
+    return result
+
+def run_benchmark(*args: *tuple[str]) -> str:
+    if len(args) > 0 and args[0] == 'users':
+        user_count = int(args[1]) if len(args) > 1 else 10000
+        if user_count < 1:
+            raise RuntimeError("User count must be at least 1.")
+        result = f"User lookups ({user_count} users):"
+        for name, duration in user.benchmark(user_count).items():
+            result += f"\n  {name}: {duration:.2f} µs"
+        return result
+    if len(args) == 0 or args[0] != 'ciphers':
+        return "Usage: /benchmark ciphers [size in MB] | /benchmark users [user count]"
+    size = int(args[1]) if len(args) > 1 else 16
+    if size < 1:
+        raise RuntimeError("Size must be at least 1 MB.")
+    result = f"Cipher throughput ({size} MB):"
+    for name, throughput in ciphers.benchmark(size * 1000000).items():
+        result += f"\n  {name}: {throughput:.1f} MB/s"
+    return result
+
+def channel_command(*args: *tuple[str]) -> str:
+    usage = "Usage: /channel join <name> [secret] | /channel leave <name> | /channel list | /channel send <name> <message>"
+    if len(args) == 0:
+        return usage
+    if args[0] == 'join' and len(args) in (2, 3):
+        name = args[1].lstrip('#')
+        message_server.call_in_loop(channels.manager.join, name, args[2] if len(args) == 3 else '')
+        return f"Joined #{name}. Members need the same secret to read its messages."
+    if args[0] == 'leave' and len(args) == 2:
+        name = args[1].lstrip('#')
+        message_server.call_in_loop(channels.manager.leave, name)
+        return f"Left #{name}."
+    if args[0] == 'list':
+        names = message_server.call_in_loop(channels.manager.get_channel_names)
+        if len(names) == 0:
+            return "You haven't joined any channels."
+        return "Channels: " + ", ".join(f"#{name}" for name in names)
+    if args[0] == 'send' and len(args) >= 3:
+        name = args[1].lstrip('#')
+        if not message_server.call_in_loop(channels.manager.get_channel, name):
+            return f"You haven't joined #{name}."
+        message_server.outbound_message_queue.put(MessagePacket(Message('<localhost>', ' '.join(args[2:]), metadata={'channel': name}), ['<localhost>', '#' + name]))
+        return ''
+    return usage
+
 def create_pseudo_command(aliases: list[str], help: str, event: str):
     assert(isinstance(aliases, list))
     assert(isinstance(help, str))
@@ -146,8 +271,13 @@ commands += [
     Command(execute_script, ['/exec'], "/exec <script_name> [arguments]... : Executes the script in the 'user_scripts' folder with the given arguments."),
     Command(change_theme, ['/theme', '/t'], "/theme <theme_name> : Changes the application theme to the specified theme. Themes available are dark, light, pink, purple, red, green, blue. Aliases: /t"),
     Command(exit, ['/exit', '/bye', '/goodbye'], "/exit : Closes the app. Aliases: /bye, /goodbye"),
-    Command(encryption_command, ['/encryption', '/bye', '/goodbye'], "/encryption <parameter1> [parameter2]... : Sets encryption paramaters.\n Parameters: \n\t -0 \t\t no encryption \n\t -1 \t\t default, diffie-hellman with preset g and p \n\t -2 \t\t diffie-hellman with custom g and p \n\t -g <N> \t\t sets DH_G to N \n\t -p <N> \t\t sets DH_P to N \n\t --fallback \t\t enabled by default, allows the connection to fallback to unencrypted plaintext \n\t --no-fallback \t\t opposite of --fallback"),
-    Command(restore_history, ['/restorehistory', '/rh'], "/restorehistory : Restores the entire message history from the 'message_history.log' file. Aliases: /rh")
+    Command(encryption_command, ['/encryption', '/bye', '/goodbye'], "/encryption <parameter1> [parameter2]... : Sets encryption paramaters.\n Parameters: \n\t -0 \t\t no encryption \n\t -1 \t\t default, diffie-hellman with preset g and p \n\t -2 \t\t diffie-hellman with custom g and p \n\t -g <N> \t\t sets DH_G to N \n\t -p <N> \t\t sets DH_P to N, must be a prime \n\t --group <NAME> \t key exchange group: modp2048, modp3072, modp4096, x25519 or custom (uses g and p) \n\t --ciphers <A,B> \t ciphers offered to peers, in order of preference (default aes-256-gcm,chacha20-poly1305,3des-ecb) \n\t --fallback \t\t enabled by default, allows the connection to fallback to unencrypted plaintext \n\t --no-fallback \t\t opposite of --fallback \n\t --rekey-interval <N> \t renegotiates session keys after N seconds (default 600) \n\t --rekey-messages <N> \t renegotiates session keys after N messages (default 1000) \n\t --rekey \t\t forgets all session keys now"),
+    Command(restore_history, ['/restorehistory', '/rh'], "/restorehistory : Restores the entire message history from the 'message_history.log' file. Aliases: /rh"),
+    Command(show_queues, ['/queues', '/q'], "/queues : Shows how many messages are waiting to be sent to each user, per lane (chat, bulk) and in the outbox for offline users. Aliases: /q"),
+    Command(show_blocklist, ['/blocklist'], "/blocklist : Shows the addresses that are blocked from connecting, because they were banned or misbehaved."),
+    Command(show_stats, ['/stats'], "/stats : Shows network statistics, such as the number of discovery datagrams sent, received and dropped."),
+    Command(run_benchmark, ['/benchmark'], "/benchmark ciphers [size in MB] | /benchmark users [user count] : Measures the speed of each supported cipher, or of user lookups with the given number of users."),
+    Command(channel_command, ['/channel', '/ch'], "/channel join <name> [secret] | /channel leave <name> | /channel list | /channel send <name> <message> : Manages multicast channels, which reach every member on the local network with a single datagram. Aliases: /ch")
 ]
 
 def run_command(text: str, echo: bool = True) -> bool:
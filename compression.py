@@ -0,0 +1,121 @@
+import json
+import lzma
+import os
+import time
+import zlib
+from base64 import b64decode, b64encode
+from typing import TYPE_CHECKING
+
+import metrics
+import unicode_utils
+import utils
+from attachment import Attachment
+from config import *
+from message import Message
+
+if TYPE_CHECKING:
+    import ciphers
+
+# Compression of message contents and attachment chunks, applied before encryption (ciphertext doesn't compress).
+# Peers announce the algorithms they can decompress as features in their hello frame,
+# and the sender uses the configured algorithm if the peer supports it.
+# Small payloads and files that are already compressed (by extension) are sent as they are,
+# as well as payloads that didn't get noticeably smaller.
+
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_LZMA = 'lzma'
+
+SUPPORTED_COMPRESSION = [COMPRESSION_ZLIB, COMPRESSION_LZMA]
+
+_features = {
+    COMPRESSION_ZLIB: FEATURE_COMPRESSION_ZLIB,
+    COMPRESSION_LZMA: FEATURE_COMPRESSION_LZMA
+}
+
+def get_algorithm(peer_features: set[str]) -> str|None:
+    """Returns the algorithm to use for a peer, or None if its payloads are not compressed."""
+    if not utils.get_setting('network.compression.enabled', True):
+        return None
+    algorithm = utils.get_setting('network.compression.algorithm', COMPRESSION_ZLIB)
+    if algorithm not in SUPPORTED_COMPRESSION or _features[algorithm] not in peer_features:
+        return None
+    return algorithm
+
+def is_compressible(attachment: Attachment) -> bool:
+    return os.path.splitext(attachment.get_sanitized_filename())[1].lower() not in COMPRESSED_FILE_EXTENSIONS
+
+def compress(data: bytes|memoryview, algorithm: str) -> bytes|None:
+    """Returns the compressed data, or None if it's too small or didn't compress well enough to be worth it."""
+    if len(data) < COMPRESSION_THRESHOLD:
+        return None
+    start = time.thread_time()
+    if algorithm == COMPRESSION_ZLIB:
+        compressed = zlib.compress(data, ZLIB_COMPRESSION_LEVEL)
+    elif algorithm == COMPRESSION_LZMA:
+        compressed = lzma.compress(data, preset=LZMA_COMPRESSION_PRESET)
+    else:
+        raise RuntimeError(f'Unsupported compression: {algorithm}')
+    metrics.increment('compression.cpu_seconds', time.thread_time() - start)
+    metrics.increment('compression.bytes.in', len(data))
+    if len(compressed) > len(data) * MAX_COMPRESSION_RATIO:
+        metrics.increment('compression.bytes.out', len(data))
+        metrics.increment('compression.skipped')
+        _update_ratio()
+        return None
+    metrics.increment('compression.bytes.out', len(compressed))
+    _update_ratio()
+    return compressed
+
+def decompress(data: bytes|memoryview, algorithm: str, max_size: int = MAX_FRAME_SIZE) -> bytes:
+    """Raises an error if the data would decompress to more than `max_size` bytes, so a small payload can't fill the memory."""
+    start = time.thread_time()
+    if algorithm == COMPRESSION_ZLIB:
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise RuntimeError('Compressed payload is too large or truncated')
+    elif algorithm == COMPRESSION_LZMA:
+        decompressor = lzma.LZMADecompressor()
+        result = decompressor.decompress(data, max_size)
+        if not decompressor.eof:
+            raise RuntimeError('Compressed payload is too large or truncated')
+    else:
+        raise RuntimeError(f'Unsupported compression: {algorithm}')
+    metrics.increment('decompression.cpu_seconds', time.thread_time() - start)
+    return result
+
+def generate_compressed_payload(message: Message, cipher: 'ciphers.SessionCipher', attachments: list[Attachment], algorithm: str) -> dict|None:
+    """Like `utils.generate_encrypted_payload`, but the text and the compressible attachments are compressed together.
+
+    Returns None if compressing them isn't worth it.
+    """
+    compressible = [attachment for attachment in attachments if is_compressible(attachment)]
+    content: dict = {'message': unicode_utils.with_surrogates(message.get_text_content())}
+    if compressible:
+        content['attachments'] = [attachment.to_dict() for attachment in compressible]
+    compressed = compress(json.dumps(content).encode('utf-8'), algorithm)
+    if compressed is None:
+        return None
+    author = message.get_author_username()
+    if author == '<localhost>':
+        author = utils.get_current_username()
+    payload = {'author': author, 'id': message.get_id(), 'time': message.get_timestamp(), 'compression': algorithm, 'compressed_content': b64encode(cipher.encrypt(compressed)).decode('ascii')}
+    others = [attachment for attachment in attachments if not is_compressible(attachment)]
+    if others:
+        payload['encrypted_attachments'] = [cipher.encrypt_text(str(attachment)) for attachment in others]
+    if message.has_metadata():
+        payload['metadata'] = message.get_metadata()
+    return payload
+
+def decompress_content(decoded_object: dict, cipher: 'ciphers.SessionCipher') -> dict:
+    """Decrypts and decompresses the content of a payload made by `generate_compressed_payload`."""
+    compressed = cipher.decrypt(b64decode(str(decoded_object['compressed_content']).encode('ascii')))
+    content = json.loads(decompress(compressed, str(decoded_object['compression'])))
+    if not isinstance(content, dict):
+        raise RuntimeError('Invalid compressed content')
+    return content
+
+def _update_ratio():
+    bytes_in = metrics.get_counter('compression.bytes.in')
+    if bytes_in:
+        metrics.set_gauge('compression.ratio', metrics.get_counter('compression.bytes.out') / bytes_in)
@@ -2,9 +2,14 @@ import argparse
 
 from constants import *
 
-parser = argparse.ArgumentParser()
+# the options shared by every entry point, which add their own options and the help on top of these
+parser = argparse.ArgumentParser(add_help=False)
 parser.add_argument('-d', '--debug-level', help='set debug level [0, 2]', default=1, type=int, choices=[0, 1, 2])
-args = parser.parse_args()
+parser.add_argument('--address', help='listen on and send from this local address instead of all of them', default='')
+parser.add_argument('--discovery-port', help='port for presence announcements (default 6000)', default=6000, type=int)
+parser.add_argument('--messaging-port', help='port for messages (default 6001)', default=6001, type=int)
+parser.add_argument('--peers', help='comma separated addresses that presence is also announced to directly, for networks without broadcasts', default='')
+args, _ = parser.parse_known_args()
 
 ICON_PATH = "./placeholder_app_icon_2_16x16.png"
 
@@ -22,17 +27,122 @@ RESERVED_USERNAMES = ["", ":", "<>", "system", "<system>", "<s>", "localhost", "
 BANNED_CHARS_FOR_USERNAMES = '\r\\:'
 
 SERVICE_BROADCAST_IP = '255.255.255.255'
-SERVICE_BROADCAST_PORT = 6000
-SERVICE_BROADCAST_INTERVAL = 8.0 # in seconds
-DISCOVERY_PORT = 6000
-MESSAGING_PORT = 6001
+SERVICE_BROADCAST_PORT = args.discovery_port
+SERVICE_BROADCAST_INTERVAL = 8.0 # in seconds, the shortest interval between presence announcements
+MAX_BROADCAST_INTERVAL = 60.0 # in seconds, the longest interval between presence announcements
+TARGET_BROADCAST_RATE = 20.0 # presence datagrams per second across the whole LAN, announcements back off to stay around it
+BROADCAST_JITTER = 0.25 # announcement intervals vary randomly by this fraction
+LEGACY_DISCOVERY_TIMEOUT = 300.0 # in seconds, JSON announcements for older clients are sent while one was seen within this
+LEGACY_BROADCAST_INTERVAL = 8.0 # in seconds, fixed and without jitter, older clients consider users offline after 10 seconds
+MAX_BROADCAST_SIZE = 256 # in bytes, larger broadcasts are dropped
+PRESENCE_TIMEOUT = 10.0 # in seconds, users are offline if they haven't been seen for this long
+PRESENCE_TIMEOUT_FACTOR = 2.0 # users that announce their interval are offline after missing this many intervals
+USER_EVICTION_TIMEOUT = 600.0 # in seconds, users that have been offline for this long are forgotten
+MAX_TOMBSTONES = 4096 # forgotten users whose last IP and last seen time are remembered
+DISCOVERY_PORT = args.discovery_port
+MESSAGING_PORT = args.messaging_port
+BIND_ADDRESS = args.address # '' for every address
+STATIC_PEERS = [address for address in args.peers.split(',') if address]
 
 MAX_PACKET_SIZE = 1024 * 64
 
+# Deadlines and circuit breakers for outgoing connections
+CONNECT_TIMEOUT = 3.0 # in seconds
+HANDSHAKE_TIMEOUT = 5.0 # in seconds, for the hello and key exchange replies
+HELLO_TIMEOUT = 6.0 # in seconds, longer than older versions wait for a complete packet before closing the connection
+WRITE_TIMEOUT = 10.0 # in seconds, for the peer to accept what was written
+CIRCUIT_FAILURE_THRESHOLD = 3 # failed sends in a row before sends to the peer fail immediately
+CIRCUIT_OPEN_TIME = 10.0 # in seconds, until a probe is sent, doubled after each failed probe
+MAX_CIRCUIT_OPEN_TIME = 120.0 # in seconds
+
+# Persistent connections
+CONNECTION_IDLE_TIMEOUT = 60.0 # in seconds, idle pooled connections are closed after this
+CONNECTION_HEALTH_CHECK_INTERVAL = 15.0 # in seconds, idle pooled connections are pinged after this
+CONNECTION_RESPONSE_TIMEOUT = 10.0 # in seconds
+LEGACY_PEER_RECHECK_INTERVAL = 60.0 # in seconds, peers without persistent connection support are probed again in the background after this
+MAX_FRAME_SIZE = 1024 * 1024 * 16 # larger message frames are rejected, large attachments are streamed in chunks instead
+# other frames are rejected if they are larger than MAX_PACKET_SIZE
+MAX_LEGACY_PACKET_SIZE = 1024 * 1024 * 256 # legacy peers send attachments inline, the packet is only buffered as it arrives
+
+# Compression
+COMPRESSION_THRESHOLD = 512 # in bytes, smaller payloads are not compressed
+MAX_COMPRESSION_RATIO = 0.9 # payloads that don't get smaller than this fraction of their size are sent uncompressed
+ZLIB_COMPRESSION_LEVEL = 6
+LZMA_COMPRESSION_PRESET = 1
+COMPRESSED_FILE_EXTENSIONS = ['.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.wmv', '.webm', '.ogg', '.flac', '.pdf', '.docx', '.xlsx', '.pptx', '.jar', '.apk']
+
+# Multicast channels
+MULTICAST_PORT = 6002
+MULTICAST_GROUP_PREFIX = '239.255' # administratively scoped, channel groups are derived from their names
+MULTICAST_TTL = 1 # datagrams stay on the local network
+MAX_MULTICAST_PAYLOAD = 1024 * 60 # in bytes, larger channel messages are rejected
+MULTICAST_HISTORY_SIZE = 256 # sent datagrams kept per channel for repairs
+MULTICAST_MAX_REPAIR_BATCH = 64 # datagrams requested at once, larger gaps are not repaired
+MULTICAST_REPAIR_DELAY = 0.2 # in seconds, missing datagrams are requested after this
+MULTICAST_REPAIR_ATTEMPTS = 3
+MULTICAST_HEARTBEAT_INTERVAL = 5.0 # in seconds, between heartbeats that let members notice a lost last message
+MULTICAST_HEARTBEAT_TIMEOUT = 60.0 # in seconds, heartbeats are sent for this long after the last message
+MULTICAST_MAX_SEQUENCE_JUMP = 4096 # datagrams that skip more sequence numbers of a sender that was heard from recently are dropped
+
+# Admission control on the messaging port
+MAX_CONCURRENT_HANDLERS = 128 # open inbound connections from all addresses
+MAX_CONNECTIONS_PER_IP = 8 # open inbound connections from one address
+CONNECTIONS_PER_SECOND_PER_IP = 5.0 # new connections, on average
+CONNECTION_BURST_PER_IP = 20
+BYTES_PER_SECOND_PER_IP = 1024 * 1024 * 64 # received bytes, senders are slowed down above this
+BYTE_BURST_PER_IP = 1024 * 1024 * 16
+BLOCK_PENALTY_THRESHOLD = 10.0 # addresses are blocked when they collect this many penalty points
+PENALTY_HALF_LIFE = 60.0 # in seconds, penalty points halve this often
+BLOCK_DURATION = 60.0 # in seconds, doubled each time the same address is blocked again
+MAX_BLOCK_DURATION = 3600.0 # in seconds
+MAX_TRACKED_ADDRESSES = 4096 # idle addresses are forgotten when more are tracked
+
+# Attachments
+STREAMING_ATTACHMENT_THRESHOLD = 1024 * 64 # in bytes, larger attachments are streamed in chunks over persistent connections
+ATTACHMENT_CHUNK_SIZE = 1024 * 60 # in bytes, small enough for a chunk frame to fit in MAX_PACKET_SIZE
+ATTACHMENT_TRANSFER_ATTEMPTS = 3
+MAX_ATTACHMENT_SIZE = 1024 * 1024 * 1024 * 4 # in bytes, larger streamed attachments are refused
+MAX_TRANSFERS_PER_IP = 8 # unfinished incoming transfers from one address
+TRANSFER_IDLE_TIMEOUT = 300.0 # in seconds, unfinished transfers without new chunks and received files without their message are deleted after this
+
+# Outbound queues
+PEER_QUEUE_SIZE = 256 # per user and lane, messages are dropped when the queue is full
+PEER_SENDER_IDLE_TIMEOUT = 60.0 # in seconds, idle per-user send workers are stopped after this
+COALESCE_DELAY = 0.002 # in seconds, how long a burst of chat messages to one user is waited for to send it in one frame
+COALESCE_MAX_MESSAGES = 64 # per frame
+COALESCE_MAX_BYTES = 1024 * 64 # of text per frame
+
+# Delivery acknowledgements
+ACK_TIMEOUT = 5.0 # in seconds, unacknowledged messages are sent again after this, twice as long after each attempt
+MAX_DELIVERY_ATTEMPTS = 4
+MAX_UNACKED_MESSAGES = 4096 # messages sent after this many are waiting for acknowledgements are not retried
+RECEIVED_ID_CACHE_SIZE = 16384 # ids of the last received messages, to drop duplicates
+MAX_MESSAGE_ID_LENGTH = 64
+
+# Outbox for users that are offline or unreachable
+OUTBOX_PATH = './data/outbox.log'
+OUTBOX_MAX_BYTES = 1024 * 1024 * 64 # messages are refused when the stored messages take this much space
+OUTBOX_MAX_MESSAGES_PER_USER = 1000
+OUTBOX_EXPIRY = 3 * 24 * 3600.0 # in seconds, stored messages are dropped when they are this old
+OUTBOX_RETRY_INTERVAL = 30.0 # in seconds, stored messages to online users that couldn't be reached are sent again after this
+OUTBOX_BATCH_SIZE = 32 # messages sent before their delivery is written to the outbox file
+OUTBOX_COMPACTION_SIZE = 1024 * 1024 # in bytes, the outbox file is rewritten when at least this much of it is delivered messages
+
 # Diffie Hellman and enryption parameters
 DH_G = DEFAULT_DH_G
 DH_P = DEFAULT_DH_P
 FALLBACK_TO_PLAINTEXT = True
+DEFAULT_REKEY_INTERVAL = 600 # in seconds, session keys are renegotiated after this
+DEFAULT_REKEY_MESSAGE_COUNT = 1000 # session keys are renegotiated after this many messages
+MAX_INCOMING_SESSIONS_PER_USER = 16
+MAX_DH_P_BITS = 8192 # larger custom primes are rejected
+DH_PRIVATE_KEY_BITS = 512 # size of private exponents for large groups
+KEYPAIR_POOL_SIZE = 4 # precomputed keypairs kept per group
+CUSTOM_GROUP_KEYPAIRS_PER_SECOND = 0.2 # keypairs for large custom groups sent by peers, which aren't pooled
+CUSTOM_GROUP_KEYPAIR_BURST = 4
+KEY_EXCHANGE_WORKERS = 2 # threads used for key generation and exchange
+RECEIVE_WORKERS = 2 # threads used for parsing and decrypting large received messages
+RECEIVE_OFFLOAD_SIZE = 1024 * 32 # in bytes, smaller messages are handled on the event loop, a thread would only add latency
 
 # can fallback to unsecure mode if FALLBACK_TO_PLAINTEXT is set
 
@@ -0,0 +1,293 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+import ciphers
+import delivery
+import key_exchange
+import metrics
+import utils
+from config import *
+from framing import *
+from key_exchange import KeyExchangeGroup
+
+# Long-lived connections between peers.
+# Every object on a persistent connection is a JSON payload inside a frame (see framing.py).
+# Requests carry a request id ("rid") and the replies echo it back, so multiple requests can share one connection.
+
+class PeerConnection():
+    def __init__(self, ip: str, port: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, inbound: bool = False, prefix: bytes = b'', channel: str = 'chat', charge: Callable[[int], Awaitable[None]]|None = None):
+        self.ip = ip
+        self.port = port
+        self.channel = channel
+        self.shared_key = 0
+        self.cipher_name = ciphers.CIPHER_3DES
+        self.peer_instance: str|None = None # changes when the peer restarts
+        self.rejected_sessions: set[str] = set()
+        self.features: set[str] = set() # optional protocol features the peer supports
+        self.lock = asyncio.Lock() # held while a key exchange and the message using that key are sent
+        self._reader = reader
+        # peers send messages, the replies to our requests are small except for channel repairs
+        large_frame_types = frozenset([FRAME_MESSAGE, FRAME_MESSAGE_BATCH]) if inbound else frozenset([FRAME_CHANNEL_REPAIR])
+        self._frame_reader = FrameReader(reader, prefix, large_frame_types, charge)
+        self._writer = writer
+        self._inbound = inbound
+        self._write_lock = asyncio.Lock()
+        self._pending: dict[int, asyncio.Future[dict]] = {}
+        self._next_request_id = 1
+        self._last_used = time.monotonic()
+        self._closed = False
+        self._reader_task: asyncio.Task|None = None
+
+    def start(self):
+        # only outbound connections read replies in the background, inbound ones are read by the server
+        if not self._inbound:
+            self._reader_task = asyncio.create_task(self._read_replies())
+
+    def is_inbound(self) -> bool:
+        return self._inbound
+    def is_alive(self) -> bool:
+        return not (self._closed or self._writer.is_closing() or self._reader.at_eof())
+    def get_idle_time(self) -> float:
+        return time.monotonic() - self._last_used
+
+    async def send(self, frame_type: int, obj: dict|None = None, touch: bool = True):
+        await self.send_raw(frame_type, encode_json_payload(obj), touch=touch)
+
+    async def send_raw(self, frame_type: int, *payload: bytes|bytearray|memoryview, touch: bool = True, flags: int = 0):
+        if not self.is_alive():
+            raise ConnectionError(f'Connection to {self.ip} is closed')
+        if touch:
+            self._last_used = time.monotonic()
+        async with self._write_lock:
+            write_frame(self._writer, frame_type, *payload, flags=flags)
+            try:
+                await utils.drain(self._writer)
+            except utils.PeerUnreachableError:
+                await self.close() # the rest of the frame may still be buffered, the stream can't be used anymore
+                raise
+
+    async def request(self, frame_type: int, obj: dict, timeout: float = CONNECTION_RESPONSE_TIMEOUT, touch: bool = True) -> dict:
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        future: asyncio.Future[dict] = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await self.send(frame_type, {**obj, 'rid': request_id}, touch=touch)
+            return await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def receive(self, timeout: float|None = None) -> tuple[int, dict]|None:
+        frame = await self.receive_frame(timeout=timeout)
+        if frame is None:
+            return None
+        frame_type, _, payload = frame
+        return frame_type, decode_json_payload(payload)
+
+    async def receive_frame(self, timeout: float|None = None) -> tuple[int, int, memoryview]|None:
+        # NOTE: the payload is only valid until the next frame is read
+        return await asyncio.wait_for(self._frame_reader.read_frame(), timeout=timeout)
+
+    async def ping(self) -> bool:
+        try:
+            await self.request(FRAME_PING, {}, touch=False)
+            return True
+        except Exception:
+            return False
+
+    async def exchange_keys(self, group: KeyExchangeGroup, session_id: str|None = None) -> int:
+        start = time.monotonic()
+        keypair = await key_exchange.pool.get(group)
+        request = {"key": keypair.public_key, **group.to_dict(), "ciphers": ciphers.get_offered_ciphers()}
+        if session_id:
+            request["session"] = session_id
+        reply = await self.request(FRAME_KEY_EXCHANGE, request, timeout=HANDSHAKE_TIMEOUT)
+        peer_group = key_exchange.get_group_from_dict(reply, default_g=group.g or DEFAULT_DH_G, default_p=group.p or DEFAULT_DH_P)
+        if peer_group.get_id() != group.get_id():
+            raise RuntimeError(f'Peer did not agree on the key exchange group ({group.name})')
+        self.cipher_name = ciphers.get_negotiated_cipher(reply)
+        self.shared_key = await key_exchange.compute_shared_key(keypair, str(reply["key"]))
+        metrics.increment('pool.key_exchanges')
+        metrics.increment('pool.key_exchange_seconds', time.monotonic() - start)
+        return self.shared_key
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f'Connection to {self.ip} was closed'))
+        self._pending.clear()
+        if self._reader_task and self._reader_task is not asyncio.current_task():
+            self._reader_task.cancel()
+        try:
+            if not self._writer.is_closing():
+                write_frame(self._writer, FRAME_BYE)
+        except Exception:
+            pass
+        await utils.close_stream(self._writer)
+
+    async def _read_replies(self):
+        try:
+            while True:
+                frame = await self.receive()
+                if frame is None:
+                    break
+                frame_type, reply = frame
+                if frame_type == FRAME_REKEY:
+                    self.rejected_sessions.add(str(reply.get('session')))
+                    continue
+                if frame_type == FRAME_ACK:
+                    delivery.tracker.acknowledge(self.ip, reply.get('ids'))
+                    continue
+                future = self._pending.get(reply.get('rid', -1))
+                if future and not future.done():
+                    if frame_type == FRAME_ERROR:
+                        future.set_exception(RuntimeError(f"Peer error: {reply.get('error')}"))
+                    else:
+                        future.set_result(reply)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            utils.print_error(f"Exception while reading from {self.ip}:", e)
+        finally:
+            await self.close()
+
+class ConnectionPool():
+    def __init__(self):
+        self._connections: dict[tuple[str, int, str], PeerConnection] = {} # keyed by (ip, port, channel)
+        self._inbound: set[PeerConnection] = set()
+        self._connect_locks: dict[tuple[str, int, str], asyncio.Lock] = {}
+        self._legacy_peers: dict[str, float] = {} # ip -> when it was last found to only speak the legacy protocol
+        self._probes: dict[str, asyncio.Task] = {}
+
+    def is_legacy_peer(self, ip: str) -> bool:
+        return ip in self._legacy_peers
+
+    async def get(self, ip: str, port: int, reconnect: bool = False, channel: str = 'chat') -> PeerConnection|None:
+        """Returns a live connection to the peer, connecting if needed. Returns None for peers that only speak the legacy protocol.
+
+        Each channel gets its own connection, so bulk transfers don't delay chat messages.
+        """
+        if self.is_legacy_peer(ip):
+            self._recheck_legacy_peer(ip, port)
+            return None
+        key = (ip, port, channel)
+        lock = self._connect_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            connection = self._connections.get(key)
+            if connection and connection.is_alive() and not reconnect:
+                return connection
+            if connection:
+                self._connections.pop(key, None)
+                await connection.close()
+            connection = await self._connect(ip, port, channel)
+            if connection:
+                self._connections[key] = connection
+            return connection
+
+    def get_open(self, ip: str, port: int, channel: str = 'chat') -> PeerConnection|None:
+        """Returns the connection to the peer if it's open, without connecting."""
+        connection = self._connections.get((ip, port, channel))
+        if connection and connection.is_alive():
+            return connection
+        return None
+
+    def register_inbound(self, connection: PeerConnection):
+        self._inbound.add(connection)
+
+    async def discard(self, connection: PeerConnection):
+        key = (connection.ip, connection.port, connection.channel)
+        if self._connections.get(key) is connection:
+            self._connections.pop(key, None)
+        self._inbound.discard(connection)
+        await connection.close()
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(CONNECTION_HEALTH_CHECK_INTERVAL)
+            for connection in list(self._connections.values()):
+                if connection.lock.locked():
+                    continue
+                idle_time = connection.get_idle_time()
+                if not connection.is_alive() or idle_time > CONNECTION_IDLE_TIMEOUT:
+                    utils.print_info("Closing idle connection to", connection.ip)
+                    await self.discard(connection)
+                elif idle_time > CONNECTION_HEALTH_CHECK_INTERVAL:
+                    if not await connection.ping():
+                        utils.print_warning("Health check failed for", connection.ip)
+                        await self.discard(connection)
+            for connection in list(self._inbound):
+                if not connection.is_alive():
+                    self._inbound.discard(connection)
+
+    async def close_all(self):
+        for task in self._probes.values():
+            task.cancel()
+        self._probes.clear()
+        for connection in list(self._connections.values()) + list(self._inbound):
+            await connection.close()
+        self._connections.clear()
+        self._inbound.clear()
+
+    def _recheck_legacy_peer(self, ip: str, port: int):
+        # the peer may have been updated, messages keep using the legacy protocol until the probe finds out
+        if ip in self._probes or time.monotonic() - self._legacy_peers[ip] < LEGACY_PEER_RECHECK_INTERVAL:
+            return
+        self._probes[ip] = asyncio.create_task(self._probe(ip, port))
+
+    async def _probe(self, ip: str, port: int):
+        key = (ip, port, 'chat')
+        try:
+            async with self._connect_locks.setdefault(key, asyncio.Lock()):
+                connection = await self._connect(ip, port, 'chat')
+                if connection:
+                    self._legacy_peers.pop(ip, None)
+                    old_connection = self._connections.get(key)
+                    if old_connection and old_connection.is_alive():
+                        await connection.close()
+                    else:
+                        self._connections[key] = connection
+        except Exception as e:
+            utils.print_info(f"Failed to probe {ip} for persistent connection support:", e)
+            self._legacy_peers[ip] = time.monotonic() # tried again after the interval
+        finally:
+            self._probes.pop(ip, None)
+
+    async def _connect(self, ip: str, port: int, channel: str) -> PeerConnection|None:
+        """Returns None if the peer only speaks the legacy protocol. Raises PeerUnreachableError if it didn't answer in time."""
+        start = time.monotonic()
+        reader, writer = await utils.open_connection(ip, port)
+        connection = PeerConnection(ip, port, reader, writer, channel=channel)
+        connection.start()
+        try:
+            reply = await connection.request(FRAME_HELLO, {'version': PROTOCOL_VERSION}, timeout=HELLO_TIMEOUT)
+            if 'version' not in reply:
+                raise FrameError('Invalid hello reply')
+            connection.peer_instance = reply.get('instance')
+            connection.features = set(reply.get('features', []))
+        except utils.PeerUnreachableError:
+            await connection.close()
+            raise
+        except TimeoutError:
+            # a slow or sleeping peer, not necessarily a legacy one
+            await connection.close()
+            raise utils.PeerUnreachableError(f'no hello reply after {HELLO_TIMEOUT:.1f} s')
+        except (ConnectionError, FrameError) as e:
+            # legacy peers close the connection when the hello isn't a packet they understand
+            utils.print_info(f"Peer {ip} does not support persistent connections:", e)
+            self._legacy_peers[ip] = time.monotonic()
+            await connection.close()
+            return None
+        except Exception:
+            await connection.close()
+            raise
+        # the total and the count give the average time to connect and say hello, see '/stats'
+        metrics.increment('pool.connections.opened')
+        metrics.increment('pool.connect_seconds', time.monotonic() - start)
+        utils.print_info("Opened persistent connection to", ip)
+        return connection
+
+pool = ConnectionPool()
@@ -0,0 +1,159 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import metrics
+import utils
+from config import *
+from message import Message
+
+# Delivery acknowledgements and duplicate suppression.
+# Every message carries its id and the time it was written ('id' and 'time' in the payload).
+# Peers with the 'message-ack' feature answer each message on a persistent connection with an ack frame listing its id.
+# Messages that aren't acknowledged in time are sent again with the same id, with a longer wait after each attempt.
+# Receivers remember the ids of the last messages from each user and drop messages they already received
+# (a retry after a lost ack, or the legacy fallbacks sending the same text twice), but still acknowledge them.
+# Every receiver of a group message gets the same id, so deliveries are tracked per receiver and acks are matched by the address they came from.
+
+def get_message_id(decoded_object: dict) -> str|None:
+    message_id = decoded_object.get('id')
+    if isinstance(message_id, str) and 0 < len(message_id) <= MAX_MESSAGE_ID_LENGTH:
+        return message_id
+    return None
+
+def get_message_timestamp(decoded_object: dict) -> float|None:
+    timestamp = decoded_object.get('time')
+    if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        return float(timestamp)
+    return None
+
+class ReceivedIds():
+    """The ids of the last received messages, the oldest are forgotten first."""
+    def __init__(self, size: int = RECEIVED_ID_CACHE_SIZE):
+        self._size = size
+        self._ids: OrderedDict[tuple[str, str], None] = OrderedDict()
+
+    def add(self, username: str, message_id: str) -> bool:
+        """Returns False if the message was already received."""
+        key = (username, message_id)
+        if key in self._ids:
+            self._ids.move_to_end(key)
+            metrics.increment('delivery.duplicates')
+            return False
+        self._ids[key] = None
+        if len(self._ids) > self._size:
+            self._ids.popitem(last=False)
+        return True
+
+    def discard(self, username: str, message_id: str):
+        """Forgets an added id, for messages that couldn't be decoded, so they are accepted when they are sent again."""
+        self._ids.pop((username, message_id), None)
+
+class _PendingDelivery():
+    def __init__(self, username: str, channel: str, message: Message):
+        self.username = username
+        self.channel = channel
+        self.message = message
+        self.ip = ''
+        self.attempts = 0
+        self.sent_at = 0.0
+        self.deadline = 0.0
+        self.resending = False # queued to be sent again, until it's tracked again
+
+class DeliveryTracker():
+    def __init__(self):
+        self._pending: dict[tuple[str, str], _PendingDelivery] = {} # keyed by (username, message id)
+        self._receivers: dict[str, set[str]] = {} # message id -> usernames it's pending for
+        self._resend: Callable[[str, Message, str], bool]|None = None
+        self._give_up: Callable[[str, Message], None]|None = None
+
+    def start(self, resend: Callable[[str, Message, str], bool], give_up: Callable[[str, Message], None]):
+        """`resend(username, message, channel)` queues the message again and returns False if it can't be,
+        `give_up(username, message)` is called when it wasn't acknowledged after MAX_DELIVERY_ATTEMPTS."""
+        self._resend = resend
+        self._give_up = give_up
+
+    def track(self, username: str, channel: str, message: Message, ip: str):
+        """Called when the message was sent to a peer that acknowledges messages."""
+        key = (username, message.get_id())
+        pending = self._pending.get(key)
+        if pending is None:
+            if len(self._pending) >= MAX_UNACKED_MESSAGES:
+                metrics.increment('delivery.untracked')
+                return
+            pending = _PendingDelivery(username, channel, message)
+            self._pending[key] = pending
+            self._receivers.setdefault(message.get_id(), set()).add(username)
+        pending.ip = ip
+        pending.resending = False
+        pending.sent_at = time.monotonic()
+        pending.deadline = pending.sent_at + ACK_TIMEOUT * 2 ** pending.attempts
+        pending.attempts += 1
+        metrics.set_gauge('delivery.unacked', len(self._pending))
+
+    def forget(self, username: str, message_id: str):
+        """Stops waiting for the user's acknowledgement, for example because the message went to their outbox."""
+        if self._remove(username, message_id):
+            metrics.set_gauge('delivery.unacked', len(self._pending))
+
+    def _remove(self, username: str, message_id: str) -> _PendingDelivery|None:
+        pending = self._pending.pop((username, message_id), None)
+        if pending:
+            receivers = self._receivers[message_id]
+            receivers.discard(username)
+            if not receivers:
+                del self._receivers[message_id]
+        return pending
+
+    def acknowledge(self, ip: str, message_ids: object):
+        if not isinstance(message_ids, list):
+            return
+        now = time.monotonic()
+        for message_id in message_ids:
+            if not isinstance(message_id, str):
+                continue
+            for username in list(self._receivers.get(message_id, ())):
+                if self._pending[(username, message_id)].ip != ip:
+                    continue
+                pending = self._remove(username, message_id)
+                # the round trip of the last attempt, from the message being written to the connection to the ack being read
+                metrics.increment('delivery.acked')
+                metrics.increment('delivery.ack_seconds', now - pending.sent_at)
+                metrics.set_gauge('delivery.last_ack_seconds', now - pending.sent_at)
+        metrics.set_gauge('delivery.unacked', len(self._pending))
+
+    def get_unacknowledged_count(self) -> int:
+        return len(self._pending)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(ACK_TIMEOUT / 10)
+            self.retry_overdue()
+
+    def retry_overdue(self):
+        assert self._resend and self._give_up, 'the delivery tracker is not started'
+        now = time.monotonic()
+        for (username, message_id), pending in list(self._pending.items()):
+            if pending.deadline > now:
+                continue
+            if pending.resending:
+                # it was sent again without being tracked (the legacy fallback or a peer that doesn't acknowledge), or it failed
+                self._remove(username, message_id)
+                metrics.increment('delivery.untracked')
+                continue
+            if pending.attempts >= MAX_DELIVERY_ATTEMPTS:
+                self._remove(username, message_id)
+                metrics.increment('delivery.failed')
+                self._give_up(pending.username, pending.message)
+                continue
+            pending.resending = True
+            pending.deadline = now + ACK_TIMEOUT * 2 ** pending.attempts # the resend may wait behind a full queue or a reconnect
+            metrics.increment('delivery.retries')
+            utils.print_info(f"Message {message_id} to {username} was not acknowledged, sending it again.")
+            if not self._resend(username, pending.message, pending.channel):
+                self._remove(username, message_id)
+        metrics.set_gauge('delivery.unacked', len(self._pending))
+
+tracker = DeliveryTracker()
+received_ids = ReceivedIds()
@@ -0,0 +1,88 @@
+import asyncio
+import random
+import struct
+from typing import Callable
+
+import metrics
+import utils
+from config import *
+
+# Presence datagrams are handled by the event loop as soon as they arrive, instead of polling a non-blocking socket.
+#
+# Binary presence datagram:
+#   magic (2 bytes) | kind (1 byte) | announce interval in tenths of a second (2 bytes, big endian) | username (UTF-8)
+# Older clients send and understand only a JSON object ({"username": ...}), which never starts with the magic bytes.
+
+PRESENCE_MAGIC = b'\xffP'
+PRESENCE_HEADER = struct.Struct('!2sBH')
+
+PRESENCE_ANNOUNCE = 1 # periodic broadcast
+PRESENCE_HELLO = 2 # unicast reply to the first announcement of a user, so they learn about us without waiting for our next one
+PRESENCE_GOODBYE = 3 # broadcast on exit, so we go offline for everyone immediately
+
+def encode_presence(kind: int, username: str, interval: float) -> bytes:
+    return PRESENCE_HEADER.pack(PRESENCE_MAGIC, kind, min(int(interval * 10), 0xffff)) + username.encode('utf-8')
+
+def decode_presence(data: bytes) -> tuple[int, str, float]:
+    """Returns (kind, username, announce interval in seconds). Raises ValueError if the datagram is malformed."""
+    if len(data) < PRESENCE_HEADER.size:
+        raise ValueError('Presence datagram is too short')
+    magic, kind, interval = PRESENCE_HEADER.unpack_from(data)
+    if magic != PRESENCE_MAGIC:
+        raise ValueError('Invalid presence datagram magic')
+    return kind, data[PRESENCE_HEADER.size:].decode('utf-8'), interval / 10
+
+def is_binary_presence(data: bytes) -> bool:
+    return data[:len(PRESENCE_MAGIC)] == PRESENCE_MAGIC
+
+class AnnounceScheduler():
+    """Decides when to announce our presence.
+
+    Every client backs off as the number of online users grows, so the whole LAN stays around TARGET_BROADCAST_RATE datagrams per second.
+    Each delay is jittered, so clients that started together don't keep broadcasting in bursts.
+    """
+    def __init__(self):
+        self._wakeup: asyncio.Event|None = None
+
+    def get_interval(self, peer_count: int) -> float:
+        return min(MAX_BROADCAST_INTERVAL, max(SERVICE_BROADCAST_INTERVAL, peer_count / TARGET_BROADCAST_RATE))
+
+    def get_delay(self, interval: float) -> float:
+        return interval * random.uniform(1 - BROADCAST_JITTER, 1 + BROADCAST_JITTER)
+
+    def request_announce(self):
+        """Makes the next announcement happen now. Must be called from the event loop."""
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def wait(self, delay: float):
+        """Waits for the delay, or until an announcement is requested."""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+        except TimeoutError:
+            pass
+        self._wakeup.clear()
+
+metrics.track_rate('discovery.datagrams.sent')
+metrics.track_rate('discovery.datagrams.received')
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, on_datagram: Callable[[bytes, str], bool]):
+        """`on_datagram` gets the data and the sender's ip, and returns False if the datagram was dropped."""
+        self._on_datagram = on_datagram
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        metrics.increment('discovery.datagrams.received')
+        try:
+            accepted = self._on_datagram(data, addr[0])
+        except Exception as e:
+            utils.print_error("Exception while handling incoming broadcast:", e)
+            accepted = False
+        if not accepted:
+            metrics.increment('discovery.datagrams.dropped')
+
+    def error_received(self, exc: Exception):
+        metrics.increment('discovery.errors')
+        utils.print_warning("Discovery socket error:", exc)
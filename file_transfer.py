@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import struct
+import time
+import uuid
+from typing import TYPE_CHECKING
+
+import utils
+import ciphers
+import compression
+import metrics
+from ciphers import SessionCipher
+from attachment import Attachment, sanitize_filename
+from connection_pool import PeerConnection
+from config import *
+from framing import *
+from session_keys import SessionKey
+
+if TYPE_CHECKING:
+    from group_send import GroupPayload
+
+# Streaming transfer of large attachments over a persistent connection.
+# The sender offers a file and the receiver answers with the offset to resume from (a previous attempt may have been cut off),
+# then the file is sent in encrypted chunks, each with the SHA-256 hash of its plain content.
+# Chunks are written to './data/attachments/partial/' as they arrive and moved next to the other attachments when complete.
+# If the offer names a compression algorithm, chunks with FLAG_COMPRESSED were compressed before they were encrypted.
+# Transfers that stop receiving chunks, and received files whose message never arrives, are deleted after TRANSFER_IDLE_TIMEOUT.
+# Only AEAD ciphers authenticate the chunk headers, so attachments aren't streamed over 3DES sessions, they are sent inline instead.
+
+CHUNK_HEADER = struct.Struct('!16sQ32s') # transfer id, offset, sha256 of the plain chunk
+FLAG_COMPRESSED = 1
+
+_partial_path = os.path.abspath('./data/attachments/partial/')
+_transfer_id_pattern = re.compile(r'^[0-9a-f]{32}$')
+
+_incoming_transfers: dict[str, 'IncomingTransfer'] = {}
+_completed_transfers: dict[str, 'IncomingTransfer'] = {}
+
+def should_stream(attachment: Attachment) -> bool:
+    return attachment.get_content_size() > STREAMING_ATTACHMENT_THRESHOLD
+
+def generate_transfer_id() -> str:
+    return uuid.uuid4().hex
+
+class IncomingTransfer():
+    def __init__(self, transfer_id: str, ip: str, filename: str, size: int, cipher: SessionCipher):
+        self.transfer_id = transfer_id
+        self.ip = ip
+        self.cipher = cipher
+        self.compression: str|None = None
+        self.filename = sanitize_filename(filename)
+        self.size = size
+        self.offset = 0
+        self.path = os.path.join(_partial_path, transfer_id)
+        self.last_active = time.monotonic()
+        self._file = None
+
+    def get_idle_time(self) -> float:
+        return time.monotonic() - self.last_active
+
+    def open(self, chunk_size: int) -> int:
+        """Opens the partial file and returns the offset to resume from."""
+        os.makedirs(_partial_path, exist_ok=True)
+        if self._file is None:
+            self._file = open(self.path, mode='r+b' if os.path.exists(self.path) else 'w+b')
+        self._file.flush()
+        offset = min(os.path.getsize(self.path), self.size)
+        offset -= offset % chunk_size
+        self._file.truncate(offset)
+        self._file.seek(offset)
+        self.offset = offset
+        return offset
+
+    def write_chunk(self, offset: int, digest: bytes, data: bytes) -> bool:
+        if self._file is None or offset != self.offset or self.offset + len(data) > self.size:
+            return False
+        if hashlib.sha256(data).digest() != digest:
+            utils.print_warning(f"Chunk at offset {offset} of transfer {self.transfer_id} failed the integrity check.")
+            return False
+        self._file.write(data)
+        self.offset += len(data)
+        self.last_active = time.monotonic()
+        return True
+
+    def is_complete(self) -> bool:
+        return self.offset == self.size
+
+    def finish(self) -> str:
+        self.close()
+        final_path = utils.generate_attachment_path(self.filename)
+        shutil.move(self.path, final_path)
+        self.path = final_path
+        self.last_active = time.monotonic()
+        return final_path
+
+    def delete(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def handle_offer(ip: str, decoded_object: dict, cipher: SessionCipher|None) -> dict:
+    if cipher is None:
+        raise RuntimeError("Attachments can only be streamed over an encrypted connection.")
+    if 'content_key' in decoded_object: # sent to several users, the chunks are encrypted with a content key
+        cipher = ciphers.unwrap_cipher(str(decoded_object['content_key']), cipher)
+    if not isinstance(cipher, ciphers.AEADCipher):
+        raise RuntimeError("Attachments can only be streamed with an AEAD cipher, which authenticates the chunk headers.")
+    transfer_id = str(decoded_object['id'])
+    if not _transfer_id_pattern.match(transfer_id):
+        raise ProtocolError("Invalid transfer id.")
+    size = int(decoded_object['size'])
+    chunk_size = int(decoded_object['chunk_size'])
+    if size < 0 or chunk_size < 1:
+        raise ProtocolError("Invalid transfer parameters.")
+    if size > MAX_ATTACHMENT_SIZE:
+        raise RuntimeError(f"Attachments larger than {MAX_ATTACHMENT_SIZE} bytes are refused.")
+    transfer = _incoming_transfers.get(transfer_id)
+    if transfer is None or transfer.ip != ip:
+        if sum(1 for other in _incoming_transfers.values() if other.ip == ip) >= MAX_TRANSFERS_PER_IP:
+            raise RuntimeError(f"Too many unfinished transfers from {ip}.")
+        os.makedirs(_partial_path, exist_ok=True)
+        if shutil.disk_usage(_partial_path).free < size:
+            raise RuntimeError("Not enough disk space for the attachment.")
+        if transfer:
+            transfer.delete() # the id was taken by another address
+        transfer = IncomingTransfer(transfer_id, ip, str(decoded_object['filename']), size, cipher)
+        _incoming_transfers[transfer_id] = transfer
+    transfer.last_active = time.monotonic()
+    transfer.cipher = cipher # the key may have changed since an interrupted attempt
+    transfer.compression = str(decoded_object['compression']) if 'compression' in decoded_object else None
+    if transfer.compression and transfer.compression not in compression.SUPPORTED_COMPRESSION:
+        raise RuntimeError(f"Unsupported compression: {transfer.compression}")
+    offset = transfer.open(chunk_size)
+    utils.print_info(f"Receiving {transfer.filename} ({size} bytes) from {ip}, starting at offset {offset}.")
+    return {'offset': offset}
+
+def handle_chunk(ip: str, payload: memoryview, flags: int = 0):
+    header = bytes(payload[:CHUNK_HEADER.size])
+    transfer_id_bytes, offset, digest = CHUNK_HEADER.unpack(header)
+    transfer = _incoming_transfers.get(transfer_id_bytes.hex())
+    if transfer is None or transfer.ip != ip:
+        raise RuntimeError("Received a chunk for an unknown transfer.")
+    # the header is authenticated along with the chunk, so a chunk can't be replayed at another offset
+    data = transfer.cipher.decrypt(payload[CHUNK_HEADER.size:], header)
+    if flags & FLAG_COMPRESSED:
+        if not transfer.compression:
+            raise RuntimeError("Received a compressed chunk for an uncompressed transfer.")
+        data = compression.decompress(data, transfer.compression, ATTACHMENT_CHUNK_SIZE)
+    transfer.write_chunk(offset, digest, data)
+
+def handle_end(ip: str, decoded_object: dict) -> dict:
+    transfer_id = str(decoded_object['id'])
+    transfer = _incoming_transfers.get(transfer_id)
+    if transfer is None or transfer.ip != ip:
+        raise RuntimeError("Unknown transfer.")
+    if not transfer.is_complete():
+        # some chunks were lost or corrupted, the sender continues from the last good offset
+        return {'complete': False, 'offset': transfer.offset}
+    _incoming_transfers.pop(transfer_id, None)
+    transfer.finish()
+    _completed_transfers[transfer_id] = transfer
+    utils.print_info(f"Received {transfer.filename} from {ip}.")
+    return {'complete': True}
+
+def expire_transfers():
+    """Deletes unfinished transfers that stopped receiving chunks, and received files whose message never arrived."""
+    for transfers in (_incoming_transfers, _completed_transfers):
+        for transfer_id, transfer in list(transfers.items()):
+            if transfer.get_idle_time() < TRANSFER_IDLE_TIMEOUT:
+                continue
+            transfers.pop(transfer_id, None)
+            try:
+                transfer.delete()
+            except OSError as e:
+                utils.print_warning(f"Failed to delete {transfer.path}:", e)
+            metrics.increment('transfers.expired')
+            utils.print_info(f"Deleted the abandoned transfer of {transfer.filename} from {transfer.ip}.")
+    # partial files left by an earlier run
+    if not os.path.isdir(_partial_path):
+        return
+    for entry in os.scandir(_partial_path):
+        if entry.name not in _incoming_transfers and time.time() - entry.stat().st_mtime > TRANSFER_IDLE_TIMEOUT:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+async def run():
+    while True:
+        await asyncio.sleep(TRANSFER_IDLE_TIMEOUT / 4)
+        expire_transfers()
+
+def pop_completed_attachment(transfer_id: str, ip: str) -> Attachment|None:
+    transfer = _completed_transfers.get(transfer_id)
+    if transfer is None or transfer.ip != ip:
+        return None
+    _completed_transfers.pop(transfer_id, None)
+    return Attachment.from_file(transfer.path, transfer.filename, saved=True)
+
+async def send_attachment(connection: PeerConnection, attachment: Attachment, transfer_id: str, session: SessionKey, group: 'GroupPayload|None' = None, algorithm: str|None = None):
+    """Streams the attachment. If it's sent to a group, the chunks encrypted once for every receiver are sent instead.
+
+    Chunks are compressed with `algorithm` if it's given, the attachment is not already compressed and it's not sent to a group
+    (the spooled chunks have a fixed size, so they can be found by offset when a transfer is resumed).
+    """
+    size = attachment.get_content_size()
+    cipher = session.cipher
+    offer = {
+        'id': transfer_id,
+        'filename': attachment.get_sanitized_filename(),
+        'size': size,
+        'chunk_size': ATTACHMENT_CHUNK_SIZE,
+        'session': session.session_id
+    }
+    spool_path = None
+    if group:
+        spool_path = await group.get_spool(attachment, transfer_id)
+        offer['content_key'] = group.wrap_key(cipher)
+    elif algorithm and compression.is_compressible(attachment):
+        offer['compression'] = algorithm
+    else:
+        algorithm = None
+    reply = await connection.request(FRAME_FILE_OFFER, offer)
+    offset = int(reply['offset'])
+    transfer_id_bytes = bytes.fromhex(transfer_id)
+    for _ in range(ATTACHMENT_TRANSFER_ATTEMPTS):
+        if spool_path:
+            await _send_spooled_chunks(connection, spool_path, offset, size)
+            offset = size
+        else:
+            with attachment.open() as file:
+                file.seek(offset)
+                while offset < size:
+                    chunk = file.read(ATTACHMENT_CHUNK_SIZE)
+                    if not chunk:
+                        raise RuntimeError(f'{attachment.get_sanitized_filename()} is shorter than expected')
+                    header = CHUNK_HEADER.pack(transfer_id_bytes, offset, hashlib.sha256(chunk).digest())
+                    compressed = await asyncio.to_thread(compression.compress, chunk, algorithm) if algorithm else None
+                    if compressed is None:
+                        algorithm = None # the file doesn't compress, the rest of it is sent as it is
+                        await connection.send_raw(FRAME_FILE_CHUNK, header, cipher.encrypt(chunk, header))
+                    else:
+                        await connection.send_raw(FRAME_FILE_CHUNK, header, cipher.encrypt(compressed, header), flags=FLAG_COMPRESSED)
+                    offset += len(chunk)
+        reply = await connection.request(FRAME_FILE_END, {'id': transfer_id})
+        if reply.get('complete'):
+            return
+        offset = int(reply['offset'])
+    raise RuntimeError(f'Failed to send {attachment.get_sanitized_filename()} after {ATTACHMENT_TRANSFER_ATTEMPTS} attempts')
+
+async def _send_spooled_chunks(connection: PeerConnection, spool_path: str, offset: int, size: int):
+    record_size = CHUNK_HEADER.size + ATTACHMENT_CHUNK_SIZE + ciphers.AEAD_OVERHEAD
+    with open(spool_path, 'rb') as spool:
+        spool.seek(offset // ATTACHMENT_CHUNK_SIZE * record_size)
+        while offset < size:
+            record = spool.read(record_size)
+            if len(record) <= CHUNK_HEADER.size + ciphers.AEAD_OVERHEAD:
+                raise RuntimeError('Spool file is shorter than expected')
+            await connection.send_raw(FRAME_FILE_CHUNK, record)
+            offset += len(record) - CHUNK_HEADER.size - ciphers.AEAD_OVERHEAD
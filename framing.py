@@ -0,0 +1,120 @@
+import asyncio
+import json
+import struct
+from typing import Awaitable, Callable
+
+from config import *
+
+# Wire format of persistent connections:
+#   magic (2 bytes) | frame type (1 byte) | flags (1 byte) | payload length (4 bytes, big endian) | payload
+# Legacy peers send a bare JSON object instead, which never starts with the magic bytes (0xff is not valid UTF-8).
+
+FRAME_MAGIC = b'\xffM'
+FRAME_HEADER = struct.Struct('!2sBBI')
+
+FRAME_HELLO = 1
+FRAME_PING = 2
+FRAME_PONG = 3
+FRAME_KEY_EXCHANGE = 4
+FRAME_MESSAGE = 5
+FRAME_BYE = 6
+FRAME_FILE_OFFER = 7
+FRAME_FILE_CHUNK = 8
+FRAME_FILE_END = 9
+FRAME_ERROR = 10 # reply to a request that failed
+FRAME_REKEY = 11 # the receiver does not know the session key of a message
+FRAME_CHANNEL_REPAIR = 12 # requests multicast channel datagrams that were lost
+FRAME_ACK = 13 # confirms that messages were received, by their ids
+FRAME_MESSAGE_BATCH = 14 # several messages without attachments, in the order they were written
+
+class ProtocolError(Exception):
+    """Raised for requests that break the protocol. Only these add penalty points to the sender's address (see admission.py)."""
+    pass
+
+class FrameError(ProtocolError):
+    pass
+
+def encode_frame_header(frame_type: int, payload_size: int, flags: int = 0) -> bytes:
+    if payload_size > MAX_FRAME_SIZE:
+        raise FrameError(f'Frame payload ({payload_size} bytes) is larger than {MAX_FRAME_SIZE} bytes')
+    return FRAME_HEADER.pack(FRAME_MAGIC, frame_type, flags, payload_size)
+
+def encode_json_payload(obj: dict|None) -> bytes:
+    if obj is None:
+        return b''
+    return json.dumps(obj).encode(encoding='utf-8')
+
+def decode_json_payload(payload: memoryview|bytes) -> dict:
+    if len(payload) == 0:
+        return {}
+    try:
+        decoded_object = json.loads(str(payload, 'utf-8'))
+    except ValueError as e: # invalid UTF-8 too
+        raise FrameError(f'Invalid JSON payload: {e}')
+    if not isinstance(decoded_object, dict):
+        raise FrameError('Expected a JSON object')
+    return decoded_object
+
+def write_frame(writer: asyncio.StreamWriter, frame_type: int, *payload: bytes|bytearray|memoryview, flags: int = 0):
+    writer.writelines([encode_frame_header(frame_type, sum(len(part) for part in payload), flags), *payload])
+
+class FrameReader():
+    """Reads frames into a preallocated buffer.
+
+    The payload returned by `read_frame` is a view into that buffer and is only valid until the next call.
+    Only the frame types in `large_frame_types` may be larger than MAX_PACKET_SIZE (up to MAX_FRAME_SIZE).
+    Their payloads get their own buffer, which grows as the bytes arrive, so a header alone can't make it allocate much.
+    `charge(byte_count)` is awaited with the size of each frame before its payload is read, for admission control.
+    """
+    def __init__(self, reader: asyncio.StreamReader, prefix: bytes = b'', large_frame_types: frozenset[int] = frozenset(), charge: Callable[[int], Awaitable[None]]|None = None):
+        self._reader = reader
+        self._prefix = prefix
+        self._large_frame_types = large_frame_types
+        self._charge = charge
+        self._buffer = bytearray(MAX_PACKET_SIZE)
+        self._header = bytearray(FRAME_HEADER.size)
+
+    async def read_frame(self) -> tuple[int, int, memoryview]|None:
+        """Returns (frame type, flags, payload), or None if the connection was closed between frames."""
+        if not await self._read_into(memoryview(self._header), allow_eof=True):
+            return None
+        magic, frame_type, flags, payload_size = FRAME_HEADER.unpack(self._header)
+        if magic != FRAME_MAGIC:
+            raise FrameError('Invalid frame magic')
+        max_size = MAX_FRAME_SIZE if frame_type in self._large_frame_types else MAX_PACKET_SIZE
+        if payload_size > max_size:
+            raise FrameError(f'Frame payload ({payload_size} bytes) of type {frame_type} is larger than {max_size} bytes')
+        if self._charge:
+            await self._charge(FRAME_HEADER.size + payload_size)
+        if payload_size <= len(self._buffer):
+            payload = memoryview(self._buffer)[:payload_size]
+            await self._read_into(payload)
+        else:
+            payload = memoryview(await self._read_growing(payload_size))
+        return frame_type, flags, payload
+
+    async def _read_growing(self, size: int) -> bytearray:
+        data = bytearray(self._prefix[:size])
+        self._prefix = self._prefix[len(data):]
+        while len(data) < size:
+            chunk = await self._reader.read(min(size - len(data), MAX_PACKET_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(data), size)
+            data += chunk
+        return data
+
+    async def _read_into(self, view: memoryview, allow_eof: bool = False) -> bool:
+        offset = 0
+        if self._prefix:
+            offset = min(len(self._prefix), len(view))
+            view[:offset] = self._prefix[:offset]
+            self._prefix = self._prefix[offset:]
+        while offset < len(view):
+            chunk = await self._reader.read(len(view) - offset)
+            if not chunk:
+                if allow_eof and offset == 0:
+                    return False
+                raise asyncio.IncompleteReadError(bytes(view[:offset]), len(view))
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return True
@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import json
+import os
+from base64 import b64decode, b64encode
+
+import binary_payload
+import ciphers
+import compression
+import file_transfer
+import unicode_utils
+import utils
+from attachment import Attachment
+from config import *
+from message import Message
+
+# A message to several users is encrypted once with a random content key, and only that key is encrypted for each receiver.
+# Streamed attachments are encrypted once into a spool file, which the transfer to every receiver reads from.
+
+CONTENT_CIPHER = ciphers.CIPHER_AES_GCM
+
+_spool_path = os.path.abspath('./data/attachments/outgoing/')
+
+class GroupPayload():
+    def __init__(self, message: Message, receiver_count: int):
+        self.message = message
+        self.content_key = os.urandom(32)
+        self.cipher = ciphers.AEADCipher(CONTENT_CIPHER, self.content_key)
+        attachments = message.get_attachments()
+        # transfer ids are shared by every receiver, they identify the spool file
+        self.transfer_ids = [file_transfer.generate_transfer_id() if file_transfer.should_stream(attachment) else None for attachment in attachments]
+        self._encrypted_content: dict[tuple[str|None, bool], tuple[str, str|None]] = {} # keyed by the requested compression algorithm and whether attachments are binary
+        self._binary_attachments: dict[str|None, tuple[list[dict], list[bytes]]] = {}
+        self._spools: dict[str, asyncio.Task[str]] = {}
+        self._remaining_receivers = receiver_count
+
+    def get_inline_attachments(self) -> list[Attachment]:
+        return [attachment for attachment, transfer_id in zip(self.message.get_attachments(), self.transfer_ids) if not transfer_id]
+
+    def get_encrypted_content(self, algorithm: str|None = None, binary: bool = False) -> tuple[str, str|None]:
+        """Returns the encrypted content and the compression algorithm it used, None if it wasn't worth compressing.
+
+        With `binary`, the inline attachments are left out, they are sent in the binary section instead.
+        """
+        key = (algorithm, binary)
+        if key not in self._encrypted_content:
+            content = {'message': unicode_utils.with_surrogates(self.message.get_text_content())}
+            inline_attachments = self.get_inline_attachments()
+            if inline_attachments and not binary:
+                content['attachments'] = [attachment.to_dict() for attachment in inline_attachments]
+            data = json.dumps(content).encode('utf-8')
+            compressed = compression.compress(data, algorithm) if algorithm else None
+            if compressed is None and algorithm:
+                self._encrypted_content[key] = self.get_encrypted_content(None, binary)
+            else:
+                self._encrypted_content[key] = (b64encode(self.cipher.encrypt(compressed or data)).decode('ascii'), algorithm)
+        return self._encrypted_content[key]
+
+    def get_binary_attachments(self, algorithm: str|None = None) -> tuple[list[dict], list[bytes]]:
+        """Returns the inline attachments encrypted with the content key, see `binary_payload.encrypt_attachments`."""
+        if algorithm not in self._binary_attachments:
+            self._binary_attachments[algorithm] = binary_payload.encrypt_attachments(self.get_inline_attachments(), self.cipher, algorithm)
+        return self._binary_attachments[algorithm]
+
+    def wrap_key(self, cipher: ciphers.SessionCipher) -> str:
+        return ciphers.wrap_key(self.content_key, cipher)
+
+    def generate_payload(self, cipher: ciphers.SessionCipher, algorithm: str|None = None, binary: bool = False) -> dict:
+        author = self.message.get_author_username()
+        if author == '<localhost>':
+            author = utils.get_current_username()
+        encrypted_content, algorithm = self.get_encrypted_content(algorithm, binary)
+        payload = {'author': author, 'id': self.message.get_id(), 'time': self.message.get_timestamp(), 'content_key': self.wrap_key(cipher), 'encrypted_content': encrypted_content}
+        if algorithm:
+            payload['compression'] = algorithm
+        if self.message.has_metadata():
+            payload['metadata'] = self.message.get_metadata()
+        return payload
+
+    async def get_spool(self, attachment: Attachment, transfer_id: str) -> str:
+        """Returns the path of the encrypted chunks of the attachment, encrypting them on first use."""
+        if transfer_id not in self._spools:
+            self._spools[transfer_id] = asyncio.create_task(asyncio.to_thread(self._write_spool, attachment, transfer_id))
+        return await self._spools[transfer_id]
+
+    def release(self):
+        """Called once per receiver when it's done. The spool files are removed after the last receiver."""
+        self._remaining_receivers -= 1
+        if self._remaining_receivers > 0:
+            return
+        for task in self._spools.values():
+            if task.done() and not task.exception():
+                try:
+                    os.remove(task.result())
+                except OSError as e:
+                    utils.print_warning("Failed to remove a spool file:", e)
+        self._spools.clear()
+
+    def _write_spool(self, attachment: Attachment, transfer_id: str) -> str:
+        os.makedirs(_spool_path, exist_ok=True)
+        path = os.path.join(_spool_path, transfer_id)
+        transfer_id_bytes = bytes.fromhex(transfer_id)
+        offset = 0
+        # each record is a complete chunk frame payload, so the transfers can send them as they are
+        with attachment.open() as file, open(path, 'wb') as spool:
+            while chunk := file.read(ATTACHMENT_CHUNK_SIZE):
+                header = file_transfer.CHUNK_HEADER.pack(transfer_id_bytes, offset, hashlib.sha256(chunk).digest())
+                spool.write(header)
+                spool.write(self.cipher.encrypt(chunk, header))
+                offset += len(chunk)
+        return path
+
+def get_content_cipher(decoded_object: dict, cipher: ciphers.SessionCipher) -> ciphers.SessionCipher:
+    return ciphers.unwrap_cipher(str(decoded_object['content_key']), cipher, CONTENT_CIPHER)
+
+def decrypt_content(decoded_object: dict, cipher: ciphers.SessionCipher) -> dict:
+    """Decrypts a message that was sent to several users at once. Returns its text and inline attachments."""
+    content_cipher = get_content_cipher(decoded_object, cipher)
+    data = content_cipher.decrypt(b64decode(str(decoded_object['encrypted_content']).encode('ascii')))
+    if 'compression' in decoded_object:
+        data = compression.decompress(data, str(decoded_object['compression']))
+    content = json.loads(data)
+    if not isinstance(content, dict):
+        raise RuntimeError('Invalid group message content')
+    return content
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import threading
+
+import commands
+import config
+import message_server
+import utils
+from attachment import Attachment
+from config import *
+from message import Message
+from message_packet import MessagePacket
+
+# Runs the app without a window (on servers, in containers, for load tests), imports neither tkinter nor PIL.
+# Run with `python3 headless.py`, add `--control-port 7000` or `--control-socket ./data/control.sock` to control it over a local socket.
+#
+# Each input line is one of:
+#   /command [arguments]...        runs a slash command, like in the chat input (/exec runs user scripts)
+#   @alice,bob message             sends a message to the given users
+#   #channel message               sends a message to a multicast channel
+#   {"to": [...], "text": "...", "attachments": ["path", ...]}    the same as JSON, for automation
+# Received and system messages are written one per line, as "author: text" or with `--json` as JSON objects.
+
+class _Output():
+    """Writes the received messages to stdout and to every connected control client."""
+    def __init__(self, use_json: bool, use_stdout: bool):
+        self._use_json = use_json
+        self._use_stdout = use_stdout
+        self._clients: dict[asyncio.StreamWriter, asyncio.Task] = {}
+
+    def add_client(self, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        assert task is not None
+        self._clients[writer] = task
+
+    def remove_client(self, writer: asyncio.StreamWriter):
+        self._clients.pop(writer, None)
+
+    def format(self, message: Message) -> str:
+        author = message.get_author_username()
+        if author == '<localhost>':
+            author = utils.get_current_username()
+        if self._use_json:
+            obj: dict = {'author': author, 'text': message.get_text_content()}
+            if message.has_attachments():
+                obj['attachments'] = [attachment.get_sanitized_filename() for attachment in message.get_attachments()]
+            if message.has_metadata():
+                obj['metadata'] = message.get_metadata()
+            return json.dumps(obj)
+        return f"{author}: {message.get_text_content()}".replace('\n', '\\n')
+
+    def write(self, message: Message):
+        line = self.format(message) + '\n'
+        if self._use_stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        for writer in list(self._clients):
+            if writer.is_closing():
+                continue
+            writer.write(line.encode('utf-8'))
+
+    async def close(self):
+        """Disconnects the control clients and waits for them to finish."""
+        tasks = list(self._clients.values())
+        for writer in self._clients:
+            writer.close()
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+
+def _parse_receivers(text: str) -> tuple[list[str], str]:
+    target, _, content = text.partition(' ')
+    if target.startswith('@'):
+        return [receiver for receiver in target[1:].split(',') if receiver], content
+    return [target], content # a channel
+
+def handle_line(line: str):
+    """Runs a control line. Called from a worker thread, as commands may wait for the message server."""
+    line = line.strip()
+    if not line:
+        return
+    if line.startswith('{'):
+        request = json.loads(line)
+        if not isinstance(request, dict) or not isinstance(request.get('to'), list):
+            raise RuntimeError('Expected {"to": [...], "text": "...", "attachments": [...]}')
+        attachments = [Attachment.from_file(str(path), os.path.basename(str(path))) for path in request.get('attachments', [])]
+        message_server.outbound_message_queue.put(MessagePacket(Message('<localhost>', str(request.get('text', '')), attachments), [str(receiver) for receiver in request['to']]))
+    elif line.startswith('/'):
+        commands.run_command(line)
+    elif line.startswith('@') or line.startswith('#'):
+        receivers, text = _parse_receivers(line)
+        message_server.outbound_message_queue.put(MessagePacket(Message('<localhost>', text), receivers))
+    else:
+        message_server.generate_system_message("Expected a /command, '@user message' or '#channel message'.")
+
+async def _run_line(line: str):
+    try:
+        await asyncio.to_thread(handle_line, line)
+    except Exception as e:
+        message_server.generate_system_message(f"Failed to run '{line.strip()}': {e}")
+
+def _read_stdin_lines(loop: asyncio.AbstractEventLoop, lines: asyncio.Queue[str]):
+    try:
+        while line := sys.stdin.readline():
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+    except RuntimeError: # the loop was closed
+        pass
+
+async def _read_stdin():
+    # a daemon thread reads stdin, as it can't be read asynchronously on every platform,
+    # and the app doesn't wait for it to exit (it may be blocked until the next line arrives)
+    lines: asyncio.Queue[str] = asyncio.Queue()
+    threading.Thread(target=_read_stdin_lines, args=(asyncio.get_running_loop(), lines), name='stdin', daemon=True).start()
+    while True:
+        await _run_line(await lines.get())
+
+async def _write_inbound_messages(output: _Output):
+    while True:
+        output.write((await message_server.inbound_message_queue.get()).message)
+
+async def _serve_control_client(output: _Output, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    output.add_client(writer)
+    try:
+        while line := await reader.readline():
+            await _run_line(line.decode('utf-8', errors='replace'))
+    except ConnectionError:
+        pass
+    finally:
+        output.remove_client(writer)
+        await utils.close_stream(writer)
+
+async def run(options: argparse.Namespace):
+    output = _Output(options.json, not options.no_stdout)
+    server_task = asyncio.create_task(message_server.main())
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, message_server.exit)
+        except (NotImplementedError, RuntimeError): # not supported on Windows
+            pass
+    tasks = [asyncio.create_task(_write_inbound_messages(output))]
+    servers: list[asyncio.Server] = []
+    if options.control_port:
+        servers.append(await asyncio.start_server(lambda r, w: _serve_control_client(output, r, w), '127.0.0.1', options.control_port))
+    if options.control_socket:
+        if os.path.exists(options.control_socket):
+            os.remove(options.control_socket)
+        servers.append(await asyncio.start_unix_server(lambda r, w: _serve_control_client(output, r, w), options.control_socket))
+    if not options.no_stdin:
+        tasks.append(asyncio.create_task(_read_stdin()))
+    utils.print_info("Running headless.")
+    await server_task
+    for server in servers:
+        server.close()
+    for task in tasks:
+        task.cancel()
+    while packet := message_server.pull_inbound_message(): # the last messages, like the reply to /exit
+        output.write(packet.message)
+    await output.close()
+    if options.control_socket and os.path.exists(options.control_socket):
+        os.remove(options.control_socket)
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs MoRes-Chat without a window.', parents=[config.parser])
+    parser.add_argument('--control-port', help='accept control connections on this port of 127.0.0.1', type=int, default=0)
+    parser.add_argument('--control-socket', help='accept control connections on this unix socket', default='')
+    parser.add_argument('--no-stdin', help="don't read control lines from stdin", action='store_true')
+    parser.add_argument('--no-stdout', help="don't write received messages to stdout", action='store_true')
+    parser.add_argument('--json', help='write received messages as JSON objects', action='store_true')
+    options = parser.parse_args()
+    utils.setup_dir()
+    asyncio.run(run(options))
+
+if __name__ == "__main__":
+    main()
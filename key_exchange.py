@@ -0,0 +1,175 @@
+import asyncio
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+
+import metrics
+import utils
+from admission import TokenBucket
+from config import *
+
+# Diffie-Hellman key exchange over the classic (g, p) groups, the RFC 3526 MODP groups or X25519.
+# Modular exponentiation always uses the 3 argument pow(), which never builds the full g ** x.
+# Keypairs are generated ahead of time in a background thread, so a key exchange only has to compute the shared key.
+# Only the named groups and the configured one are pooled. Custom groups sent by peers get a keypair on demand,
+# at a limited rate, as anyone can send a new large p with every request.
+
+class KeyExchangeGroup():
+    def __init__(self, name: str, g: int|None = None, p: int|None = None):
+        self.name = name
+        self.g = g
+        self.p = p
+
+    def is_x25519(self) -> bool:
+        return self.name == 'x25519'
+    def is_small(self) -> bool:
+        # groups this small are computed inline, handing them to a thread costs more than the math
+        return self.p is not None and self.p.bit_length() <= 64
+    def get_id(self) -> object:
+        if self.name == 'custom':
+            return (self.g, self.p)
+        return self.name
+    def to_dict(self) -> dict[str, str]:
+        result = {}
+        if self.name != 'custom':
+            result['group'] = self.name
+        if not self.is_x25519():
+            # older peers only know about g and p
+            result['g'] = str(self.g)
+            result['p'] = str(self.p)
+        return result
+
+NAMED_GROUPS = {
+    'modp2048': KeyExchangeGroup('modp2048', 2, MODP_2048_P),
+    'modp3072': KeyExchangeGroup('modp3072', 2, MODP_3072_P),
+    'modp4096': KeyExchangeGroup('modp4096', 2, MODP_4096_P),
+    'x25519': KeyExchangeGroup('x25519'),
+}
+
+def get_custom_group(g: int, p: int) -> KeyExchangeGroup:
+    if g < 2 or p <= g:
+        raise RuntimeError(f'Invalid Diffie Hellman parameters, g: {g}, p: {p}')
+    if p.bit_length() > MAX_DH_P_BITS:
+        raise RuntimeError(f'Diffie Hellman parameter p is larger than {MAX_DH_P_BITS} bits')
+    return KeyExchangeGroup('custom', g, p)
+
+def get_group_from_dict(dictionary: dict, default_g: int = DEFAULT_DH_G, default_p: int = DEFAULT_DH_P) -> KeyExchangeGroup:
+    name = dictionary.get('group')
+    if isinstance(name, str) and name in NAMED_GROUPS:
+        return NAMED_GROUPS[name]
+    dh_params = utils.extract_diffie_hellman_parameters_from_dict(dictionary, default_g=default_g, default_p=default_p)
+    return get_custom_group(dh_params['g'], dh_params['p'])
+
+def get_configured_group() -> KeyExchangeGroup:
+    name = utils.get_setting('security.encryption.group', '')
+    if name in NAMED_GROUPS:
+        return NAMED_GROUPS[name]
+    g = utils.get_setting('security.encryption.parameter.g', DEFAULT_DH_G)
+    p = utils.get_setting('security.encryption.parameter.p', DEFAULT_DH_P)
+    return get_custom_group(g, p)
+
+def is_probable_prime(n: int, rounds: int = 32) -> bool:
+    if n < 2:
+        return False
+    for small_prime in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if n % small_prime == 0:
+            return n == small_prime
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for _ in range(rounds):
+        x = pow(secrets.randbelow(n - 3) + 2, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def generate_private_exponent(p: int) -> int:
+    if p.bit_length() <= 64:
+        return utils.generate_key()
+    bits = min(DH_PRIVATE_KEY_BITS, p.bit_length() - 2)
+    return secrets.randbits(bits) | (1 << (bits - 1))
+
+class KeyPair():
+    def __init__(self, group: KeyExchangeGroup):
+        self.group = group
+        if group.is_x25519():
+            self._private_key = X25519PrivateKey.generate()
+            self.public_key = self._private_key.public_key().public_bytes_raw().hex()
+        else:
+            self._private_key = generate_private_exponent(group.p)
+            self.public_key = str(pow(group.g, self._private_key, group.p))
+
+    def compute_shared_key(self, peer_public_key: str) -> int:
+        if self.group.is_x25519():
+            peer_key = X25519PublicKey.from_public_bytes(bytes.fromhex(peer_public_key))
+            return int.from_bytes(self._private_key.exchange(peer_key), 'big')
+        p = self.group.p
+        peer_key = int(peer_public_key)
+        if peer_key < 1:
+            raise RuntimeError(f'Peer public key ({peer_key}) is less than 1')
+        elif peer_key >= p:
+            raise RuntimeError(f'Peer public key ({peer_key}) is bigger than p ({p})')
+        return pow(peer_key, self._private_key, p)
+
+_executor = ThreadPoolExecutor(max_workers=KEY_EXCHANGE_WORKERS, thread_name_prefix='key_exchange')
+
+class KeyPairPool():
+    def __init__(self, size: int = KEYPAIR_POOL_SIZE):
+        self._size = size
+        self._keypairs: dict[object, list[KeyPair]] = {}
+        self._refilling: set[object] = set()
+        self._custom_groups = TokenBucket(CUSTOM_GROUP_KEYPAIRS_PER_SECOND, CUSTOM_GROUP_KEYPAIR_BURST)
+
+    def is_pooled(self, group: KeyExchangeGroup) -> bool:
+        return group.name != 'custom' or group.get_id() == get_configured_group().get_id()
+
+    async def get(self, group: KeyExchangeGroup) -> KeyPair:
+        if group.is_small():
+            return KeyPair(group)
+        if not self.is_pooled(group):
+            if not self._custom_groups.consume():
+                metrics.increment('key_exchange.custom_groups.refused')
+                raise RuntimeError('Too many key exchanges with custom Diffie Hellman parameters')
+            metrics.increment('key_exchange.custom_groups')
+            return await asyncio.get_running_loop().run_in_executor(_executor, KeyPair, group)
+        keypairs = self._keypairs.setdefault(group.get_id(), [])
+        if keypairs:
+            keypair = keypairs.pop()
+        else:
+            keypair = await asyncio.get_running_loop().run_in_executor(_executor, KeyPair, group)
+        self.prefill(group)
+        return keypair
+
+    def prefill(self, group: KeyExchangeGroup):
+        """Starts generating keypairs for the group in the background. Must be called from the event loop."""
+        group_id = group.get_id()
+        if group_id in self._refilling or group.is_small() or not self.is_pooled(group):
+            return
+        self._refilling.add(group_id)
+        asyncio.create_task(self._refill(group))
+
+    async def _refill(self, group: KeyExchangeGroup):
+        group_id = group.get_id()
+        keypairs = self._keypairs.setdefault(group_id, [])
+        try:
+            while len(keypairs) < self._size:
+                keypairs.append(await asyncio.get_running_loop().run_in_executor(_executor, KeyPair, group))
+        except Exception as e:
+            utils.print_error("Failed to generate keypairs:", e)
+        finally:
+            self._refilling.discard(group_id)
+
+async def compute_shared_key(keypair: KeyPair, peer_public_key: str) -> int:
+    if keypair.group.is_small():
+        return keypair.compute_shared_key(peer_public_key)
+    return await asyncio.get_running_loop().run_in_executor(_executor, keypair.compute_shared_key, peer_public_key)
+
+pool = KeyPairPool()
@@ -1,9 +1,11 @@
+import argparse
 import asyncio
-import os
 import threading
 import tkinter as tk
 
+import config
 import message_server
+import utils
 from app import App
 from config import ICON_PATH
 
@@ -18,12 +20,7 @@ from config import ICON_PATH
 # This is THE MAIN file for the whole app
 # Run this file with `python3 main.py` (on Linux) or `python main.py` (on Windows)
 # Do not run any other file unless you absolutely know what you're doing
-
-def setup_dir():
-    if not os.path.exists('./data/'):
-        os.makedirs('./data')
-    if not os.path.exists('./user_scripts/'):
-        os.makedirs('./user_scripts')
+# To run without a window (on a server), run `python3 headless.py` instead
 
 def setup_tkinter():
     root = tk.Tk()
@@ -48,7 +45,8 @@ async def async_main():
 # running tkinter alongside asyncio without errors 💀
 
 def main():
-    setup_dir()
+    argparse.ArgumentParser(description='Runs MoRes-Chat.', parents=[config.parser]).parse_args() # for the help and to reject unknown options
+    utils.setup_dir()
     asyncio_thread = threading.Thread(target=asyncio.run, args=[async_main()])
     asyncio_thread.daemon = True
     asyncio_thread.start()
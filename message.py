@@ -1,19 +1,26 @@
 import copy
+import time
+import uuid
 
 from attachment import Attachment
 
 class Message():
-    def __init__(self, author_username: str, text_content: str, attachments: list[Attachment] = [], metadata: dict[str, object] = {}):
+    def __init__(self, author_username: str, text_content: str, attachments: list[Attachment] = [], metadata: dict[str, object] = {}, message_id: str|None = None, timestamp: float|None = None):
         assert(type(author_username) == type(''))
         self._content = text_content
         self._author = author_username
-        self._timestamp = 0
+        self._id = message_id or uuid.uuid4().hex # stays the same when the message is sent again, so the receiver can drop duplicates
+        self._timestamp = time.time() if timestamp is None else timestamp # when it was written
         self._attachments = attachments.copy()
         self._metadata = copy.deepcopy(metadata)
     def has_attachments(self) -> bool:
         return len(self._attachments) > 0
     def has_metadata(self) -> bool:
         return len(self._metadata) > 0
+    def get_id(self) -> str:
+        return self._id
+    def get_timestamp(self) -> float:
+        return self._timestamp
     def get_text_content(self) -> str:
         return str(self._content)
     def get_sender_username(self) -> str:
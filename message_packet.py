@@ -2,9 +2,10 @@ import utils
 from message import Message
 
 class MessagePacket():
-    def __init__(self, message: Message, receivers: list[str]):
+    def __init__(self, message: Message, receivers: list[str], lane: str|None = None):
         self.message = message
         self.receivers = receivers.copy()
+        self.lane = lane # 'chat' or 'bulk', picked automatically if None
     def is_inbound(self):
         if ('<localhost>' in self.receivers) or (utils.get_current_username() in self.receivers):
             return True
@@ -15,4 +16,7 @@ class MessagePacket():
         for receiver in self.receivers:
             if utils.validate_username(receiver) and receiver != current_username:
                 result.append(receiver)
-        return result
\ No newline at end of file
+        return result
+    def get_channels(self) -> list[str]:
+        """Returns the names of the multicast channels among the receivers, which are written as '#name'."""
+        return [receiver[1:] for receiver in self.receivers if receiver.startswith('#') and len(receiver) > 1]
\ No newline at end of file
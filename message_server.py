@@ -1,11 +1,37 @@
 import socket
 import json
 import asyncio
+import os
+import threading
 import time
-from queue import SimpleQueue
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, SimpleQueue
+from typing import Callable
 
 import utils
+import admission
+import channels
+import circuit_breaker
+import binary_payload
+import ciphers
+import compression
+import delivery
 import events
+import metrics
+import connection_pool
+import file_transfer
+import group_send
+import key_exchange
+import outbox
+import presence
+import session_keys
+from connection_pool import PeerConnection
+from discovery import *
+from group_send import GroupPayload
+from framing import *
+from peer_sender import PeerSenders, LANE_CHAT, LANE_BULK
+from session_keys import SessionKey, UnknownSessionError
 from attachment import Attachment
 from message import Message
 from message_packet import MessagePacket
@@ -13,12 +39,80 @@ from user import User, Users
 from config import *
 from events import push_event, on_event
 
-inbound_message_queue: SimpleQueue[MessagePacket] = SimpleQueue()
-outbound_message_queue: SimpleQueue[MessagePacket] = SimpleQueue()
-blocklist = {} # blocklisted addresses due to constantly sending malformed JSON packets
+class LoopQueue():
+    """A queue that can be filled from any thread (the tkinter thread, user scripts, event callbacks) and awaited in the asyncio loop.
+
+    Items put before the loop is running are kept and handed over in `bind`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop|None = None
+        self._queue: asyncio.Queue|None = None
+        self._early_items: list = []
+
+    def bind(self):
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._queue = asyncio.Queue()
+            for item in self._early_items:
+                self._queue.put_nowait(item)
+            self._early_items.clear()
+
+    def put(self, item):
+        with self._lock:
+            if self._loop is None or self._queue is None:
+                self._early_items.append(item)
+                return
+            loop, queue = self._loop, self._queue
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def get_nowait(self):
+        with self._lock:
+            if self._queue is None:
+                return self._early_items.pop(0)
+        return self._queue.get_nowait()
+
+    async def get(self):
+        assert self._queue, 'LoopQueue is not bound to a loop'
+        return await self._queue.get()
+
+class InboundQueue():
+    """A queue that can be filled from any thread and polled by the window, or awaited by a reader in an asyncio loop (headless mode)."""
+    def __init__(self):
+        self._queue: SimpleQueue[MessagePacket] = SimpleQueue()
+        self._waiter: tuple[asyncio.AbstractEventLoop, asyncio.Event]|None = None
+
+    def put(self, packet: MessagePacket):
+        self._queue.put(packet)
+        waiter = self._waiter
+        if waiter:
+            loop, event = waiter
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError: # the loop was closed
+                pass
+
+    def get_nowait(self) -> MessagePacket:
+        return self._queue.get_nowait()
+
+    async def get(self) -> MessagePacket:
+        event = asyncio.Event()
+        self._waiter = (asyncio.get_running_loop(), event)
+        while True:
+            try:
+                return self._queue.get_nowait()
+            except Empty:
+                await event.wait()
+                event.clear() # cleared before the queue is read again, so a packet put meanwhile sets it again
+
+inbound_message_queue = InboundQueue()
+outbound_message_queue: LoopQueue = LoopQueue()
 
 should_exit = False
 ready_to_exit = False
+_loop: asyncio.AbstractEventLoop|None = None
+_exit_event: asyncio.Event|None = None
+_instance_id = uuid.uuid4().hex # lets peers notice that we restarted and lost our session keys
 
 def pull_inbound_message() -> MessagePacket|None:
     try:
@@ -43,220 +137,779 @@ def generate_system_message(text: str):
 
 # A wrapper for ease of use
 class ChatConnection():
-    def __init__(self, to_username: str):
+    def __init__(self, to_username: str, channel: str = 'chat', store_undelivered: bool = True):
         self._user: User = Users.get_user_by_username(to_username)
+        self._channel = channel
+        self._store_undelivered = store_undelivered # messages to offline or unreachable users are kept in the outbox
+        self.unreachable = False
         self._encrypted = False
         if utils.get_setting('security.encryption.enabled', True):
             self._encrypted = True
-            self._g = utils.get_setting('security.encryption.parameter.g', DEFAULT_DH_G)
-            self._p = utils.get_setting('security.encryption.parameter.p', DEFAULT_DH_P)
+            self._group = key_exchange.get_configured_group()
+            # legacy peers only support (g, p) groups
+            self._g = self._group.g if self._group.g else DEFAULT_DH_G
+            self._p = self._group.p if self._group.p else DEFAULT_DH_P
         self.reset_private_key()
 
     def reset_private_key(self):
-        self._private_key = utils.generate_key()
-    async def send_message(self, message: Message):
+        self._private_key = key_exchange.generate_private_exponent(self._p) if self._encrypted else 0
+    async def send_message(self, message: Message, group: GroupPayload|None = None) -> bool:
+        """Returns True if the message was sent. If it wasn't because the user is offline or unreachable, `unreachable` is set."""
         if not self._user.is_active():
-            generate_system_message(f'Failed to send the message to {self._user.get_username()} because the user is offline.')
-            return
+            self._report_unreachable(message, f'Failed to send the message to {self._user.get_username()} because the user is offline.')
+            return False
         ip = self._user.get_ip()
+        breaker = circuit_breaker.breakers.get(ip)
+        if not breaker.allow():
+            self._report_unreachable(message, f'Failed to send the message to {self._user.get_username()}: {breaker.describe()}.')
+            return False
+        success = False
+        self._unreachable_error: utils.PeerUnreachableError|None = None
+        # transfer ids stay the same between attempts, so interrupted attachment transfers can be resumed
+        if group:
+            transfer_ids = group.transfer_ids
+        else:
+            transfer_ids = [file_transfer.generate_transfer_id() if file_transfer.should_stream(attachment) else None for attachment in message.get_attachments()]
+        for attempt in range(ATTACHMENT_TRANSFER_ATTEMPTS):
+            try:
+                connection = await connection_pool.pool.get(ip, MESSAGING_PORT, reconnect=attempt > 0, channel=self._channel)
+                if not connection:
+                    success = await self._send_legacy_message(message, ip)
+                    break
+            except utils.PeerUnreachableError as e:
+                self._unreachable_error = e
+                break
+            except Exception as e:
+                utils.print_error(f"Failed to connect to {ip}:", e)
+                break
+            success = await self._send_pooled_message(message, connection, transfer_ids, group)
+            if success or self._unreachable_error:
+                break
+        if success:
+            breaker.record_success()
+        elif self._unreachable_error:
+            breaker.record_failure(str(self._unreachable_error))
+            self._report_unreachable(message, f'Failed to send the message to {self._user.get_username()}: {ip} is unreachable ({self._unreachable_error}).')
+        else:
+            breaker.record_success() # the peer is reachable, sending failed for another reason
+            delivery.tracker.forget(self._user.get_username(), message.get_id())
+            generate_system_message("Failed to send the message.")
+        self.reset_private_key()
+        return success
+
+    def _report_unreachable(self, message: Message, failure_text: str):
+        self.unreachable = True
+        delivery.tracker.forget(self._user.get_username(), message.get_id()) # a retry that failed, the outbox takes over
+        if not self._store_undelivered:
+            return # it's already in the outbox
+        username = self._user.get_username()
+        if utils.get_setting('chat.outbox.enabled', True) and outbox.store.put(username, message, self._channel):
+            generate_system_message(f'{username} is offline or unreachable, the message will be sent when they are back online.')
+        else:
+            generate_system_message(failure_text)
+
+    async def send_messages(self, messages: list[Message]):
+        """Sends a burst of messages without attachments in one frame, or one after another if that isn't possible."""
+        if self._user.is_active():
+            ip = self._user.get_ip()
+            # the first message of a burst opens the connection, the next bursts use it
+            connection = connection_pool.pool.get_open(ip, MESSAGING_PORT, self._channel)
+            breaker = circuit_breaker.breakers.get(ip)
+            if connection and FEATURE_MESSAGE_BATCH in connection.features and breaker.state == circuit_breaker.STATE_CLOSED:
+                if await self._send_pooled_batch(messages, connection):
+                    breaker.record_success()
+                    return
+        for message in messages:
+            await self.send_message(message)
+
+    async def _send_pooled_batch(self, messages: list[Message], connection: PeerConnection) -> bool:
+        algorithm = compression.get_algorithm(connection.features)
+        try:
+            async with connection.lock:
+                batch: dict = {}
+                entries = []
+                if self._encrypted:
+                    session = await self._get_session(connection)
+                    batch['session'] = session.session_id
+                    for message in messages:
+                        cipher = session.use()
+                        payload = compression.generate_compressed_payload(message, cipher, [], algorithm) if algorithm else None
+                        entries.append(payload or utils.generate_encrypted_payload(message, cipher, []))
+                else:
+                    entries = [utils.generate_unencrypted_payload(message) for message in messages]
+                batch['messages'] = entries
+                await connection.send(FRAME_MESSAGE_BATCH, batch)
+            if FEATURE_MESSAGE_ACK in connection.features:
+                for message in messages:
+                    delivery.tracker.track(self._user.get_username(), self._channel, message, connection.ip)
+            metrics.increment('coalescing.frames')
+            metrics.increment('coalescing.messages', len(messages))
+            return True
+        except Exception as e:
+            # they are sent one by one instead, the receiver drops the ones that got through
+            utils.print_error(f"Failed to send {len(messages)} messages over the connection to {connection.ip}:", e)
+            await connection_pool.pool.discard(connection)
+            return False
+
+    async def _send_pooled_message(self, message: Message, connection: PeerConnection, transfer_ids: list[str|None], group: GroupPayload|None = None) -> bool:
+        if group and FEATURE_GROUP_CONTENT_KEY not in connection.features:
+            group = None # the peer can't decrypt a content key, the message is encrypted for it alone
+        algorithm = compression.get_algorithm(connection.features)
+        binary = FEATURE_BINARY_ATTACHMENTS in connection.features
+        start = time.monotonic()
+        try:
+            async with connection.lock:
+                if self._encrypted and group:
+                    session = await self._get_session(connection)
+                    cipher = session.use()
+                    streamed_transfer_ids = []
+                    for attachment, transfer_id in zip(message.get_attachments(), transfer_ids):
+                        if transfer_id:
+                            await file_transfer.send_attachment(connection, attachment, transfer_id, session, group)
+                            streamed_transfer_ids.append(transfer_id)
+                    payload = group.generate_payload(cipher, algorithm, binary)
+                    payload['session'] = session.session_id
+                    if streamed_transfer_ids:
+                        payload['attachment_transfers'] = streamed_transfer_ids
+                    if binary and group.get_inline_attachments():
+                        payload['binary_attachments'], parts = group.get_binary_attachments(algorithm)
+                        await connection.send_raw(FRAME_MESSAGE, *binary_payload.encode_payload(payload, parts), flags=binary_payload.FLAG_BINARY_SECTION)
+                    else:
+                        await connection.send(FRAME_MESSAGE, payload)
+                elif self._encrypted:
+                    session = await self._get_session(connection)
+                    cipher = session.use()
+                    inline_attachments = []
+                    streamed_transfer_ids = []
+                    for attachment, transfer_id in zip(message.get_attachments(), transfer_ids):
+                        if transfer_id and isinstance(cipher, ciphers.AEADCipher): # 3DES doesn't authenticate the chunk headers
+                            await file_transfer.send_attachment(connection, attachment, transfer_id, session, algorithm=algorithm)
+                            streamed_transfer_ids.append(transfer_id)
+                        else:
+                            inline_attachments.append(attachment)
+                    binary_attachments = inline_attachments if binary else []
+                    if binary_attachments:
+                        inline_attachments = []
+                    payload = None
+                    if algorithm:
+                        payload = compression.generate_compressed_payload(message, cipher, inline_attachments, algorithm)
+                    if payload is None:
+                        payload = utils.generate_encrypted_payload(message, cipher, inline_attachments)
+                    payload['session'] = session.session_id
+                    if streamed_transfer_ids:
+                        payload['attachment_transfers'] = streamed_transfer_ids
+                    if binary_attachments:
+                        payload['binary_attachments'], parts = binary_payload.encrypt_attachments(binary_attachments, cipher, algorithm)
+                        await connection.send_raw(FRAME_MESSAGE, *binary_payload.encode_payload(payload, parts), flags=binary_payload.FLAG_BINARY_SECTION)
+                    else:
+                        await connection.send(FRAME_MESSAGE, payload)
+                else:
+                    await connection.send(FRAME_MESSAGE, utils.generate_unencrypted_payload(message))
+            if FEATURE_MESSAGE_ACK in connection.features:
+                delivery.tracker.track(self._user.get_username(), self._channel, message, connection.ip)
+            return True
+        except Exception as e:
+            utils.print_error(f"Failed to send the message over the connection to {connection.ip}:", e)
+            if isinstance(e, utils.PeerUnreachableError):
+                self._unreachable_error = e
+            elif isinstance(e, TimeoutError): # no reply to a request
+                self._unreachable_error = utils.PeerUnreachableError(f'no reply after {time.monotonic() - start:.1f} s')
+            await connection_pool.pool.discard(connection)
+            return False
+
+    async def _get_session(self, connection: PeerConnection) -> SessionKey:
+        # only the first message of a session needs a key exchange
+        username = self._user.get_username()
+        session = session_keys.store.get_outgoing(username, self._group.get_id(), connection.peer_instance)
+        if session is None or session.session_id in connection.rejected_sessions:
+            session_id = session_keys.generate_session_id()
+            shared_key = await connection.exchange_keys(self._group, session_id)
+            session = SessionKey(session_id, shared_key, connection.peer_instance, connection.cipher_name)
+            session_keys.store.set_outgoing(username, self._group.get_id(), session)
+        return session
+
+    async def _send_legacy_message(self, message: Message, ip: str) -> bool:
         if self._encrypted:
             if utils.get_setting('security.encryption.forced', not FALLBACK_TO_PLAINTEXT):
-                success = await utils.send_encrypted_message(message, ip, MESSAGING_PORT, self._private_key, g=self._g, p=self._p)
+                return await utils.send_encrypted_message(message, ip, MESSAGING_PORT, self._private_key, g=self._g, p=self._p)
             else:
-                success = await utils.send_encrypted_message_with_fallback(message, ip, MESSAGING_PORT, self._private_key, g=self._g, p=self._p)
-            if not success:
-                generate_system_message("Failed to send the message.")
+                return await utils.send_encrypted_message_with_fallback(message, ip, MESSAGING_PORT, self._private_key, g=self._g, p=self._p)
         else:
-            await utils.send_unencrypted_text(message.get_text_content(), ip, MESSAGING_PORT)
-        self.reset_private_key()
+            return await utils.send_unencrypted_text(message.get_text_content(), ip, MESSAGING_PORT, message.get_id())
+
+announce_scheduler = AnnounceScheduler()
+_last_legacy_broadcast_time = -LEGACY_DISCOVERY_TIMEOUT
+_broadcast_transport: asyncio.DatagramTransport|None = None
+_discovery_transport: asyncio.DatagramTransport|None = None
 
 async def broadcast_send_service():
+    global _broadcast_transport
+    # one socket is used for every broadcast
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        asyncio.DatagramProtocol, local_addr=(BIND_ADDRESS, 0) if BIND_ADDRESS else None,
+        family=socket.AF_INET, proto=socket.IPPROTO_UDP, allow_broadcast=True
+    )
+    _broadcast_transport = transport
+    events.on_event('on_username_changed', lambda *_: _loop and _loop.call_soon_threadsafe(announce_scheduler.request_announce))
+    legacy_task = asyncio.create_task(_legacy_broadcast_service(transport))
+    try:
+        while True:
+            username = utils.get_current_username()
+            if not utils.validate_username(username):
+                utils.print_warning("Detected invalid username.")
+                generate_system_message("Please set a valid username with the '/username' command.")
+            while not utils.validate_username(username):
+                username = utils.get_current_username()
+                await asyncio.sleep(1)
+            interval = announce_scheduler.get_interval(presence.tracker.get_online_count())
+            address = (SERVICE_BROADCAST_IP, SERVICE_BROADCAST_PORT)
+            transport.sendto(encode_presence(PRESENCE_ANNOUNCE, username, interval), address)
+            metrics.increment('discovery.datagrams.sent')
+            for peer in STATIC_PEERS:
+                transport.sendto(encode_presence(PRESENCE_ANNOUNCE, username, interval), (peer, DISCOVERY_PORT))
+                metrics.increment('discovery.datagrams.sent')
+            utils.print_info("Sent service broadcast on", address)
+            await announce_scheduler.wait(announce_scheduler.get_delay(interval))
+    finally:
+        legacy_task.cancel()
+        _broadcast_transport = None
+        transport.close()
+
+async def _legacy_broadcast_service(transport: asyncio.DatagramTransport):
+    # older clients only understand JSON, and don't follow the adaptive interval of the binary announcements
     while True:
         username = utils.get_current_username()
-        if not utils.validate_username(username):
-            utils.print_warning("Detected invalid username.")
-            generate_system_message("Please set a valid username with the '/username' command.")
-        while not utils.validate_username(username):
-            username = utils.get_current_username()
-            await asyncio.sleep(1)
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.sendto((json.dumps({"username": username})).encode(), (SERVICE_BROADCAST_IP, SERVICE_BROADCAST_PORT))
-            utils.print_info("Sent service broadcast on", (SERVICE_BROADCAST_IP, SERVICE_BROADCAST_PORT))
-        await asyncio.sleep(8)
+        if time.monotonic() - _last_legacy_broadcast_time < LEGACY_DISCOVERY_TIMEOUT and utils.validate_username(username):
+            transport.sendto((json.dumps({"username": username})).encode(), (SERVICE_BROADCAST_IP, SERVICE_BROADCAST_PORT))
+            metrics.increment('discovery.datagrams.sent')
+        await asyncio.sleep(LEGACY_BROADCAST_INTERVAL)
+
+def _send_goodbye():
+    username = utils.get_current_username()
+    if _broadcast_transport and utils.validate_username(username):
+        for address in [(SERVICE_BROADCAST_IP, SERVICE_BROADCAST_PORT)] + [(peer, DISCOVERY_PORT) for peer in STATIC_PEERS]:
+            _broadcast_transport.sendto(encode_presence(PRESENCE_GOODBYE, username, 0), address)
+            metrics.increment('discovery.datagrams.sent')
+
+def _send_hello(ip: str, legacy: bool):
+    username = utils.get_current_username()
+    if not _discovery_transport or not utils.validate_username(username):
+        return
+    if legacy:
+        data = json.dumps({"username": username}).encode()
+    else:
+        data = encode_presence(PRESENCE_HELLO, username, announce_scheduler.get_interval(presence.tracker.get_online_count()))
+    _discovery_transport.sendto(data, (ip, DISCOVERY_PORT))
+    metrics.increment('discovery.datagrams.sent')
 
 def generate_online_message(user: User):
     if user.is_remote():
         generate_system_message(f'User {user.get_username()} is now online!')
+        outbox.store.flush(user.get_username())
     push_event('on_user_online', user)
 
-async def broadcast_recieve_service():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    sock.setblocking(False)
-    sock.bind(('', DISCOVERY_PORT))
-    utils.print_info("Listening for service broadcast messages on port %d :" % (DISCOVERY_PORT))
-    while not should_exit:
-        try:
-            data, (ip, port) = sock.recvfrom(256)
-            utils.print_info("Broadcast received from", ip, port)
+def _handle_broadcast(data: bytes, ip: str) -> bool:
+    global _last_legacy_broadcast_time
+    utils.print_info("Broadcast received from", ip)
+    if len(data) > MAX_BROADCAST_SIZE:
+        return False
+    timeout = PRESENCE_TIMEOUT
+    kind = PRESENCE_ANNOUNCE
+    legacy = False
+    try:
+        if is_binary_presence(data):
+            kind, username, interval = decode_presence(data)
+            if kind not in (PRESENCE_ANNOUNCE, PRESENCE_HELLO, PRESENCE_GOODBYE):
+                return False
+            timeout = max(PRESENCE_TIMEOUT, min(interval, MAX_BROADCAST_INTERVAL) * PRESENCE_TIMEOUT_FACTOR)
+        else:
+            legacy = True
             decoded_data = json.loads(data.decode())
             username = decoded_data["username"]
-            assert(utils.validate_username(username))
-            current_time = time.time()
-            if Users.check_username(username):
-                user: User = Users.get_user_by_username(username)
-                if (user.get_last_seen() + SERVICE_BROADCAST_INTERVAL) > current_time:
-                    if ip == user.get_ip():
-                        user.set_ip(ip)
-                        user.update_last_seen()
-                        if not user.is_active():
-                            generate_online_message(user)
-                    else:
-                        utils.print_warning("Skipped suspicious broadcast. Old ip: %s, New address: %s." % (user.get_ip(), ip))
-                else:
-                    user.set_ip(ip)
-                    user.update_last_seen()
-            else:
-                user = Users.create_user(username, local = utils.get_current_username() == username)
-                user.set_ip(ip)
-                user.update_last_seen()
-                push_event('on_new_user', user)
-                generate_online_message(user)
-        except OSError as e:
-            pass # 99.9% socket blocking errors
-        except Exception as e:
-            utils.print_error("Exception while handling incoming broadcast:", e)
-        finally:
-            await asyncio.sleep(0.1)
+            if username != utils.get_current_username():
+                _last_legacy_broadcast_time = time.monotonic()
+    except (ValueError, TypeError, KeyError):
+        return False
+    if not utils.validate_username(username):
+        return False
+    if kind == PRESENCE_GOODBYE:
+        if Users.check_username(username):
+            user = Users.get_user_by_username(username)
+            if user.has_ip() and user.get_ip() == ip and user.is_remote():
+                presence.tracker.set_offline(user)
+                return True
+        return False
+    if Users.check_username(username):
+        user: User = Users.get_user_by_username(username)
+        if user.is_active() and ip != user.get_ip():
+            utils.print_warning("Skipped suspicious broadcast. Old ip: %s, New address: %s." % (user.get_ip(), ip))
+            return False
+        user.set_ip(ip)
+    else:
+        user = Users.create_user(username, local = utils.get_current_username() == username)
+        user.set_ip(ip)
+        push_event('on_new_user', user)
+    if presence.tracker.seen(user, timeout):
+        generate_online_message(user)
+        # a hello is never answered, so two clients can't keep replying to each other
+        if kind == PRESENCE_ANNOUNCE and user.is_remote():
+            _send_hello(ip, legacy)
+    return True
+
+async def broadcast_recieve_service():
+    global _discovery_transport
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: DiscoveryProtocol(_handle_broadcast),
+        local_addr=(BIND_ADDRESS or '0.0.0.0', DISCOVERY_PORT), family=socket.AF_INET, allow_broadcast=True
+    )
+    _discovery_transport = transport
+    utils.print_info("Listening for service broadcast messages on port %d :" % (DISCOVERY_PORT))
+    try:
+        await wait_for_exit()
+    finally:
+        _discovery_transport = None
+        transport.close()
 
 async def broadcast_service():
     asyncio.create_task(broadcast_recieve_service())
     asyncio.create_task(broadcast_send_service())
-    
-    while not should_exit:
-        await asyncio.sleep(0.01)
+
+    await wait_for_exit()
+
+def _get_peer_ip(writer: asyncio.StreamWriter) -> str:
+    addr = writer.get_extra_info('peername')
+    if len(addr) == 2:  # IPv4
+        ip, _ = addr
+    elif len(addr) == 4:  # IPv6
+        ip, _, _, _ = addr
+    else:
+        raise RuntimeError("Unknown address type")
+    return ip
+
+# Parsing, decrypting and decompressing large messages runs on these threads, so a large attachment
+# doesn't stop the event loop from serving discovery, sends and other connections meanwhile.
+_receive_executor = ThreadPoolExecutor(max_workers=RECEIVE_WORKERS, thread_name_prefix='receive')
+
+async def _run_receive_stage(size: int, function: Callable, *args):
+    """Runs `function(*args)` on a receive thread if it handles at least RECEIVE_OFFLOAD_SIZE bytes, otherwise right away."""
+    if size < RECEIVE_OFFLOAD_SIZE:
+        return function(*args)
+    metrics.increment('receive.offloaded')
+    metrics.increment('receive.offloaded_bytes', size)
+    return await asyncio.get_running_loop().run_in_executor(_receive_executor, function, *args)
+
+def _parse_legacy_object(data: bytearray) -> dict:
+    try:
+        decoded_object = json.loads(utils.decode_arbitrary_data(data))
+    except ValueError as e:
+        raise ProtocolError(f'Invalid legacy packet: {e}')
+    if not isinstance(decoded_object, dict):
+        raise ProtocolError('Expected a JSON object')
+    return decoded_object
+
+async def _read_legacy_object(reader: asyncio.StreamReader, prefix: bytes, ip: str) -> tuple[dict, int]:
+    """Returns the object and its size in bytes."""
+    timeout = 5
+    data = bytearray(prefix)
+    while not reader.at_eof():
+        chunk = await asyncio.wait_for(reader.read(MAX_PACKET_SIZE), timeout=timeout)
+        await admission.controller.throttle(ip, len(chunk))
+        timeout *= 0.99999 # to prevent large files (that can't be received in a short time) from being received
+        data += chunk
+        if len(data) > MAX_LEGACY_PACKET_SIZE:
+            raise ProtocolError("Legacy packet is too large.")
+        # a complete JSON object can only end with a closing brace, so only then is it worth parsing
+        if chunk.rstrip(b' \t\r\n\x00').endswith(b'}'):
+            try:
+                return await _run_receive_stage(len(data), _parse_legacy_object, data), len(data)
+            except:
+                pass
+    return await _run_receive_stage(len(data), _parse_legacy_object, data), len(data)
+
+async def _generate_key_exchange_reply(decoded_object: dict) -> tuple[dict, int]:
+    group = key_exchange.get_group_from_dict(decoded_object, default_g=DH_G, default_p=DH_P)
+    if group.name == 'custom':
+        if group.g != DEFAULT_DH_G:
+            utils.print_info("Non-standard Diffie Hellman paramater, g: ", group.g)
+        if group.p != DEFAULT_DH_P:
+            utils.print_info("Non-standard Diffie Hellman paramater, p: ", group.p)
+    keypair = await key_exchange.pool.get(group)
+    shared_key = await key_exchange.compute_shared_key(keypair, str(decoded_object["key"]))
+    reply = {"key": keypair.public_key, **group.to_dict()}
+    if 'ciphers' in decoded_object: # older clients don't negotiate and only support 3DES
+        reply['cipher'] = ciphers.negotiate_cipher(decoded_object['ciphers'])
+    return reply, shared_key
+
+def _is_duplicate(decoded_object: dict, user: User, ip: str) -> bool:
+    message_id = delivery.get_message_id(decoded_object)
+    if message_id is None or delivery.received_ids.add(user.get_username(), message_id):
+        return False
+    utils.print_info(f"Dropped a duplicate of message {message_id} from {user.get_username()}.")
+    for transfer_id in decoded_object.get('attachment_transfers', []): # the attachments were sent again too
+        attachment = file_transfer.pop_completed_attachment(str(transfer_id), ip)
+        path = attachment.get_path() if attachment else None
+        if path and os.path.exists(path):
+            os.remove(path)
+    return True
+
+def _forget_received(decoded_object: dict, user: User):
+    """Called when a message that passed `_is_duplicate` couldn't be decoded. It isn't acknowledged, so the retry must not count as a duplicate."""
+    message_id = delivery.get_message_id(decoded_object)
+    if message_id is not None:
+        delivery.received_ids.discard(user.get_username(), message_id)
+
+def _decrypt_content(decoded_object: dict, cipher: ciphers.SessionCipher|None, binary_section: memoryview|None = None) -> tuple[str, list[Attachment]]:
+    """Returns the text and the inline attachments of a message. Doesn't touch shared state, so it can run on a receive thread."""
+    text_content = ""
+    attachments = list()
+    if "unencrypted_message" in decoded_object:
+        text = decoded_object["unencrypted_message"]
+        assert(type(text) == type(''))
+        text_content = text
+    if "encrypted_content" in decoded_object: # sent to several users at once
+        if cipher:
+            content = group_send.decrypt_content(decoded_object, cipher)
+            if isinstance(content.get('message'), str):
+                text_content = content['message']
+            for attachment_dict in content.get('attachments', []):
+                if isinstance(attachment_dict, dict):
+                    attachments.append(Attachment.from_dict(attachment_dict))
+    if "compressed_content" in decoded_object:
+        if cipher:
+            content = compression.decompress_content(decoded_object, cipher)
+            if isinstance(content.get('message'), str):
+                text_content = content['message']
+            for attachment_dict in content.get('attachments', []):
+                if isinstance(attachment_dict, dict):
+                    attachments.append(Attachment.from_dict(attachment_dict))
+    if "encrypted_message" in decoded_object:
+        if cipher:
+            cypher_text = decoded_object["encrypted_message"]
+            if isinstance(cypher_text, str):
+                text_content = cipher.decrypt_text(cypher_text)
+    if 'attachments' in decoded_object:
+        for attachment_dict in decoded_object['attachments']:
+            if isinstance(attachment_dict, dict):
+                attachments.append(Attachment.from_dict(attachment_dict))
+    if 'encrypted_attachments' in decoded_object:
+        if cipher:
+            for encrypted_attachment in decoded_object['encrypted_attachments']:
+                if isinstance(encrypted_attachment, str):
+                    attachments.append(Attachment.from_str(cipher.decrypt_text(encrypted_attachment)))
+    if 'binary_attachments' in decoded_object:
+        if cipher and binary_section is not None:
+            binary_cipher = group_send.get_content_cipher(decoded_object, cipher) if 'content_key' in decoded_object else cipher
+            attachments += binary_payload.decrypt_attachments(decoded_object['binary_attachments'], binary_section, binary_cipher)
+    return text_content, attachments
+
+def _build_message(decoded_object: dict, user: User, ip: str, content: tuple[str, list[Attachment]]) -> Message:
+    text_content, attachments = content
+    metadata = dict()
+    author = user.get_username()
+    if 'attachment_transfers' in decoded_object:
+        for transfer_id in decoded_object['attachment_transfers']:
+            attachment = file_transfer.pop_completed_attachment(str(transfer_id), ip)
+            if attachment:
+                attachments.append(attachment)
+    if 'metadata' in decoded_object:
+        if isinstance(decoded_object['metadata'], dict):
+            metadata = decoded_object['metadata']
+    if 'author' in decoded_object:
+        if isinstance(decoded_object['author'], str):
+            author = decoded_object['author']
+            if Users.check_username(author):
+                user2 = Users.get_user_by_username(author)
+                if user2.has_ip() and user2.get_ip() == ip:
+                    pass
+                else:
+                    author = user.get_username()
+            else:
+                author = user.get_username()
+    timestamp = delivery.get_message_timestamp(decoded_object)
+    if timestamp is not None: # the clocks of the two computers may differ a bit
+        metrics.increment('delivery.received')
+        metrics.increment('delivery.latency_seconds', max(0.0, time.time() - timestamp))
+    return Message(author, text_content, attachments, metadata, delivery.get_message_id(decoded_object), timestamp)
+
+async def _decode_message(decoded_object: dict, user: User, ip: str, cipher: ciphers.SessionCipher|None, binary_section: memoryview|None = None, size: int = 0) -> Message:
+    """`size` is the size of the received data, large messages are decrypted on a receive thread."""
+    content = await _run_receive_stage(size, _decrypt_content, decoded_object, cipher, binary_section)
+    return _build_message(decoded_object, user, ip, content)
+
+def _decrypt_batch(entries: list[tuple[dict, ciphers.SessionCipher|None]]) -> list[tuple[str, list[Attachment]]]:
+    return [_decrypt_content(entry, cipher) for entry, cipher in entries]
+
+def _get_cipher(decoded_object: dict, user: User, connection: PeerConnection) -> ciphers.SessionCipher|None:
+    if 'session' in decoded_object:
+        return session_keys.store.get_incoming(user.get_username(), str(decoded_object['session'])).use()
+    if connection.shared_key:
+        return ciphers.get_cipher(connection.cipher_name, connection.shared_key)
+    return None
+
+async def _serve_persistent_connection(connection: PeerConnection):
+    timeout = CONNECTION_IDLE_TIMEOUT + CONNECTION_HEALTH_CHECK_INTERVAL
+    while connection.is_alive():
+        try:
+            frame = await connection.receive_frame(timeout=timeout)
+        except TimeoutError:
+            utils.print_info("Closing idle connection from", connection.ip)
+            break
+        if frame is None:
+            break
+        frame_type, flags, payload = frame
+        if frame_type == FRAME_BYE:
+            break
+        request_id = None
+        try:
+            if frame_type == FRAME_FILE_CHUNK:
+                file_transfer.handle_chunk(connection.ip, payload, flags)
+                continue
+            binary_section = None
+            # the payload is only read again after this is done, so it can be parsed on a receive thread
+            if frame_type == FRAME_MESSAGE and flags & binary_payload.FLAG_BINARY_SECTION:
+                decoded_object, binary_section = await _run_receive_stage(len(payload), binary_payload.decode_payload, payload)
+            else:
+                decoded_object = await _run_receive_stage(len(payload), decode_json_payload, payload)
+            request_id = decoded_object.get('rid')
+            if frame_type == FRAME_PING:
+                await connection.send(FRAME_PONG, {'rid': request_id})
+                continue
+            if admission.controller.is_blocked(connection.ip):
+                break
+            if frame_type == FRAME_CHANNEL_REPAIR: # the datagrams are encrypted with the channel key, members that weren't discovered yet get them too
+                reply = channels.manager.handle_repair_request(decoded_object)
+                reply['rid'] = request_id
+                await connection.send(FRAME_CHANNEL_REPAIR, reply)
+                continue
+            user = Users.get_user_by_ip(connection.ip)
+            if not user:
+                raise RuntimeWarning("Unknown user.")
+            if frame_type == FRAME_KEY_EXCHANGE:
+                reply, connection.shared_key = await _generate_key_exchange_reply(decoded_object)
+                connection.cipher_name = ciphers.get_negotiated_cipher(reply)
+                if 'session' in decoded_object:
+                    session_keys.store.add_incoming(user.get_username(), SessionKey(str(decoded_object['session']), connection.shared_key, cipher_name=connection.cipher_name))
+                reply['rid'] = request_id
+                await connection.send(FRAME_KEY_EXCHANGE, reply)
+            elif frame_type == FRAME_FILE_OFFER:
+                reply = file_transfer.handle_offer(connection.ip, decoded_object, _get_cipher(decoded_object, user, connection))
+                reply['rid'] = request_id
+                await connection.send(FRAME_FILE_OFFER, reply)
+            elif frame_type == FRAME_FILE_END:
+                reply = file_transfer.handle_end(connection.ip, decoded_object)
+                reply['rid'] = request_id
+                await connection.send(FRAME_FILE_END, reply)
+            elif frame_type == FRAME_MESSAGE:
+                cipher = _get_cipher(decoded_object, user, connection) # before it's marked as received, an unknown session is sent again
+                if not _is_duplicate(decoded_object, user, connection.ip):
+                    try:
+                        message = await _decode_message(decoded_object, user, connection.ip, cipher, binary_section, len(payload))
+                    except Exception:
+                        _forget_received(decoded_object, user)
+                        raise
+                    push_inbound_message(MessagePacket(message, ['<localhost>']))
+                message_id = delivery.get_message_id(decoded_object)
+                if message_id is not None:
+                    await connection.send(FRAME_ACK, {'ids': [message_id]})
+            elif frame_type == FRAME_MESSAGE_BATCH:
+                message_ids = []
+                received = []
+                try:
+                    if not isinstance(decoded_object.get('messages'), list):
+                        raise FrameError('Invalid message batch')
+                    for entry in decoded_object['messages']: # in the order they were written
+                        if not isinstance(entry, dict):
+                            raise FrameError('Invalid message in a batch')
+                        if 'session' in decoded_object:
+                            entry['session'] = decoded_object['session']
+                        cipher = _get_cipher(entry, user, connection)
+                        if not _is_duplicate(entry, user, connection.ip):
+                            received.append((entry, cipher))
+                        message_id = delivery.get_message_id(entry)
+                        if message_id is not None:
+                            message_ids.append(message_id)
+                    contents = await _run_receive_stage(len(payload), _decrypt_batch, received) # the whole batch in one go
+                    messages = [_build_message(entry, user, connection.ip, content) for (entry, _), content in zip(received, contents)]
+                except Exception:
+                    # nothing of the batch is acknowledged, so none of it may count as received
+                    for entry, _ in received:
+                        _forget_received(entry, user)
+                    raise
+                for message in messages:
+                    push_inbound_message(MessagePacket(message, ['<localhost>']))
+                if message_ids: # one ack for the whole batch
+                    await connection.send(FRAME_ACK, {'ids': message_ids})
+            else:
+                utils.print_warning(f"Ignored unknown frame type {frame_type} from {connection.ip}")
+        except ConnectionError:
+            raise
+        except UnknownSessionError as e:
+            utils.print_warning(e)
+            await connection.send(FRAME_REKEY, {'session': decoded_object['session'], 'rid': request_id})
+        except Exception as e:
+            utils.print_error(f"Exception while handling a request from {connection.ip}:", e)
+            _report_bad_request(connection.ip, e)
+            if request_id is not None:
+                await connection.send(FRAME_ERROR, {'error': str(e), 'rid': request_id})
+
+def _report_bad_request(ip: str, error: Exception):
+    # refusals (a full disk, too many transfers), local failures and users that aren't discovered yet don't count against the address
+    if isinstance(error, ProtocolError):
+        admission.controller.report_violation(ip, 'malformed')
 
 async def handle_message_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    connection = None
+    ip = None
+    admitted = False
     try:
-        addr = writer.get_extra_info('peername')
-        utils.print_info("Incoming TCP request from", addr)
-        ip: str = ''
-        if len(addr) == 2:  # IPv4
-            ip, _ = addr
-        elif len(addr) == 4:  # IPv6
-            ip, _, _, _ = addr
-        else:
-            raise RuntimeError("Unknown address type")
-        if ip in blocklist:
+        utils.print_info("Incoming TCP request from", writer.get_extra_info('peername'))
+        ip = _get_peer_ip(writer)
+        admitted = admission.controller.admit(ip)
+        if not admitted:
+            return
+        try:
+            prefix = await asyncio.wait_for(reader.readexactly(len(FRAME_MAGIC)), timeout=5)
+        except asyncio.IncompleteReadError as e:
+            prefix = e.partial
+        if prefix == FRAME_MAGIC: # persistent connection
+            # frames are charged to the address before their payload is read, so a large header can't get past the limits
+            connection = PeerConnection(ip, MESSAGING_PORT, reader, writer, inbound=True, prefix=prefix, charge=lambda byte_count: admission.controller.throttle(ip, byte_count))
+            connection_pool.pool.register_inbound(connection)
+            frame = await connection.receive(timeout=5)
+            if frame is None or frame[0] != FRAME_HELLO:
+                raise FrameError("Expected a hello frame.")
+            await connection.send(FRAME_HELLO, {'version': PROTOCOL_VERSION, 'instance': _instance_id, 'features': SUPPORTED_FEATURES, 'rid': frame[1].get('rid')})
+            await _serve_persistent_connection(connection) # looks up the user for each request, channel repairs don't need one
             return
         user = Users.get_user_by_ip(ip)
         if not user:
-            raise RuntimeError("Unknown user.")
-        username: str = user.get_username()
-        timeout = 5
-        data = b''
-        while True:
-            data = data + await asyncio.wait_for(reader.read(MAX_PACKET_SIZE), timeout=timeout)
-            timeout *= 0.99999 # to prevent large files (that can't be received in a short time) from being received
-            # TODO: Do better and lighter checks
-            if reader.at_eof():
-                break
-            try:
-                json.loads(utils.decode_arbitrary_data(data))
-                break
-            except:
-                pass
-        decoded_data = utils.decode_arbitrary_data(data)
-        decoded_object = json.loads(decoded_data)
-        dh_params = utils.extract_diffie_hellman_parameters_from_dict(decoded_object, default_g=DH_G, default_p=DH_P)
-        g, p = dh_params['g'], dh_params['p']
-        if g != DEFAULT_DH_G:
-            utils.print_info("Non-standard Diffie Hellman paramater, g: ", g)
-        if p != DEFAULT_DH_P:
-            utils.print_info("Non-standard Diffie Hellman paramater, p: ", p)
+            raise RuntimeWarning("Unknown user.")
+        decoded_object, size = await _read_legacy_object(reader, prefix, ip)
+        shared_key = user.get_shared_key() if user.has_shared_key() else 0
         if "key" in decoded_object: # diffie hellman key exhange + maybe encrypted message
-            their_public_key = int(decoded_object["key"])
-            private_key = utils.generate_key()
-            public_key: int = (g ** private_key) % p
-            shared_key: int = (their_public_key ** private_key) % p
+            reply, shared_key = await _generate_key_exchange_reply(decoded_object)
             user.set_shared_key(shared_key)
-            writer.write(json.dumps({"key": str(public_key), 'g': g, 'p': p}).encode(encoding='utf-8'))
+            writer.write(json.dumps(reply).encode(encoding='utf-8'))
             writer.write_eof()
             await writer.drain()
             try:
                 if not (writer.is_closing() or reader.at_eof()): # in case if they still keep the connection
                     data2 = await asyncio.wait_for(reader.read(MAX_PACKET_SIZE), timeout=5)
-                    decoded_data2 = utils.decode_arbitrary_data(data2)
-                    decoded_object2 = json.loads(decoded_data2)
+                    decoded_object2 = await _run_receive_stage(len(data2), _parse_legacy_object, data2)
+                    size += len(data2)
                     if 'encrypted_message' in decoded_object2:
                         decoded_object['encrypted_message'] = decoded_object2['encrypted_message']
                     if 'encrypted_attachments' in decoded_object2:
                         decoded_object['encrypted_attachments'] = decoded_object2['encrypted_attachments']
             except Exception as e2:
                 pass
-        text_content = ""
-        attachments = list()
-        metadata = dict()
-        author = username
-        if "unencrypted_message" in decoded_object:
-            text = decoded_object["unencrypted_message"]
-            assert(type(text) == type(''))
-            text_content = text
-        if "encrypted_message" in decoded_object:
-            shared_key = user.get_shared_key()
-            if shared_key:
-                cypher_text = decoded_object["encrypted_message"]
-                if isinstance(cypher_text, str):
-                    text_content = utils.decrypt_text(cypher_text, shared_key)
-        if 'attachments' in decoded_object:
-            for attachment_dict in decoded_object['attachments']:
-                if isinstance(attachment_dict, dict):
-                    attachments.append(Attachment.from_dict(attachment_dict))
-        if 'encrypted_attachments' in decoded_object:
-            shared_key = user.get_shared_key()
-            if shared_key:
-                for encrypted_attachment in decoded_object['encrypted_attachments']:
-                    if isinstance(encrypted_attachment, str):
-                        attachments.append(Attachment.from_str(utils.decrypt_text(encrypted_attachment, shared_key)))
-        if 'metadata' in decoded_object:
-            if isinstance(decoded_object['metadata'], dict):
-                metadata = decoded_object['metadata']
-        if 'author' in decoded_object:
-            if isinstance(decoded_object['author'], str):
-                author = decoded_object['author']
-                if Users.check_username(author):
-                    user2 = Users.get_user_by_username(author)
-                    if user2.has_ip() and user2.get_ip() == ip:
-                        pass
-                    else:
-                        author = username
-                else:
-                    author = username
-        message = Message(author, text_content, attachments, metadata)
-        push_inbound_message(MessagePacket(message, ['<localhost>']))
+        if not _is_duplicate(decoded_object, user, ip): # the legacy fallbacks may send the same message twice
+            try:
+                message = await _decode_message(decoded_object, user, ip, ciphers.get_cipher(ciphers.CIPHER_3DES, shared_key) if shared_key else None, size=size)
+            except Exception:
+                _forget_received(decoded_object, user)
+                raise
+            push_inbound_message(MessagePacket(message, ['<localhost>']))
     except Exception as e:
         utils.print_error("Exception while handling TCP request:", e)
+        if admitted and ip:
+            _report_bad_request(ip, e)
     finally:
-        if writer:
+        if connection:
+            await connection_pool.pool.discard(connection)
+        elif writer:
             await utils.close_stream(writer)
+        if admitted and ip:
+            admission.controller.release(ip)
+
+async def _send_to_peer(username: str, item: Message|GroupPayload|list[Message], channel: str):
+    if isinstance(item, list): # a burst, coalesced by the peer sender
+        messages = item
+    else:
+        messages = [item.message if isinstance(item, GroupPayload) else item]
+    try:
+        if outbox.store.has_messages(username): # older messages are waiting to be sent, these go after them
+            for message in messages:
+                delivery.tracker.forget(username, message.get_id())
+                if outbox.store.put(username, message, channel):
+                    outbox.store.flush(username)
+                else:
+                    generate_system_message(f'Failed to send the message to {username} because the outbox is full.')
+        elif isinstance(item, list):
+            await ChatConnection(username, channel).send_messages(item)
+        elif isinstance(item, GroupPayload):
+            await ChatConnection(username, channel).send_message(item.message, item)
+        else:
+            await ChatConnection(username, channel).send_message(item)
+    finally:
+        if isinstance(item, GroupPayload):
+            item.release()
+
+def _resend_unacknowledged(username: str, message: Message, channel: str) -> bool:
+    return Users.check_username(username) and peer_senders.enqueue(username, message, LANE_BULK if channel == 'bulk' else LANE_CHAT)
+
+def _on_delivery_failed(username: str, message: Message):
+    generate_system_message(f'{username} did not confirm receiving the message after {MAX_DELIVERY_ATTEMPTS} attempts.')
+
+async def _send_stored_message(username: str, message: Message, channel: str) -> bool:
+    """Sends a message from the outbox. Returns False if the user couldn't be reached, the message is kept then."""
+    if not Users.check_username(username) or not Users.get_user_by_username(username).is_active():
+        return False
+    connection = ChatConnection(username, channel, store_undelivered=False)
+    return await connection.send_message(message) or not connection.unreachable
+
+peer_senders = PeerSenders(_send_to_peer)
+
+def _get_lane(message_packet: MessagePacket) -> str:
+    if message_packet.lane in (LANE_CHAT, LANE_BULK):
+        return message_packet.lane
+    for attachment in message_packet.message.get_attachments():
+        if file_transfer.should_stream(attachment):
+            return LANE_BULK
+    return LANE_CHAT
 
 async def outbound_message_server():
     while not should_exit:
-        message_packet: MessagePacket|None = pull_outbound_message()
-        if message_packet:
-            if message_packet.is_inbound():
-                push_inbound_message(message_packet)
-            async with asyncio.TaskGroup() as task_group:
-                for receiver in message_packet.get_outbound_receivers():
-                    if Users.check_username(receiver):
-                        connection = ChatConnection(receiver)
-                        task_group.create_task(connection.send_message(message_packet.message))
-        else:
-            await asyncio.sleep(0.01)
+        message_packet: MessagePacket|None = await outbound_message_queue.get()
+        if message_packet is None: # pushed by exit()
+            break
+        if message_packet.is_inbound():
+            push_inbound_message(message_packet)
+        for channel_name in message_packet.get_channels():
+            if Users.check_username('#' + channel_name):
+                continue # a user, not a channel
+            try:
+                channels.manager.send(channel_name, message_packet.message)
+            except Exception as e:
+                generate_system_message(f'Failed to send the message to #{channel_name}: {e}')
+        lane = _get_lane(message_packet)
+        receivers = []
+        for receiver in message_packet.get_outbound_receivers():
+            if Users.check_username(receiver):
+                receivers.append(receiver)
+            elif receiver[1:] not in message_packet.get_channels():
+                _store_for_removed_user(receiver, message_packet.message, 'bulk' if lane == LANE_BULK else 'chat')
+        item: Message|GroupPayload = message_packet.message
+        if len(receivers) > 1 and utils.get_setting('security.encryption.enabled', True):
+            item = GroupPayload(message_packet.message, len(receivers)) # encrypted once for every receiver
+        for receiver in receivers:
+            if not peer_senders.enqueue(receiver, item, lane):
+                generate_system_message(f'Failed to send the message to {receiver} because too many messages are waiting to be sent.')
+                if isinstance(item, GroupPayload):
+                    item.release()
+    peer_senders.stop()
+
+def _store_for_removed_user(username: str, message: Message, channel: str):
+    # users that were offline for long are removed, a tombstone or their stored messages say that they existed
+    if not (presence.tracker.get_tombstone(username) or outbox.store.has_messages(username)):
+        generate_system_message(f'Failed to send the message to {username}: unknown user.')
+    elif utils.get_setting('chat.outbox.enabled', True) and outbox.store.put(username, message, channel):
+        generate_system_message(f'{username} is offline, the message will be sent when they are back online.')
+    else:
+        generate_system_message(f'Failed to send the message to {username} because the user is offline.')
 
 async def run_messaging_server():
-    server = await asyncio.start_server(handle_message_client, '', MESSAGING_PORT)
+    server = await asyncio.start_server(handle_message_client, BIND_ADDRESS, MESSAGING_PORT)
     async with server:
         await server.start_serving()
         await outbound_message_server()
@@ -264,16 +917,63 @@ async def run_messaging_server():
 async def messaging_service():
     await run_messaging_server()
 
+def _on_channel_message(message: Message, channel_name: str):
+    metadata = message.get_metadata()
+    metadata['channel'] = channel_name
+    push_inbound_message(MessagePacket(Message(message.get_author_username(), message.get_text_content(), message.get_attachments(), metadata, message.get_id(), message.get_timestamp()), ['<localhost>']))
+
+def call_in_loop(callback, *args):
+    """Runs `callback` in the asyncio loop and returns its result. For commands, which run in the tkinter thread."""
+    assert _loop, 'message_server.main() is not running'
+    async def run():
+        return callback(*args)
+    return asyncio.run_coroutine_threadsafe(run(), _loop).result(timeout=CONNECTION_RESPONSE_TIMEOUT)
+
+async def wait_for_exit():
+    assert _exit_event, 'message_server.main() is not running'
+    await _exit_event.wait()
+
 async def main():
-    global ready_to_exit
+    global ready_to_exit, _loop, _exit_event
+    _loop = asyncio.get_running_loop()
+    _exit_event = asyncio.Event()
+    if should_exit: # exit() was called before the loop started
+        _exit_event.set()
+    outbound_message_queue.bind()
     broadcast_service_task = asyncio.create_task(broadcast_service())
     messaging_service_task = asyncio.create_task(messaging_service())
+    connection_pool_task = asyncio.create_task(connection_pool.pool.maintain())
+    presence_task = asyncio.create_task(presence.tracker.run())
+    try:
+        await channels.manager.start(_instance_id, _on_channel_message)
+    except OSError as e:
+        utils.print_error("Failed to open the multicast channel socket:", e)
+    channels_task = asyncio.create_task(channels.manager.run())
+    try:
+        outbox.store.open(_send_stored_message, generate_system_message)
+    except OSError as e:
+        utils.print_error("Failed to open the outbox:", e)
+    outbox_task = asyncio.create_task(outbox.store.run())
+    delivery.tracker.start(_resend_unacknowledged, _on_delivery_failed)
+    delivery_task = asyncio.create_task(delivery.tracker.run())
+    file_transfer_task = asyncio.create_task(file_transfer.run())
+    if utils.get_setting('security.encryption.enabled', True):
+        key_exchange.pool.prefill(key_exchange.get_configured_group())
 
-    events.on_event('ban_ip', lambda _, ip: isinstance(ip, str) and blocklist.setdefault(ip, 1))
-    events.on_event('unban_ip', lambda _, ip: isinstance(ip, str) and blocklist.pop(ip, None))
+    events.on_event('ban_ip', lambda _, ip: isinstance(ip, str) and _loop and _loop.call_soon_threadsafe(admission.controller.ban, ip))
+    events.on_event('unban_ip', lambda _, ip: isinstance(ip, str) and _loop and _loop.call_soon_threadsafe(admission.controller.unban, ip))
 
-    while not should_exit:
-        await asyncio.sleep(0.01)
+    await wait_for_exit()
+    _send_goodbye()
+    connection_pool_task.cancel()
+    presence_task.cancel()
+    channels_task.cancel()
+    channels.manager.close()
+    outbox_task.cancel()
+    outbox.store.close()
+    delivery_task.cancel()
+    file_transfer_task.cancel()
+    await connection_pool.pool.close_all()
     await broadcast_service_task
     await messaging_service_task
     ready_to_exit = True
@@ -281,6 +981,9 @@ async def main():
 def exit():
     global should_exit
     should_exit = True
+    outbound_message_queue.put(None)
+    if _loop and _exit_event:
+        _loop.call_soon_threadsafe(_exit_event.set)
 
 def _on_send_mesage_packet(_, message_packet):
     assert(isinstance(message_packet, MessagePacket))
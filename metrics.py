@@ -0,0 +1,62 @@
+import threading
+import time
+
+# Counters and gauges for the networking code, shown by the '/stats' command.
+# They can be updated from any thread.
+# Counters registered with `track_rate` also report how much they grew during the last minute.
+
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_gauges: dict[str, float] = {}
+_minute_buckets: dict[str, tuple[int, float, float]] = {} # name -> (current minute, amount in the current minute, amount in the previous minute)
+
+def _get_minute() -> int:
+    return int(time.monotonic() // 60)
+
+def track_rate(name: str):
+    with _lock:
+        _minute_buckets.setdefault(name, (_get_minute(), 0, 0))
+
+def increment(name: str, amount: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+        if name in _minute_buckets:
+            minute, current, previous = _minute_buckets[name]
+            now = _get_minute()
+            if now != minute:
+                minute, current, previous = now, 0, current if now == minute + 1 else 0
+            _minute_buckets[name] = (minute, current + amount, previous)
+
+def set_gauge(name: str, value: float):
+    with _lock:
+        _gauges[name] = value
+
+def get_counter(name: str) -> float:
+    with _lock:
+        return _counters.get(name, 0)
+
+def get_gauge(name: str) -> float:
+    with _lock:
+        return _gauges.get(name, 0)
+
+def get_rate_per_minute(name: str) -> float:
+    """Estimates how much the counter grew during the last 60 seconds."""
+    with _lock:
+        return _get_rate_per_minute(name)
+
+def _get_rate_per_minute(name: str) -> float:
+    if name not in _minute_buckets:
+        return 0
+    minute, current, previous = _minute_buckets[name]
+    now = time.monotonic() / 60
+    if int(now) == minute + 1:
+        minute, current, previous = minute + 1, 0, current
+    elif int(now) != minute:
+        return 0
+    # the previous minute is weighted by how much of it is still within the last 60 seconds
+    return current + previous * (1 - (now - minute))
+
+def get_all() -> dict[str, float]:
+    with _lock:
+        rates = {f'{name}.per_minute': _get_rate_per_minute(name) for name in _minute_buckets}
+        return {**_counters, **_gauges, **rates}
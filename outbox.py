@@ -0,0 +1,282 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import metrics
+import utils
+from attachment import Attachment
+from config import *
+from message import Message
+
+# Store-and-forward for users that are offline or unreachable (a laptop that went to sleep).
+# Undelivered messages are appended to './data/outbox.log' and sent in order when the user comes back online.
+# While a user has stored messages, new messages to them are stored too, so they arrive in the order they were written.
+# The file is append-only, one JSON object per line:
+#   {"put": {...}}        a stored message, with its receiver, time, text, attachments and metadata
+#   {"done": [id, ...]}   messages that were delivered (or dropped), written once per batch
+# It is rewritten without the delivered messages when they take up enough space, and when the app starts.
+# Attachments that are files are stored as their path, others are stored base64 encoded.
+# Lines are written right away and synced to the disk by a background task, one fsync for every burst of writes.
+
+class _StoredMessage():
+    def __init__(self, record: dict, size: int):
+        self.id = str(record['id'])
+        self.username = str(record['to'])
+        self.time = float(record['time'])
+        self.channel = str(record.get('channel', 'chat'))
+        self.record = record
+        self.size = size
+
+    def is_expired(self) -> bool:
+        return time.time() - self.time > OUTBOX_EXPIRY
+
+    def to_message(self) -> Message:
+        attachments = []
+        for entry in self.record.get('attachments', []):
+            if 'path' in entry:
+                if not os.path.exists(entry['path']):
+                    raise FileNotFoundError(f"the attachment {entry['filename']} no longer exists")
+                attachments.append(Attachment.from_file(entry['path'], entry['filename'], offset=int(entry['offset']), size=int(entry['size'])))
+            else:
+                attachments.append(Attachment.from_dict(entry))
+        # the message keeps its id, so the receiver drops it if it got through before the app was closed
+        return Message(str(self.record['author']), str(self.record['text']), attachments, dict(self.record.get('metadata', {})), self.record.get('message_id'), self.record.get('timestamp'))
+
+def _encode_attachment(attachment: Attachment) -> dict:
+    path = attachment.get_path()
+    if path is None:
+        return attachment.to_dict()
+    return {'filename': attachment.get_sanitized_filename(), 'path': os.path.abspath(path), 'offset': attachment.get_offset(), 'size': attachment.get_content_size()}
+
+class Outbox():
+    def __init__(self):
+        self._queues: dict[str, OrderedDict[str, _StoredMessage]] = {}
+        self._bytes = 0 # size of the stored messages in the file
+        self._file_size = 0
+        self._path = OUTBOX_PATH
+        self._file = None
+        self._send: Callable[[str, Message, str], Awaitable[bool]]|None = None
+        self._notify: Callable[[str], None] = utils.print_info
+        self._flush_tasks: dict[str, asyncio.Task] = {}
+        self._sync_pending = False # written lines that aren't synced to the disk yet
+        self._sync_task: asyncio.Task|None = None
+
+    def open(self, send: Callable[[str, Message, str], Awaitable[bool]], notify: Callable[[str], None], path: str = OUTBOX_PATH):
+        """Loads the stored messages. `send(username, message, channel)` returns False if the user couldn't be reached."""
+        self._send = send
+        self._notify = notify
+        self._path = path
+        if os.path.exists(path):
+            self._load()
+        self._compact()
+        self._drop_expired()
+
+    def close(self):
+        for task in self._flush_tasks.values():
+            task.cancel()
+        self._flush_tasks.clear()
+        if self._sync_task:
+            self._sync_task.cancel()
+            self._sync_task = None
+        if self._file:
+            if self._sync_pending:
+                os.fsync(self._file.fileno())
+                self._sync_pending = False
+            self._file.close()
+            self._file = None
+
+    def has_messages(self, username: str) -> bool:
+        return username in self._queues
+
+    def get_depths(self) -> dict[str, int]:
+        return {username: len(queue) for username, queue in self._queues.items()}
+
+    def put(self, username: str, message: Message, channel: str) -> bool:
+        """Stores the message until the user can be reached. Returns False if the outbox is full or isn't open."""
+        if self._file is None:
+            return False
+        record = {
+            'id': uuid.uuid4().hex,
+            'message_id': message.get_id(),
+            'timestamp': message.get_timestamp(),
+            'to': username,
+            'time': time.time(),
+            'channel': channel,
+            'author': message.get_author_username(),
+            'text': message.get_text_content(),
+            'attachments': [_encode_attachment(attachment) for attachment in message.get_attachments()],
+            'metadata': message.get_metadata(),
+        }
+        try:
+            line = json.dumps({'put': record}) + '\n'
+        except (TypeError, ValueError): # metadata that can't be stored
+            return False
+        queue = self._queues.get(username)
+        if (queue and len(queue) >= OUTBOX_MAX_MESSAGES_PER_USER) or self._bytes + len(line) > OUTBOX_MAX_BYTES:
+            metrics.increment('outbox.rejected')
+            return False
+        self._write(line)
+        self._add(_StoredMessage(record, len(line)))
+        metrics.increment('outbox.stored')
+        return True
+
+    def flush(self, username: str):
+        """Starts sending the stored messages to the user, unless they are already being sent."""
+        if username in self._queues and username not in self._flush_tasks:
+            self._flush_tasks[username] = asyncio.create_task(self._flush(username))
+
+    async def run(self):
+        # users that stayed online while they were unreachable don't come online again, they are retried from here
+        while True:
+            await asyncio.sleep(OUTBOX_RETRY_INTERVAL)
+            self._drop_expired()
+            for username in list(self._queues):
+                self.flush(username)
+
+    async def _flush(self, username: str):
+        assert self._send, 'the outbox is not open'
+        start = time.monotonic()
+        delivered_count = 0
+        try:
+            while queue := self._queues.get(username):
+                done = []
+                reachable = True
+                for stored in list(itertools.islice(queue.values(), OUTBOX_BATCH_SIZE)):
+                    if stored.is_expired():
+                        metrics.increment('outbox.expired')
+                        done.append(stored)
+                        continue
+                    try:
+                        message = stored.to_message()
+                    except (OSError, KeyError, TypeError, ValueError) as e:
+                        self._notify(f'Failed to send a stored message to {username}: {e}.')
+                        done.append(stored)
+                        continue
+                    reachable = await self._send(username, message, stored.channel)
+                    if not reachable:
+                        break
+                    done.append(stored)
+                    delivered_count += 1
+                self._remove(done)
+                if not reachable:
+                    break
+        finally:
+            self._flush_tasks.pop(username, None)
+        if delivered_count:
+            drain_time = time.monotonic() - start
+            metrics.increment('outbox.delivered', delivered_count)
+            metrics.increment('outbox.drains')
+            metrics.increment('outbox.drain_seconds', drain_time)
+            metrics.set_gauge('outbox.last_drain_seconds', drain_time)
+            self._notify(f'Sent {delivered_count} stored message{"s" if delivered_count > 1 else ""} to {username}.')
+
+    def _drop_expired(self):
+        expired = [stored for queue in self._queues.values() for stored in queue.values() if stored.is_expired()]
+        if not expired:
+            return
+        metrics.increment('outbox.expired', len(expired))
+        for username in {stored.username for stored in expired}:
+            count = sum(1 for stored in expired if stored.username == username)
+            self._notify(f'{count} stored message{"s" if count > 1 else ""} to {username} expired without being sent.')
+        self._remove(expired)
+
+    def _add(self, stored: _StoredMessage):
+        self._queues.setdefault(stored.username, OrderedDict())[stored.id] = stored
+        self._bytes += stored.size
+        self._update_gauges()
+
+    def _remove(self, stored_messages: list[_StoredMessage]):
+        removed = []
+        for stored in stored_messages:
+            queue = self._queues.get(stored.username)
+            if queue is None or queue.pop(stored.id, None) is None:
+                continue
+            if not queue:
+                del self._queues[stored.username]
+            self._bytes -= stored.size
+            removed.append(stored.id)
+        if not removed:
+            return
+        self._write(json.dumps({'done': removed}) + '\n')
+        self._update_gauges()
+        if self._file_size - self._bytes >= OUTBOX_COMPACTION_SIZE:
+            self._compact()
+
+    def _update_gauges(self):
+        metrics.set_gauge('outbox.messages', sum(len(queue) for queue in self._queues.values()))
+        metrics.set_gauge('outbox.bytes', self._bytes)
+
+    def _write(self, line: str):
+        if self._file is None:
+            return
+        data = line.encode('utf-8')
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+        # stored messages must survive the laptop losing power, but the event loop must not wait for the disk
+        self._sync_pending = True
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self._sync())
+
+    async def _sync(self):
+        while self._sync_pending and self._file:
+            self._sync_pending = False # lines written while syncing are synced in the next round
+            file = self._file
+            start = time.monotonic()
+            try:
+                await asyncio.to_thread(os.fsync, file.fileno())
+            except OSError as e:
+                if file is self._file: # otherwise it was compacted or closed meanwhile, and synced then
+                    utils.print_warning("Failed to sync the outbox to the disk:", e)
+            metrics.increment('outbox.syncs')
+            metrics.increment('outbox.sync_seconds', time.monotonic() - start)
+
+    def _load(self):
+        with open(self._path, mode='rb') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                    if 'put' in record:
+                        self._add(_StoredMessage(record['put'], len(line)))
+                    elif 'done' in record:
+                        self._remove_loaded(record['done'])
+                except (ValueError, TypeError, KeyError):
+                    utils.print_warning("Skipped a damaged line in the outbox.") # the app stopped while writing it
+        utils.print_info(f"Loaded {sum(len(queue) for queue in self._queues.values())} stored messages from the outbox.")
+
+    def _remove_loaded(self, ids: list[str]):
+        ids = set(ids)
+        for username, queue in list(self._queues.items()):
+            for message_id in ids.intersection(queue):
+                self._bytes -= queue.pop(message_id).size
+            if not queue:
+                del self._queues[username]
+
+    def _compact(self):
+        """Rewrites the file with only the stored messages."""
+        if self._file:
+            self._file.close()
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        temporary_path = self._path + '.tmp'
+        self._bytes = 0
+        with open(temporary_path, mode='wb') as file:
+            for queue in self._queues.values():
+                for stored in queue.values():
+                    data = (json.dumps({'put': stored.record}) + '\n').encode('utf-8')
+                    stored.size = len(data)
+                    self._bytes += stored.size
+                    file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self._path)
+        self._file = open(self._path, mode='ab')
+        self._file_size = self._bytes
+        self._sync_pending = False # the rewritten file was synced before it replaced the old one
+        self._update_gauges()
+
+store = Outbox()
@@ -0,0 +1,155 @@
+import asyncio
+from typing import Awaitable, Callable, TYPE_CHECKING
+
+import utils
+from config import *
+from message import Message
+
+if TYPE_CHECKING:
+    from group_send import GroupPayload
+
+# Outbound messages are queued per remote user instead of being sent one packet at a time,
+# so an unreachable user or a large attachment only delays the messages to that user.
+# Bursts of chat messages without attachments (a pasted log, a script sending in a loop) are coalesced:
+# the messages queued behind the first one, and those that arrive within COALESCE_DELAY, are passed on as one list.
+# A message that arrives alone is sent right away.
+
+LANE_CHAT = 'chat'
+LANE_BULK = 'bulk'
+
+# Lanes served by each worker.
+# Bulk traffic has its own worker (and connection), so a large attachment never holds up chat messages.
+# Control traffic (acks, rekeys, hellos) isn't queued, it's written to the connection right away.
+_WORKER_LANES = {
+    'chat': [LANE_CHAT],
+    'bulk': [LANE_BULK],
+}
+
+def is_coalescible(item: 'Message|GroupPayload') -> bool:
+    return isinstance(item, Message) and not item.has_attachments() and len(item.get_text_content()) <= COALESCE_MAX_BYTES
+
+class PeerSender():
+    def __init__(self, username: str, channel: str, send: Callable[[str, 'Message|GroupPayload|list[Message]', str], Awaitable[object]]):
+        self.username = username
+        self.channel = channel
+        self._send = send
+        self._queues: dict[str, asyncio.Queue['Message|GroupPayload']] = {lane: asyncio.Queue(PEER_QUEUE_SIZE) for lane in _WORKER_LANES[channel]}
+        self._wakeup = asyncio.Event()
+        self._in_flight_lane: str|None = None
+        self._held: tuple[str, 'Message|GroupPayload']|None = None # taken from a queue while coalescing, sent next
+        self._task = asyncio.create_task(self._work())
+
+    def enqueue(self, message: 'Message|GroupPayload', lane: str) -> bool:
+        try:
+            self._queues[lane].put_nowait(message)
+        except asyncio.QueueFull:
+            return False
+        self._wakeup.set()
+        return True
+
+    def get_queue_depths(self) -> dict[str, int]:
+        depths = {lane: queue.qsize() for lane, queue in self._queues.items()}
+        in_flight_lane = self._in_flight_lane
+        if in_flight_lane:
+            depths[in_flight_lane] += 1
+        if self._held:
+            depths[self._held[0]] += 1
+        return depths
+
+    def is_running(self) -> bool:
+        return not self._task.done()
+
+    def stop(self):
+        """Stops sending and releases the group messages that are still queued, so their spool files are removed."""
+        self._task.cancel() # the message being sent is released by the send function when it's cancelled
+        while (item := self._next_message()) is not None:
+            if not isinstance(item[1], Message):
+                item[1].release()
+
+    def _next_message(self) -> tuple[str, 'Message|GroupPayload']|None:
+        if self._held:
+            item, self._held = self._held, None
+            return item
+        for lane, queue in self._queues.items():
+            if not queue.empty():
+                return lane, queue.get_nowait()
+        return None
+
+    async def _work(self):
+        while True:
+            item = self._next_message()
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=PEER_SENDER_IDLE_TIMEOUT)
+                except TimeoutError:
+                    if self._get_queued_count() == 0:
+                        return # idle workers are removed and recreated on demand
+                continue
+            lane, message = item
+            self._in_flight_lane = lane
+            try:
+                to_send: 'Message|GroupPayload|list[Message]' = message
+                if lane == LANE_CHAT and isinstance(message, Message) and is_coalescible(message):
+                    batch = await self._coalesce(message)
+                    if len(batch) > 1:
+                        to_send = batch
+                await self._send(self.username, to_send, self.channel)
+            except Exception as e:
+                utils.print_error(f"Failed to send a message to {self.username}:", e)
+            finally:
+                self._in_flight_lane = None
+
+    async def _coalesce(self, first: Message) -> list[Message]:
+        batch = [first]
+        size = len(first.get_text_content())
+        queue = self._queues[LANE_CHAT]
+        deadline = asyncio.get_running_loop().time() + COALESCE_DELAY
+        while len(batch) < COALESCE_MAX_MESSAGES:
+            if queue.empty():
+                remaining = deadline - asyncio.get_running_loop().time()
+                if len(batch) == 1 or remaining <= 0: # a lone message isn't delayed, only a burst is waited for
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                except TimeoutError:
+                    break
+                continue
+            item = queue.get_nowait()
+            if not isinstance(item, Message) or not is_coalescible(item) or size + len(item.get_text_content()) > COALESCE_MAX_BYTES:
+                self._held = (LANE_CHAT, item) # it's sent next, after the batch
+                break
+            batch.append(item)
+            size += len(item.get_text_content())
+        return batch
+
+    def _get_queued_count(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values()) + (1 if self._held else 0)
+
+class PeerSenders():
+    def __init__(self, send: Callable[[str, 'Message|GroupPayload|list[Message]', str], Awaitable[object]]):
+        self._send = send
+        self._senders: dict[tuple[str, str], PeerSender] = {}
+
+    def enqueue(self, username: str, message: 'Message|GroupPayload', lane: str) -> bool:
+        """Queues the message for the user. Returns False if the lane is full."""
+        channel = 'bulk' if lane == LANE_BULK else 'chat'
+        sender = self._senders.get((username, channel))
+        if sender is None or not sender.is_running():
+            sender = PeerSender(username, channel, self._send)
+            self._senders[(username, channel)] = sender
+        return sender.enqueue(message, lane)
+
+    def get_queue_depths(self) -> dict[str, dict[str, int]]:
+        """Returns the number of queued (or being sent) messages for each user and lane."""
+        result: dict[str, dict[str, int]] = {}
+        for (username, _), sender in list(self._senders.items()):
+            if sender.is_running():
+                result.setdefault(username, {}).update(sender.get_queue_depths())
+        return result
+
+    def stop(self):
+        for sender in self._senders.values():
+            sender.stop()
+        self._senders.clear()
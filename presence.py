@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+import metrics
+import utils
+from config import *
+from events import push_event
+from user import User, Users
+
+# Tracks which users are online.
+# Every time a user is seen, their expiry is pushed onto a heap, instead of every user being polled for their last seen time.
+# Stale heap entries (the user was seen again since) are skipped when they come up.
+# Users that stay offline for long are removed from `Users` and only a small tombstone (last IP and last seen time) is kept.
+
+_EXPIRE = 0
+_EVICT = 1
+
+class PresenceTracker():
+    def __init__(self):
+        self._timers: list[tuple[float, int, int, User]] = [] # (due time, sequence, kind, user)
+        self._sequence = itertools.count()
+        self._tombstones: dict[str, tuple[str, float]] = {} # username -> (last IP, last seen), oldest first
+        self._wakeup: asyncio.Event|None = None
+        self._online_count = 0
+        self._expiries: dict[User, float] = {}
+        self._version = 0 # changes whenever a user comes online, goes offline or is removed
+
+    def get_version(self) -> int:
+        """Lets other threads (the user list) notice changes without relying on events, which may be coalesced."""
+        return self._version
+
+    def seen(self, user: User, timeout: float = PRESENCE_TIMEOUT) -> bool:
+        """Marks the user as seen now, and online for `timeout` seconds. Returns True if the user just came online."""
+        user.update_last_seen()
+        expiry = user.get_last_seen() + timeout
+        self._expiries[user] = expiry
+        self._schedule(expiry, _EXPIRE, user)
+        if self._tombstones.pop(user.get_username(), None):
+            metrics.set_gauge('presence.tombstones', len(self._tombstones))
+        if user.is_active():
+            return False
+        user.set_online(True)
+        self._online_count += 1
+        self._version += 1
+        metrics.set_gauge('presence.users.online', self._online_count)
+        return True
+
+    def set_offline(self, user: User):
+        """Marks the user as offline now, for example after they said goodbye."""
+        if not user.is_active():
+            return
+        user.set_online(False)
+        self._online_count -= 1
+        self._version += 1
+        self._schedule(time.time() + USER_EVICTION_TIMEOUT, _EVICT, user)
+        metrics.set_gauge('presence.users.online', self._online_count)
+        push_event('on_user_offline', user)
+
+    def get_online_count(self) -> int:
+        return self._online_count
+
+    def get_tombstone(self, username: str) -> tuple[str, float]|None:
+        """Returns the last IP and last seen time of a user that was removed after being offline for long."""
+        return self._tombstones.get(username)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            delay = self._timers[0][0] - time.time() if self._timers else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except TimeoutError:
+                    pass
+            self.process_timers()
+
+    def process_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, kind, user = heapq.heappop(self._timers)
+            if kind == _EXPIRE:
+                if user.is_active() and self._expiries.get(user, 0) <= now:
+                    self.set_offline(user)
+            elif kind == _EVICT:
+                if not user.is_active() and user.is_remote() and user.get_last_seen() + USER_EVICTION_TIMEOUT <= now:
+                    self._evict(user)
+
+    def _schedule(self, due: float, kind: int, user: User):
+        if self._wakeup and (not self._timers or due < self._timers[0][0]):
+            self._wakeup.set() # the run loop is waiting for a later timer
+        heapq.heappush(self._timers, (due, next(self._sequence), kind, user))
+
+    def _evict(self, user: User):
+        self._expiries.pop(user, None)
+        if not Users.remove_user(user):
+            return
+        self._version += 1
+        username = user.get_username()
+        self._tombstones[username] = (user.get_ip() if user.has_ip() else 'NA', user.get_last_seen())
+        while len(self._tombstones) > MAX_TOMBSTONES:
+            self._tombstones.pop(next(iter(self._tombstones)))
+        metrics.set_gauge('presence.tombstones', len(self._tombstones))
+        utils.print_info(f"Removed user {username}, who has been offline for {USER_EVICTION_TIMEOUT} seconds.")
+        push_event('on_user_removed', user)
+
+tracker = PresenceTracker()
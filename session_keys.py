@@ -0,0 +1,96 @@
+import threading
+import time
+import uuid
+
+import ciphers
+import utils
+from config import *
+
+# Shared keys are agreed once per session instead of once per message.
+# The sender picks a session id during the key exchange and includes it in every message encrypted with that key.
+# Outgoing sessions are rekeyed after a configurable lifetime or number of messages (see the '/encryption' command).
+
+class UnknownSessionError(Exception):
+    pass
+
+class SessionKey():
+    def __init__(self, session_id: str, key: int, peer_instance: str|None = None, cipher_name: str = ciphers.CIPHER_3DES):
+        self.session_id = session_id
+        self.key = key
+        self.cipher = ciphers.get_cipher(cipher_name, key)
+        self.peer_instance = peer_instance
+        self.message_count = 0
+        self._created = time.monotonic()
+        self._last_used = self._created
+
+    def use(self) -> ciphers.SessionCipher:
+        self.message_count += 1
+        self._last_used = time.monotonic()
+        return self.cipher
+
+    def get_age(self) -> float:
+        return time.monotonic() - self._created
+    def get_idle_time(self) -> float:
+        return time.monotonic() - self._last_used
+
+def generate_session_id() -> str:
+    return uuid.uuid4().hex
+
+def get_rekey_interval() -> int:
+    return utils.get_setting('security.encryption.rekey.interval', DEFAULT_REKEY_INTERVAL)
+
+def get_rekey_message_count() -> int:
+    return utils.get_setting('security.encryption.rekey.messages', DEFAULT_REKEY_MESSAGE_COUNT)
+
+class SessionKeyStore():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._outgoing: dict[tuple[str, object], SessionKey] = {} # keyed by (username, key exchange group id)
+        self._incoming: dict[str, dict[str, SessionKey]] = {} # keyed by username, then session id
+
+    def get_outgoing(self, username: str, group_id: object, peer_instance: str|None) -> SessionKey|None:
+        """Returns the current session key for the user, or None if a new key exchange is needed."""
+        with self._lock:
+            session = self._outgoing.get((username, group_id))
+            if session is None:
+                return None
+            if session.peer_instance != peer_instance: # the peer restarted and lost its keys
+                expired = True
+            else:
+                expired = session.get_age() > get_rekey_interval() or session.message_count >= get_rekey_message_count()
+            if expired:
+                self._outgoing.pop((username, group_id), None)
+                return None
+            return session
+
+    def set_outgoing(self, username: str, group_id: object, session: SessionKey):
+        with self._lock:
+            self._outgoing[(username, group_id)] = session
+
+    def add_incoming(self, username: str, session: SessionKey):
+        with self._lock:
+            sessions = self._incoming.setdefault(username, {})
+            sessions[session.session_id] = session
+            while len(sessions) > MAX_INCOMING_SESSIONS_PER_USER:
+                least_recently_used = max(sessions.values(), key=lambda session: session.get_idle_time())
+                sessions.pop(least_recently_used.session_id, None)
+
+    def get_incoming(self, username: str, session_id: str) -> SessionKey:
+        with self._lock:
+            session = self._incoming.get(username, {}).get(session_id)
+        if session is None:
+            raise UnknownSessionError(f'Unknown session {session_id} from {username}')
+        return session
+
+    def forget(self, username: str|None = None):
+        """Forgets the keys of the user, or every key if no user is given, so the next message starts a new key exchange."""
+        with self._lock:
+            if username is None:
+                self._outgoing.clear()
+                self._incoming.clear()
+                return
+            for key in [key for key in self._outgoing if key[0] == username]:
+                self._outgoing.pop(key, None)
+            self._incoming.pop(username, None)
+
+store = SessionKeyStore()
@@ -1,7 +1,10 @@
 import json
 import os
-import tkinter as tk
-from typing import Dict, assert_type
+import sys
+from typing import Dict, assert_type, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tkinter as tk
 
 type SettingValue = None|bool|int|float|str
 
@@ -70,8 +73,8 @@ def bind_to_setting(variable: object, setting: str, default: SettingValue) -> bo
     _setting_bindings[setting].append(variable)
     return _update_variable(variable, get_setting(setting, default))
 
-def bind_tkinter_variable_to_setting(variable: tk.Variable, setting: str, default: SettingValue) -> tk.Variable:
-    assert_type(variable, tk.Variable)
+def bind_tkinter_variable_to_setting(variable: 'tk.Variable', setting: str, default: SettingValue) -> 'tk.Variable':
+    assert_type(variable, 'tk.Variable')
     assert_type(setting, str)
     assert_type(default, SettingValue)
     bind_to_setting(variable, setting, default)
@@ -125,9 +128,14 @@ def _update_bound_variables(setting: str, value: SettingValue) -> bool:
             success = min(success, _update_variable(variable, value))
     return success
 
+def _is_tkinter_variable(variable: object) -> bool:
+    # tkinter is only imported by the window, the headless mode runs without it
+    tkinter = sys.modules.get('tkinter')
+    return tkinter is not None and isinstance(variable, tkinter.Variable)
+
 def _update_variable(variable: object, value: SettingValue) -> bool:
     assert_type(value, SettingValue)
-    if isinstance(variable, tk.Variable):
+    if _is_tkinter_variable(variable):
         variable.set(value)
     elif isinstance(variable, tuple[dict[str, object], str]):
         variable[0][variable[1]] = value
@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import channels
+from config import *
+
+# Datagrams from another member are built with their own MulticastChannel, as they would be on the wire.
+
+SENDER = b'\x01' * 16
+REPAIR_PORT = 6001
+
+class ChannelDatagramTest(unittest.TestCase):
+    def setUp(self):
+        self.received: list[str] = []
+        self.manager = channels.ChannelManager()
+        self.manager._instance = b'\x02' * 16
+        self.manager._on_message = lambda message, channel_name: self.received.append(message.get_text_content())
+        self.manager.join('general', 's3cret', save=False)
+        self.sender = channels.MulticastChannel('general', 's3cret')
+
+    def send(self, text: str) -> bool:
+        payload = ('{"author": "bob", "message": "%s"}' % text).encode()
+        return self.manager.handle_datagram(self.sender.encode(channels.CHANNEL_DATA, SENDER, REPAIR_PORT, payload), '10.0.0.2')
+
+    def test_data_is_received_in_order(self):
+        self.assertTrue(self.send('one'))
+        self.assertTrue(self.send('two'))
+        self.assertEqual(self.received, ['one', 'two'])
+
+    def test_spoofed_heartbeat_is_dropped(self):
+        self.send('one')
+        header = channels.CHANNEL_HEADER.pack(channels.CHANNEL_MAGIC, channels.CHANNEL_HEARTBEAT, self.sender.channel_id, SENDER, REPAIR_PORT, 2 ** 40)
+        self.assertFalse(self.manager.handle_datagram(header, '10.0.0.66'))
+        self.assertTrue(self.send('two'))
+        self.assertEqual(self.received, ['one', 'two'])
+
+    def test_heartbeat_with_another_key_is_dropped(self):
+        self.send('one')
+        intruder = channels.MulticastChannel('general', 'guessed')
+        intruder.sequence = 2 ** 40
+        self.assertFalse(self.manager.handle_datagram(intruder.encode(channels.CHANNEL_HEARTBEAT, SENDER, REPAIR_PORT, b''), '10.0.0.66'))
+        self.send('two')
+        self.assertEqual(self.received, ['one', 'two'])
+
+    def test_large_sequence_jump_is_rejected(self):
+        self.send('one')
+        self.sender.sequence += MULTICAST_MAX_SEQUENCE_JUMP + 2
+        self.assertFalse(self.manager.handle_datagram(self.sender.encode(channels.CHANNEL_HEARTBEAT, SENDER, REPAIR_PORT, b''), '10.0.0.2'))
+        self.assertFalse(self.send('far ahead'))
+        self.assertEqual(self.received, ['one'])
+
+if __name__ == '__main__':
+    unittest.main()
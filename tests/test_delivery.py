@@ -0,0 +1,95 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import delivery
+from config import *
+from message import Message
+
+# A group message is sent to every receiver with the same id, each of them acknowledges it from their own address.
+
+RECEIVERS = {'alice': '10.0.0.1', 'bob': '10.0.0.2', 'carol': '10.0.0.3', 'dave': '10.0.0.4'}
+
+class GroupDeliveryTest(unittest.TestCase):
+    def setUp(self):
+        self.resent: list[str] = []
+        self.failed: list[str] = []
+        self.tracker = delivery.DeliveryTracker()
+        self.tracker.start(lambda username, message, channel: self.resent.append(username) or True, lambda username, message: self.failed.append(username))
+        self.message = Message('<localhost>', 'hello everyone')
+        for username, ip in RECEIVERS.items():
+            self.tracker.track(username, 'chat', self.message, ip)
+
+    def retry_later(self, seconds: float):
+        with mock.patch('delivery.time.monotonic', return_value=delivery.time.monotonic() + seconds):
+            self.tracker.retry_overdue()
+
+    def test_every_receiver_is_tracked(self):
+        self.assertEqual(self.tracker.get_unacknowledged_count(), len(RECEIVERS))
+
+    def test_ack_only_clears_its_sender(self):
+        self.tracker.acknowledge(RECEIVERS['bob'], [self.message.get_id()])
+        self.assertEqual(self.tracker.get_unacknowledged_count(), len(RECEIVERS) - 1)
+        self.retry_later(ACK_TIMEOUT + 1)
+        self.assertEqual(sorted(self.resent), ['alice', 'carol', 'dave'])
+
+    def test_ack_from_unknown_address_is_ignored(self):
+        self.tracker.acknowledge('10.0.0.99', [self.message.get_id()])
+        self.assertEqual(self.tracker.get_unacknowledged_count(), len(RECEIVERS))
+
+    def test_every_ack_clears_everything(self):
+        for ip in RECEIVERS.values():
+            self.tracker.acknowledge(ip, [self.message.get_id()])
+        self.assertEqual(self.tracker.get_unacknowledged_count(), 0)
+
+    def test_attempts_are_counted_per_receiver(self):
+        # alice answers nothing, the others acknowledge the first retry
+        self.retry_later(ACK_TIMEOUT + 1)
+        for username, ip in RECEIVERS.items():
+            self.tracker.track(username, 'chat', self.message, ip)
+            if username != 'alice':
+                self.tracker.acknowledge(ip, [self.message.get_id()])
+        for attempt in range(2, MAX_DELIVERY_ATTEMPTS):
+            self.retry_later(ACK_TIMEOUT * 2 ** attempt)
+            self.tracker.track('alice', 'chat', self.message, RECEIVERS['alice'])
+        self.retry_later(ACK_TIMEOUT * 2 ** MAX_DELIVERY_ATTEMPTS)
+        self.assertEqual(self.failed, ['alice'])
+        self.assertEqual(self.tracker.get_unacknowledged_count(), 0)
+
+    def test_resend_that_is_not_tracked_is_dropped(self):
+        # sent again through the legacy fallback, which isn't acknowledged
+        self.retry_later(ACK_TIMEOUT + 1)
+        self.assertEqual(self.tracker.get_unacknowledged_count(), len(RECEIVERS))
+        self.retry_later(ACK_TIMEOUT * 4)
+        self.assertEqual(self.tracker.get_unacknowledged_count(), 0)
+        self.assertEqual(len(self.resent), len(RECEIVERS))
+        self.assertEqual(self.failed, [])
+
+    def test_forget_only_drops_one_receiver(self):
+        self.tracker.forget('carol', self.message.get_id())
+        self.assertEqual(self.tracker.get_unacknowledged_count(), len(RECEIVERS) - 1)
+        self.tracker.acknowledge(RECEIVERS['carol'], [self.message.get_id()])
+        self.assertEqual(self.tracker.get_unacknowledged_count(), len(RECEIVERS) - 1)
+        for username in ['alice', 'bob', 'dave']:
+            self.tracker.acknowledge(RECEIVERS[username], [self.message.get_id()])
+        self.assertEqual(self.tracker.get_unacknowledged_count(), 0)
+
+class ReceivedIdsTest(unittest.TestCase):
+    def test_duplicates_are_found(self):
+        received_ids = delivery.ReceivedIds()
+        self.assertTrue(received_ids.add('bob', 'm1'))
+        self.assertFalse(received_ids.add('bob', 'm1'))
+        self.assertTrue(received_ids.add('carol', 'm1'))
+
+    def test_discarded_id_is_received_again(self):
+        # a message that couldn't be decoded wasn't acknowledged, its retry isn't a duplicate
+        received_ids = delivery.ReceivedIds()
+        received_ids.add('bob', 'm1')
+        received_ids.discard('bob', 'm1')
+        self.assertTrue(received_ids.add('bob', 'm1'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import threading
 import time
 
 class User():
@@ -9,6 +10,8 @@ class User():
         self._shared_key = 0
         self._last_seen = -1.0
         self._local = local
+        self._online = False # maintained by the presence tracker
+        self._registry: 'UserRegistry|None' = None
     
     def has_ip(self):
         return self._ip != 'NA'
@@ -21,12 +24,17 @@ class User():
         return not self._local
     
     def is_active(self) -> bool:
-        return (self._last_seen + 10) > time.time()
+        return self._online
     
     def set_ip(self, ip: str):
-        self._ip = ip
+        if self._registry:
+            self._registry._set_user_ip(self, ip) # keeps the IP index up to date
+        else:
+            self._ip = ip
     def set_shared_key(self, key: int):
         self._shared_key = key
+    def set_online(self, online: bool):
+        self._online = online
     def set_local(self):
         self._local = True
     def set_remote(self):
@@ -48,68 +56,132 @@ class User():
     def get_last_seen(self) -> float:
         return self._last_seen
 
-class Users():
-    users: list[User] = []
+class UserRegistry():
+    """All known users, indexed by username and by IP address.
 
-    @staticmethod
-    def create_user(username: str, local: bool):
-        if Users.check_username(username):
-            raise RuntimeError('User "' + username + '" already exist.')
-        user = User(username, local)
-        user.update_last_seen()
-        Users.users.append(user)
-        return user
+    Both the tkinter thread and the asyncio thread use the registry, so every access holds the lock.
+    """
+    def __init__(self):
+        self.users: list[User] = []
+        self._by_username: dict[str, User] = {}
+        self._by_ip: dict[str, list[User]] = {} # more than one user can share an IP address
+        self._lock = threading.RLock()
+
+    def create_user(self, username: str, local: bool):
+        with self._lock:
+            if username in self._by_username:
+                raise RuntimeError('User "' + username + '" already exist.')
+            user = User(username, local)
+            user.update_last_seen()
+            user._registry = self
+            self.users.append(user)
+            self._by_username[username] = user
+            return user
 
-    @staticmethod
-    def check_username(username: str) -> bool:
-        for user in Users.users:
-            if user.get_username() == username:
-                return True
-        return False
+    def check_username(self, username: str) -> bool:
+        with self._lock:
+            return username in self._by_username
 
-    @staticmethod
-    def get_user_by_username(username: str) -> User:
-        for user in Users.users:
-            if user.get_username() == username:
-                return user
-        raise RuntimeError('User "' + username + '" does not exist')
+    def get_user_by_username(self, username: str) -> User:
+        with self._lock:
+            user = self._by_username.get(username)
+        if user is None:
+            raise RuntimeError('User "' + username + '" does not exist')
+        return user
 
-    @staticmethod
-    def get_user_by_ip(ip: str) -> User|None:
-        best_last_seen = -1
-        best_candidate = None
-        for user in Users.users:
-            if user.get_ip() == ip and user.get_last_seen() > best_last_seen:
-                best_candidate = user
-                best_last_seen = user.get_last_seen()
-        if best_candidate == None:
-            raise RuntimeWarning('No user found with the ip: ' + ip)
-        return best_candidate
+    def get_user_by_ip(self, ip: str) -> User|None:
+        with self._lock:
+            candidates = self._by_ip.get(ip)
+            if not candidates:
+                raise RuntimeWarning('No user found with the ip: ' + ip)
+            return max(candidates, key=lambda user: user.get_last_seen())
 
-    @staticmethod
-    def set_username_ip(username: str, ip: str):
-        user: User = Users.get_user_by_username(username)
+    def set_username_ip(self, username: str, ip: str):
+        user: User = self.get_user_by_username(username)
         user.set_ip(ip)
 
-    @staticmethod
-    def rename_user(user: User|str, new_username: str):
+    def rename_user(self, user: User|str, new_username: str):
         if not isinstance(new_username, str):
             raise Exception('Bad argument #2: `new_username` should be a str')
-        if Users.check_username(new_username):
-            raise RuntimeError(f'Another user already has the username "{new_username}"')
-        if isinstance(user, str):
-            user = Users.get_user_by_username(user)
-        if isinstance(user, User):
-            if not user.is_local():
-                raise Exception('Can not rename an remote user')
-            user.username = new_username
+        with self._lock:
+            if new_username in self._by_username:
+                raise RuntimeError(f'Another user already has the username "{new_username}"')
+            if isinstance(user, str):
+                user = self.get_user_by_username(user)
+            if isinstance(user, User):
+                if not user.is_local():
+                    raise Exception('Can not rename an remote user')
+                if self._by_username.get(user.username) is user:
+                    del self._by_username[user.username]
+                    self._by_username[new_username] = user
+                user.username = new_username
 
-    @staticmethod
-    def get_all_users():
-        return Users.users.copy()
-    
-    @staticmethod
-    def is_active(user: User|str) -> bool:
+    def remove_user(self, user: User) -> bool:
+        with self._lock:
+            if self._by_username.get(user.username) is not user:
+                return False
+            del self._by_username[user.username]
+            self.users.remove(user)
+            if user.has_ip():
+                candidates = self._by_ip.get(user.get_ip(), [])
+                if user in candidates:
+                    candidates.remove(user)
+                if not candidates:
+                    self._by_ip.pop(user.get_ip(), None)
+            user._registry = None
+            return True
+
+    def get_all_users(self):
+        with self._lock:
+            return self.users.copy()
+
+    def is_active(self, user: User|str) -> bool:
         if isinstance(user, str):
-            user = Users.get_user_by_username(user)
+            user = self.get_user_by_username(user)
         return user.is_active()
+
+    def _set_user_ip(self, user: User, new_ip: str):
+        with self._lock:
+            old_ip = user._ip
+            user._ip = new_ip
+            if old_ip == new_ip:
+                return
+            if old_ip in self._by_ip:
+                candidates = self._by_ip[old_ip]
+                if user in candidates:
+                    candidates.remove(user)
+                if not candidates:
+                    del self._by_ip[old_ip]
+            if new_ip != 'NA':
+                self._by_ip.setdefault(new_ip, []).append(user)
+
+Users = UserRegistry()
+
+def benchmark(user_count: int = 10000, lookups: int = 100000) -> dict[str, float]:
+    """Returns the average time of each lookup in microseconds, on a separate registry with `user_count` users."""
+    registry = UserRegistry()
+    for i in range(user_count):
+        user = registry.create_user(f'user{i}', local=False)
+        user.set_ip(f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}')
+    usernames = [f'user{(i * 7919) % user_count}' for i in range(lookups)]
+    ips = [registry.get_user_by_username(username).get_ip() for username in usernames]
+    result = {}
+    start = time.perf_counter()
+    for username in usernames:
+        registry.check_username(username)
+    result['check_username'] = (time.perf_counter() - start) / lookups * 1000000
+    start = time.perf_counter()
+    for username in usernames:
+        registry.get_user_by_username(username)
+    result['get_user_by_username'] = (time.perf_counter() - start) / lookups * 1000000
+    start = time.perf_counter()
+    for ip in ips:
+        registry.get_user_by_ip(ip)
+    result['get_user_by_ip'] = (time.perf_counter() - start) / lookups * 1000000
+    # the linear scan the registry used to do, for comparison
+    scan_lookups = max(1, lookups // 100)
+    start = time.perf_counter()
+    for username in usernames[:scan_lookups]:
+        any(user.get_username() == username for user in registry.users)
+    result['linear scan (old)'] = (time.perf_counter() - start) / scan_lookups * 1000000
+    return result
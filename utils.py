@@ -2,14 +2,15 @@ import unicodedata
 import json
 import asyncio
 import secrets
+import time
+import hashlib
 import uuid
 from base64 import b64decode, b64encode
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives.ciphers import Cipher, modes as CipherModes
 from cryptography.hazmat.primitives.padding import PKCS7
 from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
-from typing import Any
-from tkinter import Variable
+from typing import Any, TYPE_CHECKING
 
 import unicode_utils
 from attachment import Attachment
@@ -19,13 +20,23 @@ from message import Message
 from constants import *
 from settings import *
 
-_setting_bindings: dict[str, list[Variable]] = {}
+if TYPE_CHECKING:
+    import ciphers
+    from tkinter import Variable
+
+_setting_bindings: dict[str, list['Variable']] = {}
+
+def setup_dir():
+    if not os.path.exists('./data/'):
+        os.makedirs('./data')
+    if not os.path.exists('./user_scripts/'):
+        os.makedirs('./user_scripts')
 
 def remove_control_characters(text: str) -> str:
     return "".join(ch for ch in text if unicodedata.category(ch)[0]!="C" or ch == '\n')
 
 # to not break the existing code
-def bind_variable_to_setting(variable: Variable, setting: str, default: SettingValue) -> Variable:
+def bind_variable_to_setting(variable: 'Variable', setting: str, default: SettingValue) -> 'Variable':
     return bind_tkinter_variable_to_setting(variable, setting, default)
 
 def change_username(username: str):
@@ -54,15 +65,43 @@ def validate_username(username: Any) -> bool:
 def generate_key(offset: int = 2, modulo: int = 65500):
     return (secrets.randbelow(modulo * 3) + offset) % modulo
 
-async def send_unencrypted_text(text: str, address: str, port: int) -> bool:
+class PeerUnreachableError(ConnectionError):
+    """Connecting to the peer failed or timed out. The message says why and how long it took."""
+    pass
+
+async def open_connection(address: str, port: int, timeout: float = CONNECT_TIMEOUT) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    start = time.monotonic()
+    try:
+        # with a bind address, peers see it as the source and can tell instances on one host apart
+        local_address = (BIND_ADDRESS, 0) if BIND_ADDRESS else None
+        return await asyncio.wait_for(asyncio.open_connection(address, port, local_addr=local_address), timeout=timeout)
+    except TimeoutError:
+        raise PeerUnreachableError(f'connecting timed out after {time.monotonic() - start:.1f} s')
+    except OSError as e:
+        raise PeerUnreachableError(f'{e.strerror or e} after {(time.monotonic() - start) * 1000:.0f} ms') from e
+
+async def drain(writer: asyncio.StreamWriter, timeout: float = WRITE_TIMEOUT):
+    try:
+        await asyncio.wait_for(writer.drain(), timeout=timeout)
+    except TimeoutError:
+        raise PeerUnreachableError(f'writing timed out after {timeout:.1f} s')
+
+async def send_unencrypted_text(text: str, address: str, port: int, message_id: str|None = None) -> bool:
     print_info("Initiating unencrypted connection.")
     writer = None
     try:
-        _, writer = await asyncio.open_connection(address, port)
-        writer.write(json.dumps({"unencrypted_message": unicode_utils.with_surrogates(text)}).encode(encoding='utf-8'))
+        _, writer = await open_connection(address, port)
+        payload: dict = {"unencrypted_message": unicode_utils.with_surrogates(text)}
+        if message_id:
+            payload['id'] = message_id
+        writer.write(json.dumps(payload).encode(encoding='utf-8'))
         writer.write_eof()
         print_info("Successfully sent the unencrypted message.")
         return True
+    except PeerUnreachableError:
+        raise
+    except ConnectionError as e: # reset or aborted by the peer, the other ways of sending would fail the same way
+        raise PeerUnreachableError(e.strerror or str(e)) from e
     except:
         print_error("Unencrypted connection failed.")
         return False
@@ -70,23 +109,26 @@ async def send_unencrypted_text(text: str, address: str, port: int) -> bool:
         if writer:
             await close_stream(writer)
 
-async def send_encrypted_text_with_common_diffie_hellman(text: str, address: str, port: int, our_private_key: int) -> bool:
+async def send_encrypted_text_with_common_diffie_hellman(text: str, address: str, port: int, our_private_key: int, message_id: str|None = None) -> bool:
     print_info("Initiating common DH key exchange")
     writer = None
     writer2 = None
     try:
         # generate our public key
-        our_public_key = (DEFAULT_DH_G ** our_private_key) % DEFAULT_DH_P
+        our_public_key = pow(DEFAULT_DH_G, our_private_key, DEFAULT_DH_P)
 
         # establish connection
-        reader, writer = await asyncio.open_connection(address, port)
+        reader, writer = await open_connection(address, port)
 
         # send our oublic key
         writer.write(json.dumps({"key": str(our_public_key)}).encode(encoding='utf-8'))
-        await writer.drain()
+        await drain(writer)
 
         # read their public key
-        data = await asyncio.wait_for(reader.read(MAX_PACKET_SIZE), timeout=10)
+        try:
+            data = await asyncio.wait_for(reader.read(MAX_PACKET_SIZE), timeout=HANDSHAKE_TIMEOUT)
+        except TimeoutError:
+            raise PeerUnreachableError(f'no key exchange reply after {HANDSHAKE_TIMEOUT:.1f} s')
         decoded_data = json.loads(decode_arbitrary_data(data))
         peer_public_key = int(decoded_data["key"])
 
@@ -94,19 +136,26 @@ async def send_encrypted_text_with_common_diffie_hellman(text: str, address: str
         assert(peer_public_key > 0 and peer_public_key < DEFAULT_DH_P)
 
         # generate a shared key using our private key and their public key
-        shared_key: int = (peer_public_key ** our_private_key) % DEFAULT_DH_P
+        shared_key: int = pow(peer_public_key, our_private_key, DEFAULT_DH_P)
 
         # encrypt the data using the shared key
         encrypted_data: str = encrypt_text(unicode_utils.with_surrogates(text), shared_key)
 
         # send the encrypted message
+        payload: dict = {"encrypted_message": encrypted_data}
+        if message_id:
+            payload['id'] = message_id
         if reader.at_eof():
-            _, writer2 = await asyncio.open_connection(address, port)
-            writer2.write(json.dumps({"encrypted_message": encrypted_data}).encode())
+            _, writer2 = await open_connection(address, port)
+            writer2.write(json.dumps(payload).encode())
         else:
-            writer.write(json.dumps({"encrypted_message": encrypted_data}).encode())
+            writer.write(json.dumps(payload).encode())
         print_info("Successfully sent the encrypted message.")
         return True
+    except PeerUnreachableError:
+        raise
+    except ConnectionError as e: # reset or aborted by the peer, the other ways of sending would fail the same way
+        raise PeerUnreachableError(e.strerror or str(e)) from e
     except Exception as e:
         print_error("Common DH failed. Error:", e)
         return False
@@ -123,12 +172,12 @@ async def send_encrypted_message(message: Message, address: str, port: int, our_
     writer2 = None
     try:
         # generate our public key
-        our_public_key = (g ** our_private_key) % p
+        our_public_key = pow(g, our_private_key, p)
         print_info("Our private key:", our_private_key)
         print_info("Our public key:", our_public_key)
 
         # establish connection
-        reader, writer = await asyncio.open_connection(address, port)
+        reader, writer = await open_connection(address, port)
         print_info("Connected to", writer.get_extra_info('peername'))
 
         # send our oublic key along with our custom g and p
@@ -139,15 +188,14 @@ async def send_encrypted_message(message: Message, address: str, port: int, our_
                 "g": g_str, "base": g_str,
                  "p": p_str, "mod": p_str, "modulus": p_str, "prime": p_str,
                 }).encode(encoding='utf-8'))
-        await writer.drain()
+        await drain(writer)
         print_info("Sent public key")
 
         # read their public key
         try:
-            data = await asyncio.wait_for(reader.read(MAX_PACKET_SIZE), timeout=10)
+            data = await asyncio.wait_for(reader.read(MAX_PACKET_SIZE), timeout=HANDSHAKE_TIMEOUT)
         except TimeoutError:
-            print_error('Peer failed to respond in time')
-            return False
+            raise PeerUnreachableError(f'no key exchange reply after {HANDSHAKE_TIMEOUT:.1f} s')
         print_info("Received peer's public key")
 
         # decode data
@@ -169,35 +217,28 @@ async def send_encrypted_message(message: Message, address: str, port: int, our_
         print_info("Agreed on DH parameters. g:", g, ", p:", p)
 
         # generate a shared key using our private key and their public key
-        shared_key: int = (peer_public_key ** our_private_key) % p
+        shared_key: int = pow(peer_public_key, our_private_key, p)
         print_info("Shared key:", shared_key)
 
-        # encrypt the message using the shared key
-        encrypted_text = encrypt_text(unicode_utils.with_surrogates(message.get_text_content()), shared_key)
-
-        # generate the payload
-        author = message.get_author_username()
-        if author == '<localhost>':
-            author = get_current_username()
-        payload_json = {'encrypted_message': encrypted_text, 'author': author}
-        if message.has_attachments():
-            payload_json['encrypted_attachments'] = [encrypt_text(str(attachment), shared_key) for attachment in message.get_attachments()]
-        if message.has_metadata():
-            payload_json['metadata'] = message.get_metadata()
-        payload = json.dumps(payload_json).encode()
+        # encrypt the message using the shared key and generate the payload
+        payload = json.dumps(generate_encrypted_payload(message, shared_key)).encode()
 
         # send the encrypted message
         if reader.at_eof():
-            _, writer2 = await asyncio.open_connection(address, port)
+            _, writer2 = await open_connection(address, port)
             writer2.write(payload)
             writer2.write_eof()
-            await writer2.drain()
+            await drain(writer2)
         elif writer.can_write_eof() and not writer.is_closing():
             writer.write(payload)
             writer.write_eof()
-            await writer.drain()
+            await drain(writer)
         print_info("Successfully sent the encrypted message.")
         return True
+    except PeerUnreachableError:
+        raise
+    except ConnectionError as e: # reset or aborted by the peer, the other ways of sending would fail the same way
+        raise PeerUnreachableError(e.strerror or str(e)) from e
     except Exception as e:
         print_error("Custom DH key exchange failed. Error:", e)
         return False
@@ -207,15 +248,38 @@ async def send_encrypted_message(message: Message, address: str, port: int, our_
         if writer2:
             await close_stream(writer2)
 
+def generate_encrypted_payload(message: Message, cipher: 'ciphers.SessionCipher|int', attachments: list[Attachment]|None = None) -> dict:
+    """Encrypts the message with a session cipher, or with 3DES if a shared key is given (for older clients)."""
+    if isinstance(cipher, int):
+        shared_key = cipher
+        encrypt = lambda text: encrypt_text(text, shared_key)
+    else:
+        encrypt = cipher.encrypt_text
+    encrypted_text = encrypt(unicode_utils.with_surrogates(message.get_text_content()))
+    author = message.get_author_username()
+    if author == '<localhost>':
+        author = get_current_username()
+    payload_json = {'encrypted_message': encrypted_text, 'author': author, 'id': message.get_id(), 'time': message.get_timestamp()}
+    if attachments is None:
+        attachments = message.get_attachments()
+    if len(attachments) > 0:
+        payload_json['encrypted_attachments'] = [encrypt(str(attachment)) for attachment in attachments]
+    if message.has_metadata():
+        payload_json['metadata'] = message.get_metadata()
+    return payload_json
+
+def generate_unencrypted_payload(message: Message) -> dict:
+    return {"unencrypted_message": unicode_utils.with_surrogates(message.get_text_content()), 'id': message.get_id(), 'time': message.get_timestamp()}
+
 async def send_encrypted_message_with_fallback(message: Message, address: str, port: int, our_private_key: int, g: int, p: int) -> bool:
     success = await send_encrypted_message(message, address, port, our_private_key, g=g, p=p)
     if success:
         return True
     else:
-        success = await send_encrypted_text_with_common_diffie_hellman(message.get_text_content(), address, port, our_private_key)
+        success = await send_encrypted_text_with_common_diffie_hellman(message.get_text_content(), address, port, our_private_key, message.get_id())
         if success:
             return True
-        success = await send_unencrypted_text(message.get_text_content(), address, port)
+        success = await send_unencrypted_text(message.get_text_content(), address, port, message.get_id())
         return False
 
 def decode_arbitrary_data(data: bytes) -> str:
@@ -237,7 +301,9 @@ async def close_stream(stream: asyncio.StreamReader|asyncio.StreamWriter):
         except:
             pass
         try:
-            await stream.drain()
+            await asyncio.wait_for(stream.drain(), timeout=WRITE_TIMEOUT)
+        except TimeoutError:
+            stream.transport.abort() # the peer stopped reading, the buffered data is dropped
         except:
             pass
         try:
@@ -250,22 +316,37 @@ async def close_stream(stream: asyncio.StreamReader|asyncio.StreamWriter):
     else:
         raise Exception(f'Invalid argument. StreamReader or StreamWriter expected, got {type(stream)}')
 
+def derive_cipher_key(key: int) -> bytes:
+    key_bytes = str(key).encode()
+    if len(key_bytes) <= 24:
+        return key_bytes.ljust(24) # keys from the small default group stay compatible with older peers
+    return hashlib.sha256(key_bytes).digest()[:24] # shared keys of large groups don't fit in a 3DES key
+
 def encrypt_text(text: str, key: int) -> str:
     return encrypt_bytes(text.encode('utf-8'), key)
 
 def encrypt_bytes(data: bytes, key: int) -> str:
-    cipher = Cipher(TripleDES(key=str(key).encode().ljust(24)), CipherModes.ECB())
-    encryptor = cipher.encryptor()
-    encrypted_data = encryptor.update(pad_PKCS7(data)) + encryptor.finalize()
+    encrypted_data = encrypt_bytes_raw(data, key)
     encrypted_string = b64encode(encrypted_data).decode(encoding='ascii')
     return encrypted_string
 
+def encrypt_bytes_raw(data: bytes|memoryview, key: int) -> bytes:
+    cipher = Cipher(TripleDES(key=derive_cipher_key(key)), CipherModes.ECB())
+    encryptor = cipher.encryptor()
+    return encryptor.update(pad_PKCS7(data)) + encryptor.finalize()
+
+def decrypt_bytes_raw(data: bytes|memoryview, key: int) -> bytes:
+    cipher = Cipher(TripleDES(key=derive_cipher_key(key)), CipherModes.ECB())
+    decryptor = cipher.decryptor()
+    return unpad_PKCS7(decryptor.update(data) + decryptor.finalize())
+
 def decrypt_text(encrypted_text: str, key: int) -> str:
-    cipher = Cipher(TripleDES(key=str(key).encode().ljust(24)), CipherModes.ECB())
+    cipher = Cipher(TripleDES(key=derive_cipher_key(key)), CipherModes.ECB())
     decryptor = cipher.decryptor()
     try:
-        if is_base64_encoded(encrypted_text):
-            decrypted_data = decryptor.update(b64decode(encrypted_text.encode(encoding='ascii'))) + decryptor.finalize()
+        encrypted_data = decode_base64(encrypted_text)
+        if encrypted_data is not None:
+            decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
         else:
             decrypted_data = decryptor.update(encrypted_text) + decryptor.finalize()
     except:
@@ -279,8 +360,9 @@ def decrypt_text(encrypted_text: str, key: int) -> str:
 
 def decrypt_text_with_fernet(encrypted_text: str, key: int) -> str:
     fernet = Fernet(key=str(key).encode().ljust(24))
-    if is_base64_encoded(encrypted_text):
-        decrypted_data = fernet.decrypt(b64decode(encrypted_text.encode(encoding='ascii')))
+    encrypted_data = decode_base64(encrypted_text)
+    if encrypted_data is not None:
+        decrypted_data = fernet.decrypt(encrypted_data)
     else:
         decrypted_data = fernet.decrypt(encrypted_text)
     return decode_arbitrary_data(decrypted_data)
@@ -296,11 +378,14 @@ def unpad_PKCS7(data: bytes):
     return unpadded_data
 
 def is_base64_encoded(string: str) -> bool:
+    return decode_base64(string) is not None
+
+def decode_base64(string: str) -> bytes|None:
+    """Returns the decoded data, or None if the string is not base64 encoded."""
     try:
-        result = b64decode(string.encode(encoding='ascii'))
-        return True
+        return b64decode(string.encode(encoding='ascii'))
     except:
-        return False
+        return None
 
 def search_dict(dictionary: dict, keys: list[str]) -> object|None:
     for k in dictionary.keys():
@@ -340,15 +425,18 @@ def log_chat_message(message: Message):
         except:
             print_error("Failed to log the message.")
 
-def save_attachment(attachment: Attachment) -> str:
+def generate_attachment_path(filename: str) -> str:
     path = os.path.abspath('./data/attachments/')
     os.makedirs(path, exist_ok=True)
-    filename = attachment.get_sanitized_filename()
-    content = attachment.get_content()
     unique_name = str(uuid.uuid4()) + '-' + filename
-    unique_abs_file_path = os.path.join(path, unique_name)
+    return os.path.join(path, unique_name)
+
+def save_attachment(attachment: Attachment) -> str:
+    if attachment.is_saved(): # streamed attachments are written to the attachments folder while being received
+        return os.path.relpath(attachment.get_path())
+    unique_abs_file_path = generate_attachment_path(attachment.get_sanitized_filename())
     with open(unique_abs_file_path, mode='xb') as file:
-        file.write(content)
+        file.write(attachment.get_view())
     return os.path.relpath(unique_abs_file_path)
 
 def can_send_attachments() -> bool: